@@ -1,31 +1,60 @@
 import base64
 import streamlit as st
 import pandas as pd
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import as_completed
 import snowflake.connector as con
+from streamlit import runtime
+from streamlit.runtime.scriptrunner import get_script_run_ctx
 import plotly.express as px
 from st_aggrid import AgGrid, GridOptionsBuilder
 import re
+import charts
 import data_fetcher
+import exports
+import rollups
+from backends import ParquetBackend, SnowflakeBackend
+from connection_pool import ConnectionPool
+from device_grid import DeviceGrid
+from diagnostics import QueryLog
+from query_scheduler import QueryScheduler
+from refresher import BackgroundRefresher
+from result_cache import ResultCache, frame_fingerprint
+from shared_cache import SharedResultStore
 import pathlib
+import tempfile
+import uuid
 from contextlib import suppress
+from functools import partial
 
 class InterruptResource(UserWarning):
     """To interrupt body on connection errors"""
 
 st.set_page_config(layout='wide')
+con.paramstyle = "qmark" # server side bind variables, so statements are reused across parameter values
 plotly_template = "plotly_dark"
 style_path = "assets/style.css"
 logo_path = "images/virsabi_logo_green_AW-01_pos.png"
 env = "testing"
+environments = ["testing", "production"] # offered in the environment comparison of the Total tab
+incremental_refresh = False # refresh aggregates from a watermark instead of rescanning all history
+local_sessions = False # split sessions locally by inactivity instead of by session ID and day, adds a funnel chart
+session_gap = pd.Timedelta(minutes=30) # inactivity that ends a session when local_sessions is on
+prefetch_device_details = True # index "Fetch more" data for every device up front
+pool_size = 4 # max snowflake connections per set of credentials
+max_concurrent_queries = 8 # warehouse queries running at once across every session
+device_grid_page_size = 50 # device table rows sent to the browser at once
+data_source = "snowflake" # "snowflake", or "parquet" to serve from the local snapshot below
+snapshot_path = "snapshot/account_events" # Parquet snapshot of ACCOUNT_EVENTS, written nightly by write_snapshot.py
+background_refresh_interval = 300 # seconds between background re-runs of the first page's queries, 0 turns it off
+shared_cache_dir = None # e.g. "/dev/shm/carlsberg_cache" to share query results between every server process on this host
 
 main_con = st.container(key="main")
 header = st.container(border=True, key="header")
 body = st.container(border=False, key="body")
 
 # Data to be persistent across restarts
-if "selected_row" not in st.session_state:
-    st.session_state.selected_row = None
+if "selected_device_token" not in st.session_state:
+    st.session_state.selected_device_token = None
 
 if "isActive" not in st.session_state:
     st.session_state.isActive = False
@@ -38,245 +67,98 @@ if "clear_cache" not in st.session_state:
 
 
 def main():
-    css_path = pathlib.Path(style_path)
-    load_css(css_path)
-    error = []
-    
+    load_css(style_path)
+    get_refresher() # starts warming the local snapshot's results while the first user logs in
+
     with header: # Login input header
-        
-        st.html(
-            """
-            <img id="expimg" src="data:image/png;base64,{}">
-            <h2 id="title1" >Analytics</h2>
-            """.format(
-                base64.b64encode(open("images/Purple_CBE.png", "rb").read()).decode()
-            )
-        )
-        st.divider()
-        
-        user = st.text_input("Username: ", key="user")
-        key = st.text_input("API Key: ", type="password", key="password")
-        # env = st.text_input("Environment: ", key="env")
-
-        h_col_l, h_col_r = st.columns(2, vertical_alignment="center")
-        with h_col_l:
-            if st.button("Fetch", type="primary", use_container_width=True):
-                try:
-                    # if not validate_input_string(env):
-                    #     error.append("Environments can only be a-Z characters")
-                    con = get_snowflake_connection(user, key) # FOR TESTING MOCK DATA
-                    # con = None # REMOVE IN PROD
-                    fetcher = data_fetcher.Data_fetcher(con, env)
-                    st.session_state.clear_cache = False
-                    st.session_state.fetcher = fetcher
-                    st.session_state.isActive = True
-                except Exception as e:
-                    print(f"Login error: {e}")
-                    error.append("Credential Error!")
-        with h_col_r:
-            cc_clicked = st.button("Clear Cache", type="primary", use_container_width=True)
-            if "fetcher" in st.session_state and cc_clicked:
-                st.session_state.isActive = False
-                st.session_state.clear_cache = True
-                st.cache_resource.clear()
-                st.cache_data.clear()
-
-        if len(error) > 0:
-            for e in error:
-                st.error(e)
-            st.session_state.isActive = False
-            
+        render_header()
 
     with suppress(InterruptResource) as _, body: # Data visualization fields
 
         # col_l, col_r = st.columns(2, gap='medium')
-        col_l, col_r = st.tabs(["Total", "By Device"])
+        show_diagnostics = st.query_params.get("diagnostics") == "1" # hidden tab, open the app with ?diagnostics=1
+        if show_diagnostics:
+            col_l, col_r, col_diag = st.tabs(["Total", "By Device", "Diagnostics"])
+        else:
+            col_l, col_r = st.tabs(["Total", "By Device"])
 
         if st.session_state.isActive:
             if st.session_state.get("clear_cache", False):
                 st.warning("Cache has been cleared. Please reload data.")
 
             else:
-                with st.spinner("Fetching data... (First time may take several minutes)"):
-                    st.session_state.isActive = True
-
-                    df_total_count, df_session_dur, df_event_count_by_device = run_funcs_async(st.session_state.fetcher.get_total_event_started,
-                                                                                                st.session_state.fetcher.get_generic_session_durations,
-                                                                                                st.session_state.fetcher.get_event_count_by_device_token)
-                    
-                    if isinstance(df_total_count, Exception) or isinstance(df_session_dur, Exception) or isinstance(df_event_count_by_device, Exception):
-                        print(f"Dataframe exception:: df_total_count: {df_total_count}, df_session_dur: {df_session_dur},  df_event_count_by_device: {df_event_count_by_device}")
-                        st.error("Failed to fetch data. Probably because connection timed out. Enter Credentials again")
-                        st.session_state.fetcher.con.close()
-                        st.session_state.fetcher = None
-                        st.cache_resource.clear()
-                        st.session_state.isActive = False
-                        raise InterruptResource()
-
-
-
                 with col_l: # Left column with total data
                     with st.container(key="col_container", border=True):
-                        if df_total_count is not None and isinstance(df_total_count, pd.DataFrame): # Total event count dataframe
-                            fig = px.bar(
-                                df_total_count, 
-                                x='EVENT_NAME', 
-                                y='EVENT_COUNT', 
-                                title="Total Event Counts for 'The Experience'", 
-                                labels={'EVENT_NAME': 'Event Name', 'EVENT_COUNT': 'Event Count'}, 
-                                text='EVENT_COUNT'  # Show count values on the bars
-                                )
-
-                            fig.update_layout(
-                                xaxis_title="Event Name",
-                                yaxis_title="Count",
-                                template=plotly_template
-                            )
-                            st.plotly_chart(fig)
-
-
-                        if df_session_dur is not None and isinstance(df_session_dur, pd.DataFrame): # Session duration dataframe. used for next 2 charts
-
-                            df_daily_avg = (
-                                df_session_dur.groupby('SESSION_DATE')['SESSION_DURATION']
-                                .mean()
-                                .reset_index()
-                                .rename(columns={'SESSION_DURATION': 'AVG_SESSION_DURATION'})
-                            )
-
-                            fig_avg_daily = px.line( # Average duration line chart
-                            df_daily_avg,
-                            x='SESSION_DATE',
-                            y='AVG_SESSION_DURATION',
-                            title='Average Session Duration Per Day (Last Month)',
-                            labels={'SESSION_DATE': 'Date', 'AVG_SESSION_DURATION': 'Average Duration (minutes)'},
-                            markers=True
-                            )
-                            fig_avg_daily.update_layout(template='plotly_white')
-                            st.plotly_chart(fig_avg_daily)
-
-                            metrics = {
-                                'Shortest': df_session_dur['SESSION_DURATION'].min(),
-                                'Longest': df_session_dur['SESSION_DURATION'].max(),
-                                'Average': df_session_dur['SESSION_DURATION'].mean()
-                            }
-                            df_metrics = pd.DataFrame(
-                                metrics.items(),
-                                columns=['DURATION_METRIC', 'DURATION_MINUTES']
-                            )
-
-                            fig_metrics = px.bar( # aggregated metrics bar chart
-                            df_metrics,
-                            x='DURATION_MINUTES',
-                            y='DURATION_METRIC',
-                            text='DURATION_MINUTES',
-                            orientation='h',  # Horizontal orientation
-                            title='Session Duration Metrics (Last Month)',
-                            labels={'DURATION_METRIC': 'Duration Metric', 'DURATION_MINUTES': 'Minutes'},
-                            color='DURATION_METRIC',
-                            color_discrete_sequence=px.colors.qualitative.Set2
-                            )
-                            fig_metrics.update_traces(texttemplate='%{text:.2f}', textposition='outside')
-                            fig_metrics.update_layout(
-                                xaxis_title='Minutes',
-                                yaxis_title='Duration Metric',
-                                template=plotly_template,
-                                showlegend=False
-                            )
-
-                            st.plotly_chart(fig_metrics)
-
-
+                        total_view = st.radio("View", ["Last month", "Custom date range", "Compare environments"],
+                                              horizontal=True, label_visibility="collapsed", key="total_view")
+                        if total_view == "Compare environments": # switching or overlaying reuses the cached results
+                            compared_envs = st.multiselect("Environments", environments, default=[env], key="compared_envs")
+                            shown_env = st.radio("Show", ["Overlay", *compared_envs], horizontal=True, key="shown_env")
+                        total_slot = st.empty()
+                        session_slot = st.empty()
+                        funnel_slot = st.empty()
                 with col_r: # Right column for data by device
                     with st.container(key="col_container2", border=True):
-
-                        if df_event_count_by_device is not None and isinstance(df_event_count_by_device, pd.DataFrame): # event count by device dataframe
-                            st.write("Device Event Table. Select row for visualization and more data")     
-                            grid_options = GridOptionsBuilder.from_dataframe(df_event_count_by_device)
-                            grid_options.configure_default_column(resizable=True, flex=1)
-                            grid_options.configure_selection('single')
-                            grid_options = grid_options.build()
-
-                            response = AgGrid( # Interactive table
-                                df_event_count_by_device,
-                                gridOptions=grid_options,
-                                allow_unsafe_jscode=True,
-                                update_mode='MODEL_CHANGED',
-                                fit_columns_on_grid_load=True
-                            )
-
-                            if response:
-                                selected_row = response['selected_rows']
-
-                            if selected_row is not None:
-                                st.session_state.selected_row = selected_row.index[0]
-                                print(f"session row update: {selected_row.index[0]}")
-
-                            if st.session_state.selected_row is not None: # show extra device viz when row is selected
-                                row = df_event_count_by_device.iloc[[st.session_state.selected_row]]
-                                event_data = {
-                                    'EVENT_NAME': list(df_event_count_by_device.columns[1:-1]),
-                                    'EVENT_COUNT': [row.get(col) for col in df_event_count_by_device.columns[1:-1]]
-                                }
-                                event_df = pd.DataFrame(event_data)
-                                event_df["EVENT_COUNT"] = event_df["EVENT_COUNT"].astype(int)
-                                fig_title = row.get('DEVICE_NAME').to_string()
-                                fig = px.bar(
-                                    event_df,
-                                    x='EVENT_NAME',
-                                    y='EVENT_COUNT',
-                                    title=f"Event Data for Device: {fig_title}",
-                                    labels={'EVENT_NAME': 'Event Name', 'EVENT_COUNT': 'Event Count'},
-                                    color='EVENT_NAME',
-                                    color_discrete_sequence=px.colors.qualitative.Set2
-                                )
-                                fig.update_layout(
-                                    xaxis_title="Event Names", yaxis_title="Event Counts",
-                                    template=plotly_template
-                                )
-                                
-                                st.plotly_chart(fig)
-
-                                if (st.button("Fetch more", type="primary")): # fetch extra device data from db when pressed
-                                    with st.spinner("Fetching device data... May take several minutes first time"):
-                                        st.write("Latest event recordings by device")
-                                        token = str(row.iloc[0]["DEVICE_TOKEN"])
-                                        results = run_funcs_async(
-                                            st.session_state.fetcher.get_latest_event_timestamps_by_devicetoken,
-                                            st.session_state.fetcher.get_session_durations_by_devicetoken,
-                                            arg=token
-                                            )
-
-                                    device_timestamp_df = results[0]
-                                    device_session_dur_df = results[1]
-
-                                    if isinstance(device_timestamp_df, Exception) or isinstance(device_session_dur_df, Exception):
-                                        print(f"Dataframe exception:: device_timestamp_df: {device_timestamp_df}, device_session_dur_df: {device_session_dur_df}")
-                                        st.error("Failed to fetch data. Probably because connection timed out. Enter Credentials again")
-                                        st.session_state.fetcher.con.close()
-                                        st.cache_resource.clear()
-                                        st.session_state.fetcher = None
-                                        st.session_state.isActive = False
-                                        raise InterruptResource()
-
-                                    st.write(device_timestamp_df) # show table
-                            
-                                    df_device_daily_avg = (
-                                        device_session_dur_df.groupby('SESSION_DATE')['SESSION_DURATION']
-                                        .mean()
-                                        .reset_index()
-                                    )
-
-                                    fig_avg_daily = px.line( # show line chart
-                                    df_device_daily_avg,
-                                    x='SESSION_DATE',
-                                    y='SESSION_DURATION',
-                                    title='Session Duration Per Day By Device (Last Month)',
-                                    labels={'SESSION_DATE': 'Date', 'SESSION_DURATION': 'Session Duration (minutes)'},
-                                    markers=True
-                                    )
-                                    fig_avg_daily.update_layout(template='plotly_white')
-                                    st.plotly_chart(fig_avg_daily)
+                        device_slot = st.empty()
+
+                panels = { # each panel renders as soon as its own query is back
+                    "total": (total_slot, st.session_state.fetcher.get_total_event_started, render_total_counts),
+                    "sessions": (session_slot, st.session_state.fetcher.get_session_duration_stats, render_session_durations),
+                    "device": (device_slot, st.session_state.fetcher.get_event_count_by_device_token, render_device_table),
+                }
+                if local_sessions: # from the same locally split sessions as the duration charts
+                    panels["funnel"] = (funnel_slot, st.session_state.fetcher.get_session_funnel, render_session_funnel)
+                if total_view == "Custom date range": # one incremental rollup refresh replaces the total and session queries
+                    del panels["sessions"]
+                    panels.pop("funnel", None)
+                    panels["total"] = (total_slot, st.session_state.fetcher.refresh_rollups, render_date_range)
+                elif total_view == "Compare environments": # one scan per query for every compared environment
+                    del panels["total"], panels["sessions"]
+                    panels.pop("funnel", None)
+                    if compared_envs:
+                        panels["total"] = (total_slot, partial(st.session_state.fetcher.get_total_event_started_by_env, compared_envs),
+                                           partial(render_env_total_counts, shown_env=shown_env))
+                        panels["sessions"] = (session_slot, partial(st.session_state.fetcher.get_session_duration_stats_by_env, compared_envs),
+                                              partial(render_env_session_durations, shown_env=shown_env))
+                    else:
+                        total_slot.info("Pick at least one environment")
+                for slot, _, _ in panels.values():
+                    slot.info("Fetching data... (First time may take several minutes)")
+
+                # Queries of the first page are submitted asynchronously, a panel takes a worker only once they are back.
+                # A rerun cancels what the previous run still has running and this one no longer needs
+                scheduler = get_query_scheduler()
+                page_group = session_query_group(f"page:{uuid.uuid4().hex[:8]}")
+                future_to_panel = {
+                    scheduler.submit_after(
+                        [st.session_state.fetcher.load_page_async(getattr(fetch, "__name__", None), page_group)],
+                        fetch, group=session_query_group()
+                    ): name
+                    for name, (_, fetch, _) in panels.items()
+                }
+                previous_page_group = st.session_state.get("page_query_group")
+                st.session_state.page_query_group = page_group
+                if previous_page_group is not None:
+                    scheduler.cancel_group(previous_page_group)
+                for future in as_completed(future_to_panel):
+                    name = future_to_panel[future]
+                    slot, _, render = panels[name]
+                    try:
+                        df = future.result()
+                    except Exception as e:
+                        print(f"Dataframe exception:: {name}: {e}")
+                        slot.error("Failed to fetch data. Try again, or enter credentials again if it keeps failing")
+                        continue
+
+                    with slot.container():
+                        render(df)
+
+                if prefetch_device_details: # after every panel is drawn, so no panel waits for it
+                    start_device_prefetch()
+
+        if show_diagnostics:
+            with col_diag:
+                render_diagnostics()
 
     with st.container(key="footer"): # Footer container
         f_col_1, f_col_2 = st.columns(2, vertical_alignment="center")
@@ -287,7 +169,7 @@ def main():
                 """
                 <img class="logo" src="data:image/png;base64,{}" width="100">
                 """.format(
-                    base64.b64encode(open("images/CB_Logo_White.png", "rb").read()).decode()
+                    image_base64("images/CB_Logo_White.png")
                 )
                 +
                 """
@@ -295,7 +177,7 @@ def main():
                     <img src="data:image/png;base64,{}" width="132">
                 </a>
                 """.format(
-                    base64.b64encode(open("images/virsabi_logo_green_AW-01_neg.png", "rb").read()).decode()
+                    image_base64("images/virsabi_logo_green_AW-01_neg.png")
                 )
             )
 
@@ -305,11 +187,523 @@ def main():
             st.write("Version 0.5 [BETA]")
 
 
+@st.fragment
+def render_header(): # typing credentials only reruns the header, a login or cache clear reruns the whole page
+    error = []
+
+    st.html(
+        """
+        <img id="expimg" src="data:image/png;base64,{}">
+        <h2 id="title1" >Analytics</h2>
+        """.format(
+            image_base64("images/Purple_CBE.png")
+        )
+    )
+    st.divider()
+
+    user = st.text_input("Username: ", key="user")
+    key = st.text_input("API Key: ", type="password", key="password")
+    # env = st.text_input("Environment: ", key="env")
+
+    h_col_l, h_col_r = st.columns(2, vertical_alignment="center")
+    with h_col_l:
+        if st.button("Fetch", type="primary", use_container_width=True):
+            if not validate_input_string(env):
+                error.append("Environments can only be a-Z characters")
+            else:
+                try:
+                    backend = get_backend(user, key)
+                    fetcher = data_fetcher.Data_fetcher(backend, env, cache=get_result_cache(), query_log=get_query_log(),
+                                                        incremental=incremental_refresh,
+                                                        session_gap=session_gap if local_sessions else None,
+                                                        rollups=get_rollup_store(env), partials=get_incremental_partials(env))
+                    st.session_state.clear_cache = False
+                    st.session_state.fetcher = fetcher
+                    if background_refresh_interval > 0 and data_source != "parquet": # the snapshot's job runs without a login
+                        # the latest login of an environment keeps its results warm until its browser session ends
+                        get_refresher().register(env, fetcher.warm, alive=partial(query_group_is_alive, session_query_group()))
+                    st.session_state.isActive = True
+                except Exception as e:
+                    print(f"Login error: {e}")
+                    error.append("Credential Error!")
+                else:
+                    st.rerun()
+    with h_col_r:
+        cc_clicked = st.button("Clear Cache", type="primary", use_container_width=True)
+        if "fetcher" in st.session_state and cc_clicked:
+            st.session_state.isActive = False
+            st.session_state.clear_cache = True
+            if st.session_state.fetcher is not None: # only this environment's results, other users keep theirs
+                st.session_state.fetcher.clear_cache()
+            else:
+                get_result_cache().invalidate(env=env)
+            st.rerun()
+
+    if len(error) > 0 and st.session_state.isActive: # hide the data below, the errors are shown after the full rerun
+        st.session_state.isActive = False
+        st.session_state.header_errors = error
+        st.rerun()
+
+    for e in error + st.session_state.pop("header_errors", []):
+        st.error(e)
+
+@st.fragment
+def render_total_counts(df_total_count: pd.DataFrame):
+    st.plotly_chart(total_counts_figure(df_total_count, frame_fingerprint(df_total_count)))
+
+@st.cache_resource(max_entries=32, show_spinner=False)
+def total_counts_figure(_df_total_count: pd.DataFrame, fingerprint: str): # memoized by the data's fingerprint
+    fig = px.bar(
+        _df_total_count,
+        x='EVENT_NAME', 
+        y='EVENT_COUNT', 
+        title="Total Event Counts for 'The Experience'", 
+        labels={'EVENT_NAME': 'Event Name', 'EVENT_COUNT': 'Event Count'}, 
+        text='EVENT_COUNT'  # Show count values on the bars
+        )
+
+    fig.update_layout(
+        xaxis_title="Event Name",
+        yaxis_title="Count",
+        template=plotly_template
+    )
+    return fig
+
+def render_session_funnel(df_funnel: pd.DataFrame):
+    if len(df_funnel) == 0 or df_funnel["SESSIONS"].iloc[0] == 0:
+        st.write("No sessions in the last month")
+        return
+    st.plotly_chart(session_funnel_figure(df_funnel, frame_fingerprint(df_funnel)))
+
+@st.cache_resource(max_entries=32, show_spinner=False)
+def session_funnel_figure(_df_funnel: pd.DataFrame, fingerprint: str): # sessions reaching each started event in turn
+    fig = px.funnel(
+        _df_funnel,
+        x='SESSIONS',
+        y='EVENT_NAME',
+        title='Session Funnel (Last Month)',
+        labels={'EVENT_NAME': 'Event Name', 'SESSIONS': 'Sessions'}
+        )
+    fig.update_traces(textinfo="value+percent initial")
+    fig.update_layout(template=plotly_template)
+    return fig
+
+def render_env_total_counts(df_total_count: pd.DataFrame, shown_env: str): # "Overlay" or one of the compared environments
+    if shown_env != "Overlay":
+        df_total_count = df_total_count[df_total_count["ENVIRONMENT_NAME"] == shown_env].drop(columns="ENVIRONMENT_NAME")
+        st.plotly_chart(total_counts_figure(df_total_count, frame_fingerprint(df_total_count)))
+        return
+    st.plotly_chart(env_total_counts_figure(df_total_count, frame_fingerprint(df_total_count)))
+
+@st.cache_resource(max_entries=32, show_spinner=False)
+def env_total_counts_figure(_df_total_count: pd.DataFrame, fingerprint: str): # grouped bars, one color per environment
+    fig = px.bar(
+        _df_total_count,
+        x='EVENT_NAME',
+        y='EVENT_COUNT',
+        color='ENVIRONMENT_NAME',
+        barmode='group',
+        title="Total Event Counts for 'The Experience' by Environment",
+        labels={'EVENT_NAME': 'Event Name', 'EVENT_COUNT': 'Event Count', 'ENVIRONMENT_NAME': 'Environment'},
+        text='EVENT_COUNT'
+        )
+
+    fig.update_layout(
+        xaxis_title="Event Name",
+        yaxis_title="Count",
+        template=plotly_template
+    )
+    return fig
+
+def render_env_session_durations(df_session_stats: pd.DataFrame, shown_env: str):
+    if shown_env != "Overlay":
+        df_session_stats = df_session_stats[df_session_stats["ENVIRONMENT_NAME"] == shown_env].drop(columns="ENVIRONMENT_NAME")
+    df_daily_avg, summary = data_fetcher.split_duration_stats(df_session_stats)
+    if summary is None:
+        st.write("No sessions in the last month")
+        return
+
+    title_env = "by Environment" if shown_env == "Overlay" else f"in {shown_env}"
+    color = "ENVIRONMENT_NAME" if shown_env == "Overlay" else None
+    st.plotly_chart(duration_series_figure(df_daily_avg, frame_fingerprint(df_daily_avg), "SESSION_DATE",
+                                           f"Average Session Duration Per Day {title_env} (Last Month)", "Average Duration (minutes)", color))
+    if shown_env != "Overlay":
+        st.plotly_chart(session_metrics_figure(df_session_stats, frame_fingerprint(df_session_stats),
+                                               f"Session Duration Metrics {title_env} (Last Month)"))
+        return
+    st.plotly_chart(env_session_metrics_figure(df_session_stats, frame_fingerprint(df_session_stats)))
+
+@st.cache_resource(max_entries=32, show_spinner=False)
+def env_session_metrics_figure(_df_session_stats: pd.DataFrame, fingerprint: str): # summary metrics side by side per environment
+    summaries = _df_session_stats[_df_session_stats["IS_SUMMARY"].astype(bool)]
+    df_metrics = pd.DataFrame(
+        [(summary['ENVIRONMENT_NAME'], metric, minutes)
+         for _, summary in summaries.iterrows() for metric, minutes in duration_metrics(summary).items()],
+        columns=['ENVIRONMENT_NAME', 'DURATION_METRIC', 'DURATION_MINUTES']
+    )
+
+    fig_metrics = px.bar(
+    df_metrics,
+    x='DURATION_MINUTES',
+    y='DURATION_METRIC',
+    text='DURATION_MINUTES',
+    orientation='h',
+    barmode='group',
+    title='Session Duration Metrics by Environment (Last Month)',
+    labels={'DURATION_METRIC': 'Duration Metric', 'DURATION_MINUTES': 'Minutes', 'ENVIRONMENT_NAME': 'Environment'},
+    color='ENVIRONMENT_NAME',
+    color_discrete_sequence=px.colors.qualitative.Set2
+    )
+    fig_metrics.update_traces(texttemplate='%{text:.2f}', textposition='outside')
+    fig_metrics.update_layout(
+        xaxis_title='Minutes',
+        yaxis_title='Duration Metric',
+        template=plotly_template
+    )
+
+    return fig_metrics
+
+@st.fragment
+def render_session_durations(df_session_stats: pd.DataFrame): # Daily session duration statistics plus summary row. used for next 2 charts
+    df_daily_avg, summary = data_fetcher.split_duration_stats(df_session_stats)
+    if summary is None:
+        st.write("No sessions in the last month")
+        return
+
+    render_duration_series(df_daily_avg, "Average Session Duration Per {grain} (Last Month)", "Average Duration (minutes)", "sessions_zoom")
+    st.plotly_chart(session_metrics_figure(df_session_stats, frame_fingerprint(df_session_stats)))
+    render_export("Export all sessions", "export_session_durations", "session_durations", "sessions_export")
+
+def duration_metrics(summary: pd.Series) -> dict: # bars of the session metrics charts, from a summary row
+    return {
+        'Shortest': summary['MIN_DURATION'],
+        'Longest': summary['MAX_DURATION'],
+        'Average': summary['AVG_DURATION'],
+        'Median': summary['P50_DURATION'],
+        '90th percentile': summary['P90_DURATION']
+    }
+
+@st.cache_resource(max_entries=32, show_spinner=False)
+def session_metrics_figure(_df_session_stats: pd.DataFrame, fingerprint: str, title: str = 'Session Duration Metrics (Last Month)'):
+    _, summary = data_fetcher.split_duration_stats(_df_session_stats)
+
+    df_metrics = pd.DataFrame(
+        duration_metrics(summary).items(),
+        columns=['DURATION_METRIC', 'DURATION_MINUTES']
+    )
+
+    fig_metrics = px.bar( # aggregated metrics bar chart
+    df_metrics,
+    x='DURATION_MINUTES',
+    y='DURATION_METRIC',
+    text='DURATION_MINUTES',
+    orientation='h',  # Horizontal orientation
+    title=title,
+    labels={'DURATION_METRIC': 'Duration Metric', 'DURATION_MINUTES': 'Minutes'},
+    color='DURATION_METRIC',
+    color_discrete_sequence=px.colors.qualitative.Set2
+    )
+    fig_metrics.update_traces(texttemplate='%{text:.2f}', textposition='outside')
+    fig_metrics.update_layout(
+        xaxis_title='Minutes',
+        yaxis_title='Duration Metric',
+        template=plotly_template,
+        showlegend=False
+    )
+
+    return fig_metrics
+
+@st.fragment
+def render_date_range(span: tuple): # totals and session durations for any range and granularity, merged from the rollups
+    first, last = span
+    if first is None:
+        st.write("No events recorded yet")
+        return
+
+    r_col_range, r_col_grain = st.columns([3, 2], vertical_alignment="bottom")
+    with r_col_range:
+        default_start = max(first.date(), (last - pd.DateOffset(months=1)).date())
+        picked = st.date_input("Date range", value=(default_start, last.date()), min_value=first.date(),
+                               max_value=last.date(), key="rollup_range")
+    with r_col_grain:
+        granularity = st.radio("Granularity", rollups.GRANULARITIES, index=1, horizontal=True,
+                               format_func=str.capitalize, key="rollup_granularity")
+    if len(picked) < 2:
+        st.info("Pick an end date")
+        return
+
+    since, until = pd.Timestamp(picked[0]), pd.Timestamp(picked[1]) + pd.Timedelta(days=1)
+    try:
+        df_total_count = st.session_state.fetcher.get_total_event_started_between(since, until)
+        df_session_stats = st.session_state.fetcher.get_session_duration_stats_between(since, until, granularity)
+    except Exception as e:
+        print(f"Dataframe exception:: date range: {e}")
+        st.error("Failed to fetch data. Try again, or enter credentials again if it keeps failing")
+        return
+
+    st.plotly_chart(total_counts_figure(df_total_count, frame_fingerprint(df_total_count)))
+
+    df_period_avg, summary = data_fetcher.split_duration_stats(df_session_stats)
+    if summary is None:
+        st.write("No sessions in this date range")
+        return
+
+    period = f"{picked[0]:%d %b %Y} - {picked[1]:%d %b %Y}"
+    st.plotly_chart(duration_series_figure(df_period_avg, frame_fingerprint(df_period_avg), "SESSION_DATE",
+                                           f"Average Session Duration Per {granularity.capitalize()} ({period})", "Average Duration (minutes)"))
+    st.plotly_chart(session_metrics_figure(df_session_stats, frame_fingerprint(df_session_stats), f"Session Duration Metrics ({period})"))
+
+def render_duration_series(df_daily_avg: pd.DataFrame, title: str, y_label: str, key: str, device_token: str = None):
+    # Daily averages over the whole range. Zooming in to a short range re-fetches it per hour
+    first, last = df_daily_avg["SESSION_DATE"].min(), df_daily_avg["SESSION_DATE"].max()
+    series, x, grain = df_daily_avg, "SESSION_DATE", "Day"
+
+    if last > first:
+        start, end = st.slider("Zoom", min_value=first.date(), max_value=last.date(), value=(first.date(), last.date()),
+                               key=f"{key}:{first.date()}:{last.date()}")
+        since, until = pd.Timestamp(start), pd.Timestamp(end) + pd.Timedelta(days=1)
+        if since > first or until <= last:
+            series = df_daily_avg[(df_daily_avg["SESSION_DATE"] >= since) & (df_daily_avg["SESSION_DATE"] < until)]
+            if until - since <= data_fetcher.SERIES_HOURLY_SPAN:
+                try:
+                    series = st.session_state.fetcher.get_session_duration_series(since, until, device_token)
+                    x, grain = "SESSION_BUCKET", "Hour"
+                except Exception as e:
+                    print(f"Dataframe exception:: duration series: {e}")
+                    st.warning("Hourly detail is not available right now, showing daily averages")
+
+    st.plotly_chart(duration_series_figure(series, frame_fingerprint(series), x, title.format(grain=grain), y_label))
+
+@st.cache_resource(max_entries=64, show_spinner=False)
+def duration_series_figure(_series: pd.DataFrame, fingerprint: str, x: str, title: str, y_label: str, color: str = None):
+    # downsampled to a fixed point budget, WebGL for dense series, so long ranges cost the browser the same
+    fig = charts.time_series_figure(
+        _series,
+        x=x,
+        y='AVG_DURATION',
+        color=color,
+        title=title,
+        labels={x: 'Date', 'AVG_DURATION': y_label, 'ENVIRONMENT_NAME': 'Environment'},
+        markers=True
+    )
+    fig.update_layout(template='plotly_white')
+    return fig
+
+@st.fragment
+def render_device_table(df_event_count_by_device: pd.DataFrame): # event count by device dataframe, selection only reruns this tab
+    grid = get_device_grid(df_event_count_by_device)
+    st.write("Device Event Table. Select row for visualization and more data")
+
+    g_col_search, g_col_filter, g_col_sort, g_col_order = st.columns([3, 2, 2, 1], vertical_alignment="bottom")
+    with g_col_search:
+        search = st.text_input("Search device name or token", key="device_search")
+    with g_col_filter:
+        filter_event = st.selectbox("Only devices with", [None] + grid.event_columns, key="device_filter",
+                                    format_func=lambda column: "Any event" if column is None else column)
+    with g_col_sort:
+        sort_by = st.selectbox("Sort by", list(grid.frame.columns), key="device_sort")
+    with g_col_order:
+        ascending = st.toggle("Ascending", value=True, key="device_ascending")
+
+    # only the visible page goes to the browser, the full table stays in the server side grid
+    grid_page = grid.page(st.session_state.get("device_page", 1) - 1, device_grid_page_size, search, sort_by, ascending, filter_event)
+    st.session_state.device_page = grid_page.page + 1 # clamped when a search leaves fewer pages
+
+    grid_options = GridOptionsBuilder.from_dataframe(grid_page.rows)
+    grid_options.configure_default_column(resizable=True, flex=1, sortable=False)
+    grid_options.configure_selection('single')
+    grid_options = grid_options.build()
+
+    response = AgGrid( # Interactive table
+        grid_page.rows,
+        gridOptions=grid_options,
+        allow_unsafe_jscode=True,
+        update_on=['selectionChanged'], # reruns on row selection only
+        fit_columns_on_grid_load=True
+    )
+    st.number_input(f"Page (of {grid_page.page_count}, {grid_page.total_rows} devices)", min_value=1,
+                    max_value=grid_page.page_count, step=1, key="device_page")
+    render_export("Export device event counts", "started_event_counts", "device_event_counts", "device_export")
+
+    selected_rows = response['selected_rows'] if response else None
+    if selected_rows is not None and len(selected_rows) > 0: # rows are identified by token, not page position
+        st.session_state.selected_device_token = str(selected_rows.iloc[0]["DEVICE_TOKEN"])
+        print(f"session device update: {st.session_state.selected_device_token}")
+
+    token = st.session_state.selected_device_token
+    row = grid.row(token) if token is not None else None
+    if row is not None: # show extra device viz when row is selected
+        event_data = {
+            'EVENT_NAME': grid.event_columns,
+            'EVENT_COUNT': [row[col] for col in grid.event_columns]
+        }
+        event_df = pd.DataFrame(event_data)
+        event_df["EVENT_COUNT"] = event_df["EVENT_COUNT"].astype(int)
+        st.plotly_chart(device_events_figure(event_df, frame_fingerprint(event_df), row['DEVICE_NAME']))
+
+        render_device_drilldown(token)
+
+def start_device_prefetch(): # one grouped query for every device's drill-down, in the background
+    fetcher = st.session_state.fetcher
+    running_for, running = st.session_state.get("device_prefetch", (None, None))
+    if fetcher.device_index_is_fresh() or (running_for is fetcher and not running.done()):
+        return
+    future = get_query_scheduler().submit(fetcher.prefetch_device_details, group=session_query_group())
+    future.add_done_callback(report_prefetch_error)
+    st.session_state.device_prefetch = (fetcher, future)
+
+def report_prefetch_error(future):
+    if not future.cancelled() and future.exception() is not None: # "Fetch more" falls back to single device queries
+        print(f"Device prefetch error: {future.exception()}")
+
+@st.cache_resource(max_entries=64, show_spinner=False)
+def device_events_figure(_event_df: pd.DataFrame, fingerprint: str, device_name: str):
+    fig = px.bar(
+        _event_df,
+        x='EVENT_NAME',
+        y='EVENT_COUNT',
+        title=f"Event Data for Device: {device_name}",
+        labels={'EVENT_NAME': 'Event Name', 'EVENT_COUNT': 'Event Count'},
+        color='EVENT_NAME',
+        color_discrete_sequence=px.colors.qualitative.Set2
+    )
+    fig.update_layout(
+        xaxis_title="Event Names", yaxis_title="Event Counts",
+        template=plotly_template
+    )
+    return fig
+
+@st.fragment
+def render_device_drilldown(token: str): # "Fetch more" only reruns the drill-down, not the grid above it
+    if (st.button("Fetch more", type="primary")): # fetch extra device data from db when pressed
+        st.session_state.device_details_token = token
+    if st.session_state.get("device_details_token") == token: # stays open while zooming its chart
+        render_device_details(token)
+
+def render_device_details(token: str):
+    with st.spinner("Fetching device data... May take several minutes first time"):
+        st.write("Latest event recordings by device")
+        device_group = session_query_group(f"device:{token}")
+        previous_group = st.session_state.get("device_query_group")
+        if previous_group is not None and previous_group != device_group: # drop the drill-down of the previously selected device
+            get_query_scheduler().cancel_group(previous_group)
+        st.session_state.device_query_group = device_group
+
+        results = get_query_scheduler().run_all(
+            st.session_state.fetcher.get_latest_event_timestamps_by_devicetoken,
+            st.session_state.fetcher.get_session_duration_stats_by_devicetoken,
+            arg=token,
+            group=device_group
+            )
+
+    device_timestamp_df = results[0]
+    device_session_stats_df = results[1]
+
+    if isinstance(device_timestamp_df, Exception):
+        print(f"Dataframe exception:: device_timestamp_df: {device_timestamp_df}")
+        st.error("Failed to fetch latest events. Try again, or enter credentials again if it keeps failing")
+    else:
+        st.write(device_timestamp_df) # show table
+
+    if isinstance(device_session_stats_df, Exception):
+        print(f"Dataframe exception:: device_session_stats_df: {device_session_stats_df}")
+        st.error("Failed to fetch session durations. Try again, or enter credentials again if it keeps failing")
+        return
+
+    df_device_daily_avg, _ = data_fetcher.split_duration_stats(device_session_stats_df)
+    if len(df_device_daily_avg) == 0:
+        st.write("No sessions in the last month")
+        return
+    render_duration_series(df_device_daily_avg, "Session Duration Per {grain} By Device (Last Month)", "Session Duration (minutes)",
+                           f"device_zoom:{token}", device_token=token)
+
+def render_export(label: str, statement_name: str, file_stem: str, key: str): # full history download, written only when clicked
+    fetcher = st.session_state.fetcher
+    e_col_format, e_col_button = st.columns([1, 3], vertical_alignment="bottom")
+    with e_col_format:
+        fmt = st.selectbox("Format", list(exports.EXPORT_FORMATS), key=f"{key}_format", format_func=str.upper)
+    with e_col_button:
+        mime, suffix = exports.EXPORT_FORMATS[fmt]
+        st.download_button(label, partial(export_file, fetcher, statement_name, fmt), file_name=f"{file_stem}_{fetcher.env}{suffix}",
+                           mime=mime, on_click="ignore", key=key)
+
+def export_file(fetcher: data_fetcher.Data_fetcher, statement_name: str, fmt: str):
+    # runs when the download is clicked. The result is streamed batch by batch into a temporary file, so the
+    # query never holds it as a frame, and the finished file is read into memory once to hand it to Streamlit
+    sink = tempfile.TemporaryFile()
+    try:
+        fetcher.export_data(statement_name, sink, fmt)
+        sink.seek(0)
+        return sink.read()
+    finally:
+        sink.close()
+
+def render_diagnostics(): # query latencies, cache counters and the raw query log
+    query_log = get_query_log()
+    last_n = st.number_input("Last N queries", min_value=10, max_value=2000, value=200, step=10)
+
+    st.write("Latency per method")
+    st.dataframe(query_log.latency_summary(last=int(last_n)), hide_index=True)
+
+    st.write("Result cache")
+    st.dataframe(pd.DataFrame([get_result_cache().stats()]), hide_index=True)
+
+    st.write("Background refresh")
+    st.dataframe(pd.DataFrame(get_refresher().status()), hide_index=True)
+
+    st.write("Recent queries")
+    st.dataframe(query_log.to_frame(last=int(last_n)).iloc[::-1], hide_index=True)
+    st.download_button("Export query log (JSON lines)", query_log.to_jsonl(), file_name="query_log.jsonl", mime="application/x-ndjson")
+
 def load_css(file_path):
-    with open(file_path) as f:
-        st.html(f"<style>{f.read()}</style>")
+    st.html(f"<style>{read_text(file_path)}</style>")
+
+@st.cache_resource
+def read_text(file_path: str) -> str: # static assets are read once per process
+    return pathlib.Path(file_path).read_text()
 
 @st.cache_resource
+def image_base64(file_path: str) -> str:
+    return base64.b64encode(pathlib.Path(file_path).read_bytes()).decode()
+
+def get_device_grid(df_event_count_by_device: pd.DataFrame) -> DeviceGrid: # rebuilt only when the device table's content changes
+    # keyed by content, get_event_count_by_device_token builds a new frame from the cached counts on every rerun
+    fingerprint = frame_fingerprint(df_event_count_by_device)
+    grid = st.session_state.get("device_grid")
+    if grid is None or st.session_state.get("device_grid_fingerprint") != fingerprint:
+        grid = DeviceGrid(df_event_count_by_device)
+        st.session_state.device_grid = grid
+        st.session_state.device_grid_fingerprint = fingerprint
+    return grid
+
+@st.cache_resource
+def get_query_log(): # rolling record of every fetch in this process
+    return QueryLog()
+
+@st.cache_resource
+def get_result_cache(): # one query result cache shared by every session in this process, backed by shared_cache_dir
+    shared = SharedResultStore(shared_cache_dir) if shared_cache_dir else None
+    return ResultCache(ttls=data_fetcher.QUERY_TTLS, shared=shared)
+
+@st.cache_resource
+def get_rollup_store(env: str): # one set of date range rollups per environment, refreshed by whichever session needs it first
+    return rollups.RollupStore(data_fetcher.TRAILING_WINDOW, min_refresh_interval=data_fetcher.MIN_REFRESH_INTERVAL)
+
+@st.cache_resource
+def get_incremental_partials(env: str): # per environment like the rollups, so a new login refreshes from the shared watermark
+    return data_fetcher.IncrementalPartials.create()
+
+@st.cache_resource
+def get_refresher(): # one refresher thread per process, re-runs each environment's first page queries into the shared cache
+    refresher = BackgroundRefresher(interval=background_refresh_interval)
+    if data_source == "parquet" and background_refresh_interval > 0: # no credentials needed, warm up before the first login
+        fetcher = data_fetcher.Data_fetcher(get_parquet_backend(snapshot_path), env, cache=get_result_cache(),
+                                            query_log=get_query_log(), incremental=incremental_refresh,
+                                            session_gap=session_gap if local_sessions else None,
+                                            rollups=get_rollup_store(env), partials=get_incremental_partials(env))
+        refresher.register(env, fetcher.warm)
+    return refresher
+
 def get_snowflake_connection(i_user: str, key: str):
     try:
         conn = con.connect(
@@ -322,23 +716,33 @@ def get_snowflake_connection(i_user: str, key: str):
     except:
         raise
 
-def run_funcs_async(*functions, arg=None): # run several queries at once with optional argument
-    results = [None] * len(functions)
-    with ThreadPoolExecutor() as executor:
+@st.cache_resource
+def get_connection_pool(i_user: str, key: str): # one pool per set of credentials, expired sessions reconnect inside the pool
+    return ConnectionPool(lambda: get_snowflake_connection(i_user, key), max_size=pool_size)
 
-        if arg is None:
-            future_to_index = {executor.submit(func): i for i, func in enumerate(functions)}
-        else:
-            future_to_index = {executor.submit(func, arg): i for i, func in enumerate(functions)}
-            
-        for future in as_completed(future_to_index):
-            index = future_to_index[future]
-            try:
-                results[index] = future.result()
-            except Exception as e:
-                results[index] = e
-
-        return results
+@st.cache_resource
+def get_parquet_backend(path: str): # one in-process engine over the snapshot, shared by every session
+    return ParquetBackend(path, pool_size=pool_size)
+
+def get_backend(i_user: str, key: str):
+    if data_source == "parquet":
+        return get_parquet_backend(snapshot_path)
+    return SnowflakeBackend(get_connection_pool(i_user, key), scheduler=get_query_scheduler())
+
+@st.cache_resource
+def get_query_scheduler(): # shared by every session, caps concurrent warehouse queries for the whole process
+    return QueryScheduler(max_concurrent_queries=max_concurrent_queries, is_group_alive=query_group_is_alive)
+
+def session_query_group(suffix: str = None) -> str: # scheduler group of this browser session, optionally narrowed
+    ctx = get_script_run_ctx()
+    session_id = ctx.session_id if ctx is not None else "no-session"
+    return session_id if suffix is None else f"{session_id}:{suffix}"
+
+def query_group_is_alive(group: str) -> bool: # queries of closed browser sessions get cancelled
+    if not runtime.exists():
+        return True
+    session_id = group.split(":", 1)[0]
+    return runtime.get_instance().is_active_session(session_id)
 
 
 def validate_input_string(input: str): # only english letters allowed in env for SQL sanitation!
@@ -0,0 +1,180 @@
+import pathlib
+import shutil
+import time
+from concurrent.futures import Future
+from contextlib import nullcontext
+from typing import Callable
+
+import duckdb
+import pandas as pd
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+
+import local_engine
+from connection_pool import ConnectionPool
+from data_fetcher import execute_cursor, execute_query
+from queries import DIALECTS, STATEMENTS, BoundStatement
+
+# Hive style partition columns of a Parquet snapshot, ENVIRONMENT_NAME=testing/EVENT_MONTH=2024-11/part-0.parquet
+SNAPSHOT_PARTITIONING = ["ENVIRONMENT_NAME", "EVENT_MONTH"]
+
+
+class Backend:
+    """Where Data_fetcher's bound statements run.
+
+    A backend owns a ConnectionPool of DB-API style connections and the SQL dialect those connections
+    speak. Statements go through the optional QueryScheduler when one is set.
+    """
+
+    dialect = "snowflake"
+    supports_async = False # whether execute_async can submit statements without a thread waiting for them
+
+    def __init__(self, pool: ConnectionPool, scheduler=None) -> None:
+        self.pool = pool
+        self.scheduler = scheduler # optional QueryScheduler, caps concurrent queries and cancels them by group
+
+    @property
+    def fragments(self) -> dict:
+        return DIALECTS[self.dialect]
+
+    def execute(self, statement: BoundStatement, timings: dict = None, timeout: float = None) -> pd.DataFrame:
+        # timeout: seconds the statement may run, the scheduler's default when None and there is a scheduler
+        requested = time.perf_counter()
+
+        def run(conn):
+            if timings is not None:
+                timings["queue_ms"] = (time.perf_counter() - requested) * 1000
+            if self.scheduler is not None:
+                return self.scheduler.execute(conn, statement.sql, statement.params, timeout=timeout, timings=timings)
+            return execute_query(conn, statement.sql, statement.params, timings, timeout=timeout)
+
+        return self.pool.run(run)
+
+    def execute_async(self, statement: BoundStatement, timings: dict = None, timeout: float = None, group: str = None,
+                      transform: Callable = None) -> Future:
+        # Submits statement through the scheduler and returns a future of its frame, see QueryScheduler.submit_query.
+        # The connection goes back to the pool once the query is submitted. Needs a scheduler and supports_async
+        requested = time.perf_counter()
+
+        def run(conn):
+            if timings is not None:
+                timings["queue_ms"] = (time.perf_counter() - requested) * 1000
+            return self.scheduler.submit_query(conn, statement.sql, statement.params, timeout=timeout, timings=timings,
+                                               group=group, transform=transform)
+
+        return self.pool.run(run)
+
+    def stream(self, statement: BoundStatement, consume: Callable, timeout: float = None):
+        # Executes statement and returns consume(cursor), for results read batch by batch instead of as one frame.
+        # Runs under the scheduler like execute. An expired session is only retried before consume got the
+        # cursor, so whatever consume wrote is never written twice
+        consumed = False
+
+        def run(conn):
+            nonlocal consumed
+            running = self.scheduler.running(conn, timeout) if self.scheduler is not None else nullcontext(timeout)
+            with running as query_timeout:
+                cursor = conn.cursor()
+                try:
+                    execute_cursor(cursor, statement.sql, statement.params, query_timeout)
+                    consumed = True
+                    return consume(cursor)
+                finally:
+                    cursor.close()
+
+        return self.pool.run(run, retry=lambda: not consumed)
+
+    def close(self) -> None:
+        self.pool.close()
+
+
+class SnowflakeBackend(Backend):
+    """The Snowflake warehouse, ACCOUNT_EVENTS with device and session fields inside EVENT_JSON"""
+
+    dialect = "snowflake"
+    supports_async = True
+
+
+class LocalBackend(Backend):
+    """An in-process duckdb database with a flattened ACCOUNT_EVENTS table or view"""
+
+    dialect = "duckdb"
+
+    def __init__(self, database: duckdb.DuckDBPyConnection, pool_size: int = 4, scheduler=None) -> None:
+        self.database = database
+        super().__init__(ConnectionPool(local_engine.connect(database), max_size=pool_size), scheduler)
+
+    def close(self) -> None:
+        super().close()
+        self.database.close()
+
+
+class ParquetBackend(LocalBackend):
+    """Serves the dashboard from a Parquet snapshot of ACCOUNT_EVENTS, no warehouse or network needed.
+
+    Filters on ENVIRONMENT_NAME only read that environment's partition, and event timestamp filters
+    skip row groups by their min/max statistics.
+    """
+
+    def __init__(self, path, pool_size: int = 4, threads: int = None) -> None:
+        self.path = pathlib.Path(path)
+        if not self.path.is_dir():
+            raise FileNotFoundError(f"No Parquet snapshot at {self.path}")
+
+        database = duckdb.connect(":memory:")
+        if threads is not None:
+            database.execute(f"SET threads = {int(threads)}")
+        if any(self.path.rglob("*.parquet")):
+            files = str(self.path / "**" / "*.parquet").replace("'", "''")
+            source = f"SELECT * EXCLUDE (EVENT_MONTH) FROM read_parquet('{files}', hive_partitioning = true)"
+        else: # the snapshot of an empty extract has no files, and read_parquet fails on a glob matching none
+            source = _empty_account_events()
+        database.execute(f"CREATE VIEW ACCOUNT_EVENTS AS {source}")
+        super().__init__(database, pool_size)
+
+
+def _empty_account_events() -> str: # query of an ACCOUNT_EVENTS without rows, typed like a snapshot's columns
+    columns = [
+        f"CAST(NULL AS {'TIMESTAMP' if name == 'EVENT_TIMESTAMP' else 'VARCHAR'}) AS {name}"
+        for name in local_engine.ACCOUNT_EVENTS_COLUMNS
+    ]
+    return f"SELECT {', '.join(columns)} WHERE false"
+
+
+def write_parquet_snapshot(backend: Backend, path, game_name: str = None) -> int:
+    # Extracts ACCOUNT_EVENTS with the JSON fields flattened into a Parquet snapshot for ParquetBackend.
+    # Written next to path first and swapped in by rename, so readers never see a half written snapshot
+    params = {} if game_name is None else {"game_name": game_name}
+    statement = STATEMENTS["account_events_extract"].bind(backend.fragments, **params)
+    path = pathlib.Path(path)
+    staging = path.with_name(path.name + ".tmp")
+    shutil.rmtree(staging, ignore_errors=True)
+
+    rows = 0
+    def extract(conn):
+        nonlocal rows
+        cursor = conn.cursor()
+        try:
+            cursor.execute(statement.sql, statement.params)
+            names = [desc[0] for desc in cursor.description]
+            for i, table in enumerate(cursor.fetch_arrow_batches()):
+                table = table.rename_columns(names)
+                table = table.append_column("EVENT_MONTH", pc.strftime(table["EVENT_TIMESTAMP"], format="%Y-%m"))
+                ds.write_dataset(
+                    table, staging, format="parquet", partitioning=SNAPSHOT_PARTITIONING, partitioning_flavor="hive",
+                    basename_template=f"part-{i}-{{i}}.parquet", existing_data_behavior="overwrite_or_ignore",
+                )
+                rows += table.num_rows
+        finally:
+            cursor.close()
+
+    backend.pool.run(extract)
+    staging.mkdir(parents=True, exist_ok=True) # an empty extract is still a valid snapshot, see ParquetBackend
+
+    previous = path.with_name(path.name + ".old")
+    shutil.rmtree(previous, ignore_errors=True)
+    if path.exists():
+        path.rename(previous)
+    staging.rename(path)
+    shutil.rmtree(previous, ignore_errors=True)
+    return rows
@@ -0,0 +1,188 @@
+"""End to end benchmark of every Data_fetcher method against a local synthetic ACCOUNT_EVENTS warehouse.
+
+Each method runs on a fresh fetcher and cache, so every repeat pays for query, fetch, DataFrame build
+and pandas post-processing. One extra run per method without the result schemas measures how much
+cache memory the compact dtypes save. Results are written to benchmarks/results/ as JSON and can be compared
+with an earlier run to catch regressions.
+
+Usage:
+    python benchmarks/bench_dashboard.py --events 10000 1000000 10000000
+    python benchmarks/bench_dashboard.py --events 1000000 --baseline benchmarks/results/<earlier run>.json
+"""
+import argparse
+import json
+import pathlib
+import platform
+import statistics
+import subprocess
+import sys
+import time
+
+BENCH_DIR = pathlib.Path(__file__).resolve().parent
+sys.path.insert(0, str(BENCH_DIR.parent))
+
+import duckdb
+import pandas as pd
+
+import data_fetcher
+from backends import LocalBackend
+from diagnostics import QueryLog
+from result_cache import ResultCache
+from synthetic_events import SyntheticSpec, load
+
+RESULTS_DIR = BENCH_DIR / "results"
+
+# (label, how to call it on a fetcher). Device methods use the most active device token
+METHODS = [
+    ("get_total_event_started", lambda f, token: f.get_total_event_started()),
+    ("get_event_count_by_device_token", lambda f, token: f.get_event_count_by_device_token()),
+    ("get_generic_session_durations", lambda f, token: f.get_generic_session_durations()),
+    ("get_session_duration_stats", lambda f, token: f.get_session_duration_stats()),
+    ("get_latest_event_timestamps_by_devicetoken", lambda f, token: f.get_latest_event_timestamps_by_devicetoken(token)),
+    ("get_session_durations_by_devicetoken", lambda f, token: f.get_session_durations_by_devicetoken(token)),
+    ("get_session_duration_stats_by_devicetoken", lambda f, token: f.get_session_duration_stats_by_devicetoken(token)),
+    ("prefetch_device_details", lambda f, token: f.prefetch_device_details()),
+]
+
+
+def make_fetcher(database: duckdb.DuckDBPyConnection, env: str, query_log: QueryLog, **options) -> data_fetcher.Data_fetcher:
+    return data_fetcher.Data_fetcher(LocalBackend(database), env, cache=ResultCache(ttls=data_fetcher.QUERY_TTLS),
+                                     query_log=query_log, **options)
+
+
+def bench_scale(spec: SyntheticSpec, env: str, repeat: int) -> dict:
+    start = time.perf_counter()
+    database = load(spec)
+    load_seconds = time.perf_counter() - start
+
+    token = database.execute(
+        "SELECT DEVICE_TOKEN FROM ACCOUNT_EVENTS WHERE ENVIRONMENT_NAME = ? AND DEVICE_TOKEN IS NOT NULL "
+        "GROUP BY DEVICE_TOKEN ORDER BY COUNT(*) DESC LIMIT 1", [env]
+    ).fetchone()[0]
+
+    methods = {}
+    for name, call in METHODS:
+        runs = []
+        for _ in range(repeat):
+            query_log = QueryLog()
+            fetcher = make_fetcher(database, env, query_log)
+
+            start = time.perf_counter()
+            res = call(fetcher, token)
+            total_ms = (time.perf_counter() - start) * 1000
+
+            records = query_log.records()
+            phases = {phase: sum(getattr(r, phase) for r in records) for phase in ("queue_ms", "execute_ms", "fetch_ms", "build_ms")}
+            runs.append({
+                "total_ms": total_ms,
+                **phases,
+                "postprocess_ms": max(total_ms - sum(r.total_ms for r in records), 0.0), # pandas work after the fetch
+                "rows": len(res) if isinstance(res, pd.DataFrame) else sum(len(frame) for frame, _ in fetcher.device_index.values()),
+                "result_bytes": sum(r.result_bytes or 0 for r in records),
+                "queries": len(records),
+            })
+
+        methods[name] = {key: statistics.median(run[key] for run in runs) for key in runs[0]}
+
+        query_log = QueryLog() # same results with the engine's dtypes
+        raw = make_fetcher(database, env, query_log, compact_dtypes=False)
+        call(raw, token)
+        methods[name]["raw_bytes"] = sum(r.result_bytes or 0 for r in query_log.records())
+
+    database.close()
+    return {"spec": spec._asdict(), "load_seconds": load_seconds, "methods": methods}
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=BENCH_DIR, capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return "unknown"
+
+
+def print_scale(result: dict) -> None:
+    spec = result["spec"]
+    print(f"\n{spec['events']:,} events, {spec['devices']} devices, {spec['sessions']:,} sessions (load {result['load_seconds']:.1f}s)")
+    print(f"{'method':<44}{'total ms':>10}{'execute':>10}{'fetch':>8}{'build':>8}{'post':>8}{'rows':>10}{'bytes':>12}")
+    for name, m in result["methods"].items():
+        print(f"{name:<44}{m['total_ms']:>10.1f}{m['execute_ms']:>10.1f}{m['fetch_ms']:>8.1f}{m['build_ms']:>8.1f}"
+              f"{m['postprocess_ms']:>8.1f}{m['rows']:>10,.0f}{m['result_bytes']:>12,.0f}")
+
+    print(f"\n{'cache memory':<44}{'raw bytes':>14}{'compact':>14}{'saved':>8}")
+    for name, m in result["methods"].items():
+        saved = 1 - m['result_bytes'] / m['raw_bytes'] if m['raw_bytes'] else 0.0
+        print(f"{name:<44}{m['raw_bytes']:>14,.0f}{m['result_bytes']:>14,.0f}{saved:>8.0%}")
+    raw_total = sum(m['raw_bytes'] for m in result["methods"].values())
+    compact_total = sum(m['result_bytes'] for m in result["methods"].values())
+    print(f"{'all methods':<44}{raw_total:>14,.0f}{compact_total:>14,.0f}{1 - compact_total / max(raw_total, 1):>8.0%}")
+
+
+def compare(run: dict, baseline: dict, threshold: float) -> list:
+    # methods whose median total time grew by more than threshold (0.2 = 20%) at the same scale
+    regressions = []
+    baseline_scales = {scale["spec"]["events"]: scale for scale in baseline["scales"]}
+    for scale in run["scales"]:
+        before = baseline_scales.get(scale["spec"]["events"])
+        if before is None:
+            continue
+        for name, m in scale["methods"].items():
+            old = before["methods"].get(name)
+            if old is None or old["total_ms"] <= 0:
+                continue
+            ratio = m["total_ms"] / old["total_ms"]
+            print(f"{scale['spec']['events']:>12,} {name:<44}{old['total_ms']:>10.1f} -> {m['total_ms']:>10.1f} ms ({ratio:.2f}x)")
+            if ratio > 1 + threshold:
+                regressions.append((scale["spec"]["events"], name, ratio))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--events", type=int, nargs="+", default=[10_000, 1_000_000, 10_000_000])
+    parser.add_argument("--devices", type=int, default=None, help="default scales with the event count")
+    parser.add_argument("--sessions", type=int, default=None, help="default scales with the event count")
+    parser.add_argument("--env", default="testing")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--baseline", type=pathlib.Path, help="earlier results file to compare against")
+    parser.add_argument("--threshold", type=float, default=0.2, help="allowed slowdown before a run counts as a regression")
+    args = parser.parse_args()
+
+    scales = []
+    for events in args.events:
+        spec = SyntheticSpec(
+            events=events,
+            devices=args.devices or max(20, min(5_000, events // 2_000)),
+            sessions=args.sessions or max(100, events // 50),
+            seed=args.seed,
+        )
+        result = bench_scale(spec, args.env, args.repeat)
+        print_scale(result)
+        scales.append(result)
+
+    run = {
+        "created": pd.Timestamp.now().isoformat(timespec="seconds"),
+        "git_revision": git_revision(),
+        "python": platform.python_version(),
+        "pandas": pd.__version__,
+        "duckdb": duckdb.__version__,
+        "env": args.env,
+        "repeat": args.repeat,
+        "scales": scales,
+    }
+    RESULTS_DIR.mkdir(exist_ok=True)
+    path = RESULTS_DIR / f"dashboard_{pd.Timestamp.now():%Y%m%d_%H%M%S}_{run['git_revision'] or 'nogit'}.json"
+    path.write_text(json.dumps(run, indent=2))
+    print(f"\nResults written to {path}")
+
+    if args.baseline is not None:
+        print(f"\nCompared with {args.baseline}")
+        regressions = compare(run, json.loads(args.baseline.read_text()), args.threshold)
+        if regressions:
+            for events, name, ratio in regressions:
+                print(f"REGRESSION {name} at {events:,} events: {ratio:.2f}x slower")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
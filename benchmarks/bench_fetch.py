@@ -0,0 +1,103 @@
+"""Benchmark of the columnar (arrow) and row-tuple fetch paths in data_fetcher.frame_from_cursor.
+
+Usage: python benchmarks/bench_fetch.py --rows 200000 --batch-size 50000
+"""
+import argparse
+import multiprocessing as mp
+import pathlib
+import resource
+import sys
+import time
+
+import numpy as np
+import pyarrow as pa
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
+
+EVENT_NAMES = ['gameStarted', 'experienceStarted', 'perfectServingStarted', 'breweryIngredientsStarted', 'artOfBrewingStarted']
+
+
+def make_batches(rows: int, batch_size: int) -> list: # device table shaped result, as arrow batches like the connector receives them
+    rng = np.random.default_rng(0)
+    batches = []
+    for start in range(0, rows, batch_size):
+        n = min(batch_size, rows - start)
+        ids = rng.integers(0, max(rows // 5, 1), n)
+        batches.append(pa.table({
+            'EVENT_NAME': pa.array(np.array(EVENT_NAMES)[rng.integers(0, len(EVENT_NAMES), n)]),
+            'DEVICE_NAME': pa.array([f"device-{i}" for i in ids]),
+            'DEVICE_TOKEN': pa.array([f"{i:032x}" for i in ids]),
+            'EVENT_COUNT': pa.array(rng.integers(1, 500, n)),
+        }))
+    return batches
+
+
+class FakeCursor:
+
+    def __init__(self, batches: list) -> None:
+        self._batches = batches
+        self.description = [(name, None, None, None, None, None, None) for name in batches[0].column_names]
+
+    def fetch_arrow_batches(self): # hands each batch over like the connector, keeping no reference to it
+        while self._batches:
+            yield self._batches.pop(0)
+
+
+class FakeRowCursor: # cursor without arrow support, materializes tuples like a DB-API fetchall
+
+    def __init__(self, batches: list) -> None:
+        self._batches = batches
+        self.description = [(name, None, None, None, None, None, None) for name in batches[0].column_names]
+
+    def fetchall(self) -> list:
+        rows = []
+        for batch in self._batches:
+            columns = [column.to_pylist() for column in batch.columns]
+            rows.extend(zip(*columns))
+        return rows
+
+
+def _peak_rss_kb() -> int:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def _run(path: str, rows: int, batch_size: int, queue) -> None: # runs in its own process so peak RSS is per path
+    from data_fetcher import frame_from_cursor
+
+    batches = make_batches(rows, batch_size)
+    cursor = FakeCursor(batches) if path == 'arrow' else FakeRowCursor(batches)
+    del batches
+    baseline = _peak_rss_kb()
+
+    start = time.perf_counter()
+    df = frame_from_cursor(cursor)
+    elapsed = time.perf_counter() - start
+
+    queue.put({
+        'path': path,
+        'rows': len(df),
+        'seconds': elapsed,
+        'rows_per_sec': len(df) / elapsed if elapsed > 0 else float('inf'),
+        'peak_rss_delta_mb': (_peak_rss_kb() - baseline) / 1024,
+    })
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--rows', type=int, default=200_000)
+    parser.add_argument('--batch-size', type=int, default=50_000)
+    args = parser.parse_args()
+
+    ctx = mp.get_context('spawn')
+    print(f"{'path':<8}{'rows':>12}{'seconds':>10}{'rows/sec':>14}{'peak RSS +MB':>14}")
+    for path in ('arrow', 'tuples'):
+        queue = ctx.Queue()
+        proc = ctx.Process(target=_run, args=(path, args.rows, args.batch_size, queue))
+        proc.start()
+        res = queue.get()
+        proc.join()
+        print(f"{res['path']:<8}{res['rows']:>12}{res['seconds']:>10.3f}{res['rows_per_sec']:>14,.0f}{res['peak_rss_delta_mb']:>14.1f}")
+
+
+if __name__ == "__main__":
+    main()
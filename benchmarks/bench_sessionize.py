@@ -0,0 +1,48 @@
+"""Benchmark of the local sessionization engine (sessionize.py) on synthetic raw events.
+
+Columns are handed over as the result schemas leave them: categorical tokens, session IDs and event
+names, and datetime64 timestamps.
+
+Usage: python benchmarks/bench_sessionize.py --events 1000000 10000000 30000000 --gap-minutes 30
+"""
+import argparse
+import pathlib
+import sys
+import time
+
+import pandas as pd
+
+BENCH_DIR = pathlib.Path(__file__).resolve().parent
+sys.path.insert(0, str(BENCH_DIR.parent))
+
+from sessionize import funnel_frame, funnel_steps, sessionize
+from synthetic_events import SyntheticSpec, generate
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--events", type=int, nargs="+", default=[1_000_000, 10_000_000])
+    parser.add_argument("--gap-minutes", type=float, default=30)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    gap = pd.Timedelta(minutes=args.gap_minutes)
+    print(f"{'events':>12}{'sessions':>12}{'sessionize s':>14}{'funnel s':>10}{'events/sec':>14}")
+    for events in args.events:
+        spec = SyntheticSpec(events=events, devices=max(20, min(5_000, events // 2_000)), sessions=max(100, events // 50), seed=args.seed)
+        frame = generate(spec).select(["DEVICE_TOKEN", "SESSION_ID", "EVENT_NAME", "EVENT_TIMESTAMP"]).to_pandas()
+
+        start = time.perf_counter()
+        res = sessionize(frame["DEVICE_TOKEN"], frame["SESSION_ID"], frame["EVENT_TIMESTAMP"], gap)
+        sessionize_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        funnel_frame(funnel_steps(res, frame["EVENT_NAME"]))
+        funnel_seconds = time.perf_counter() - start
+
+        print(f"{events:>12,}{len(res.sessions):>12,}{sessionize_seconds:>14.2f}{funnel_seconds:>10.2f}"
+              f"{events / sessionize_seconds:>14,.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+"""Synthetic ACCOUNT_EVENTS generator for the local benchmark warehouse.
+
+Device activity follows a Zipf-like skew, so a few devices produce most sessions. Sessions have a
+log-normal number of events and duration, and start times follow a daytime peak. A share of
+events has no device token or no session ID, like production data.
+"""
+from typing import NamedTuple
+
+import duckdb
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+from queries import GAME_NAME, STARTED_EVENTS
+
+OTHER_EVENTS = ("stepCompleted", "answerSelected", "videoWatched", "experienceEnded")
+ENVIRONMENTS = ("testing", "production")
+
+
+class SyntheticSpec(NamedTuple):
+    events: int = 1_000_000
+    devices: int = 200
+    sessions: int = 20_000
+    days: int = 90
+    device_skew: float = 1.1 # zipf exponent of device activity
+    missing_token_share: float = 0.03
+    missing_session_share: float = 0.02
+    seed: int = 0
+
+
+def _dictionary(indices: np.ndarray, values: list, null_mask: np.ndarray = None) -> pa.DictionaryArray:
+    return pa.DictionaryArray.from_arrays(pa.array(indices.astype(np.int32), mask=null_mask), pa.array(values))
+
+
+def generate(spec: SyntheticSpec, now: pd.Timestamp = None) -> pa.Table:
+    rng = np.random.default_rng(spec.seed)
+    now = (now if now is not None else pd.Timestamp.now()).floor("h")
+
+    # sessions: owning device (skewed), start time and duration
+    device_weights = 1.0 / np.arange(1, spec.devices + 1) ** spec.device_skew
+    session_device = rng.choice(spec.devices, size=spec.sessions, p=device_weights / device_weights.sum())
+    day_offsets = rng.integers(0, spec.days, spec.sessions)
+    start_minutes = np.clip(rng.normal(14 * 60, 180, spec.sessions), 0, 24 * 60 - 1) # daytime peak
+    session_start = now.normalize().value - day_offsets * 86_400_000_000_000 + (start_minutes * 60e9).astype(np.int64)
+    session_minutes = np.clip(rng.lognormal(2.0, 0.7, spec.sessions), 0.5, 180)
+
+    # events: spread over sessions by a log-normal session size
+    session_size = rng.lognormal(0, 1, spec.sessions)
+    event_session = rng.choice(spec.sessions, size=spec.events, p=session_size / session_size.sum())
+    offsets = (rng.random(spec.events) * session_minutes[event_session] * 60e9).astype(np.int64)
+    timestamps = (np.minimum(session_start[event_session] + offsets, now.value) // 1000).astype("datetime64[us]")
+
+    event_names = list(STARTED_EVENTS) + list(OTHER_EVENTS)
+    event_weights = np.array([0.04, 0.10, 0.03, 0.03, 0.03, 0.45, 0.20, 0.07, 0.05])
+    event_index = rng.choice(len(event_names), size=spec.events, p=event_weights / event_weights.sum())
+
+    device_index = session_device[event_session]
+    env_index = (device_index % 5 == 0).astype(np.int32) # every fifth device is a production one
+
+    missing_token = rng.random(spec.events) < spec.missing_token_share
+    missing_session = rng.random(spec.events) < spec.missing_session_share
+
+    devices = [f"device-{i:05d}" for i in range(spec.devices)]
+    tokens = [f"{i:032x}" for i in rng.integers(0, 2**62, spec.devices)]
+    sessions = [f"session-{i:08d}" for i in range(spec.sessions)]
+
+    return pa.table({
+        "GAME_NAME": _dictionary(np.zeros(spec.events), [GAME_NAME]),
+        "ENVIRONMENT_NAME": _dictionary(env_index, list(ENVIRONMENTS)),
+        "EVENT_NAME": _dictionary(event_index, event_names),
+        "EVENT_TIMESTAMP": pa.array(timestamps),
+        "DEVICE_NAME": _dictionary(device_index, devices, missing_token & (rng.random(spec.events) < 0.5)),
+        "DEVICE_TOKEN": _dictionary(device_index, tokens, missing_token),
+        "SESSION_ID": _dictionary(event_session, sessions, missing_session),
+    })
+
+
+def load(spec: SyntheticSpec, database: str = ":memory:") -> duckdb.DuckDBPyConnection:
+    # returns a duckdb database with ACCOUNT_EVENTS filled from the spec
+    con = duckdb.connect(database)
+    events = generate(spec)
+    con.register("synthetic_events", events)
+    con.execute("CREATE OR REPLACE TABLE ACCOUNT_EVENTS AS SELECT * FROM synthetic_events ORDER BY EVENT_TIMESTAMP")
+    con.unregister("synthetic_events")
+    return con
@@ -0,0 +1,61 @@
+import numpy as np
+import pandas as pd
+import plotly.express as px
+
+POINT_BUDGET = 1500 # most points a time series chart sends to the browser
+WEBGL_THRESHOLD = 1000 # charts with more points than this are drawn with WebGL instead of SVG
+
+
+def lttb_indices(x: np.ndarray, y: np.ndarray, n_out: int) -> np.ndarray:
+    # Largest-Triangle-Three-Buckets: positions of n_out points that keep the visual shape of a series sorted by x.
+    # The first and last points are kept, every bucket in between keeps the point spanning the largest triangle
+    # with the previously kept point and the average of the next bucket
+    n = len(x)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+
+    x = x.astype(float)
+    y = y.astype(float)
+    edges = np.linspace(1, n - 1, n_out - 1).astype(np.int64) # n_out - 2 buckets between the first and last point
+
+    res = np.empty(n_out, dtype=np.int64)
+    res[0], res[-1] = 0, n - 1
+    kept = 0
+    for i in range(n_out - 2):
+        start, stop = edges[i], edges[i + 1]
+        following = slice(edges[i + 1], edges[i + 2]) if i + 2 < len(edges) else slice(n - 1, n)
+        avg_x, avg_y = x[following].mean(), y[following].mean()
+
+        areas = np.abs((x[kept] - avg_x) * (y[start:stop] - y[kept]) - (x[kept] - x[start:stop]) * (avg_y - y[kept]))
+        kept = start + int(np.argmax(areas))
+        res[i + 1] = kept
+    return res
+
+
+def downsample(df: pd.DataFrame, x: str, y: str, point_budget: int = POINT_BUDGET) -> pd.DataFrame:
+    # at most point_budget rows of df, sorted by x, chosen with LTTB on (x, y)
+    series = df.dropna(subset=[x, y]).sort_values(x, kind="stable")
+    if len(series) <= point_budget:
+        return series.reset_index(drop=True)
+
+    x_values = series[x]
+    x_values = x_values.astype("int64") if pd.api.types.is_datetime64_any_dtype(x_values) else x_values
+    positions = lttb_indices(x_values.to_numpy(), series[y].to_numpy(), point_budget)
+    return series.iloc[positions].reset_index(drop=True)
+
+
+def time_series_figure(df: pd.DataFrame, x: str, y: str, point_budget: int = POINT_BUDGET,
+                       webgl_threshold: int = WEBGL_THRESHOLD, color: str = None, **line_options):
+    # px.line of a downsampled series, WebGL above webgl_threshold points. Markers are dropped on dense charts.
+    # With color, every line is downsampled on its own and shares the point budget
+    if color is None:
+        series = downsample(df, x, y, point_budget)
+    else:
+        groups = [group for _, group in df.groupby(color, observed=True, sort=True)]
+        budget = max(point_budget // max(len(groups), 1), 3)
+        series = pd.concat([downsample(group, x, y, budget) for group in groups], ignore_index=True) if groups else df
+        line_options["color"] = color
+    dense = len(series) > webgl_threshold
+    if dense:
+        line_options["markers"] = False
+    return px.line(series, x=x, y=y, render_mode="webgl" if dense else "svg", **line_options)
@@ -0,0 +1,119 @@
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Callable, TypeVar
+
+T = TypeVar("T")
+
+# Snowflake error numbers for a session that no longer exists or whose token expired
+SESSION_EXPIRED_ERRNOS = {390111, 390112, 390114}
+
+
+def is_session_expired(e: Exception) -> bool:
+    return getattr(e, "errno", None) in SESSION_EXPIRED_ERRNOS
+
+
+class ConnectionPool:
+    """Bounded pool of DB-API connections made by one connect function (one set of credentials).
+
+    Each checkout gets its own connection, so queries from worker threads run in parallel.
+    """
+
+    def __init__(self, connect: Callable[[], object], max_size: int = 4, probe_after: float = 60.0,
+                 prefill: int = 1) -> None:
+        self._connect = connect
+        self.max_size = max_size
+        self.probe_after = probe_after # seconds idle before a connection is probed on checkout
+
+        self._idle = deque() # (connection, returned_at)
+        self._slots = threading.BoundedSemaphore(max_size)
+        self._lock = threading.Lock()
+        self._closed = False
+
+        for _ in range(min(prefill, max_size)): # fails fast on bad credentials
+            self._idle.append((self._connect(), time.monotonic()))
+
+    @contextmanager
+    def connection(self):
+        self._slots.acquire()
+        conn = None
+        try:
+            conn = self._checkout()
+            yield conn
+        except Exception as e:
+            if conn is not None and is_session_expired(e):
+                _close_quietly(conn)
+                conn = None
+            raise
+        finally:
+            if conn is not None:
+                self._checkin(conn)
+            self._slots.release()
+
+    def run(self, fn: Callable[[object], T], retry: Callable[[], bool] = lambda: True) -> T:
+        # Runs fn with a pooled connection. A query that fails on an expired session is retried once on a fresh
+        # connection, unless retry() says fn already did something a second run would repeat
+        try:
+            with self.connection() as conn:
+                return fn(conn)
+        except Exception as e:
+            if not is_session_expired(e) or not retry():
+                raise
+
+        with self.connection() as conn:
+            return fn(conn)
+
+    def close(self) -> None:
+        with self._lock:
+            self._closed = True
+            while self._idle:
+                conn, _ = self._idle.popleft()
+                _close_quietly(conn)
+
+    def _checkout(self):
+        while True:
+            with self._lock:
+                if self._closed:
+                    raise RuntimeError("Connection pool is closed")
+                if not self._idle:
+                    break
+                conn, returned_at = self._idle.pop() # most recently used first, so idle ones age out
+
+            if self._is_alive(conn, time.monotonic() - returned_at):
+                return conn
+            _close_quietly(conn)
+
+        return self._connect()
+
+    def _checkin(self, conn) -> None:
+        with self._lock:
+            if self._closed:
+                _close_quietly(conn)
+                return
+            self._idle.append((conn, time.monotonic()))
+
+    def _is_alive(self, conn, idle_for: float) -> bool: # cheap liveness probe
+        is_closed = getattr(conn, "is_closed", None)
+        if is_closed is not None and is_closed():
+            return False
+        if idle_for < self.probe_after:
+            return True
+
+        try:
+            cursor = conn.cursor()
+            try:
+                cursor.execute("SELECT 1")
+                cursor.fetchall()
+            finally:
+                cursor.close()
+            return True
+        except Exception:
+            return False
+
+
+def _close_quietly(conn) -> None:
+    try:
+        conn.close()
+    except Exception:
+        pass
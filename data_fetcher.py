@@ -1,43 +1,434 @@
+import functools
+import threading
+import time
+from concurrent.futures import Future
+from typing import NamedTuple
+import numpy as np
 import pandas as pd
-import streamlit as st
+import pyarrow as pa
+from diagnostics import QueryLog, QueryRecord, Stopwatch
+from exports import export_statement
+from incremental import PartialAggregateStore
+from queries import CATEGORY, COUNT, EPOCH, RESULT_SCHEMAS, STARTED_EVENT_COLUMNS, STATEMENTS, TIMESTAMP, BoundStatement
+from rollups import SKETCH_LOG_GAMMA, RollupStore
+from sessionize import DEFAULT_INACTIVITY_GAP, funnel_frame, funnel_steps, sessionize
+from result_cache import CacheKey, ResultCache, completed_future, frame_nbytes
+
+def frame_from_cursor(cursor, timings: dict = None) -> pd.DataFrame: # build a DataFrame from an executed cursor
+    column_names = [desc[0] for desc in cursor.description]
+    fetch_batches = getattr(cursor, "fetch_arrow_batches", None)
+
+    if fetch_batches is not None: # columnar path, no python object per cell
+        try:
+            with Stopwatch(timings, "fetch_ms"):
+                batches = list(fetch_batches())
+        except NotImplementedError:
+            batches = None
+        except Exception as e: # e.g. snowflake NotSupportedError when the result is not in arrow format
+            if type(e).__name__ != "NotSupportedError":
+                raise
+            batches = None
+
+        if batches is not None:
+            with Stopwatch(timings, "build_ms"):
+                if len(batches) == 0:
+                    return pd.DataFrame(columns=column_names)
+                # self_destruct frees arrow buffers while converting, so peak memory stays near one copy. It can
+                # only free them once the batches list no longer holds the tables
+                # batches can differ in integer and float widths (Snowflake sizes them per batch), widened here
+                table = pa.concat_tables(batches, promote_options="permissive")
+                batches.clear()
+                return table.to_pandas(split_blocks=True, self_destruct=True)
+
+    with Stopwatch(timings, "fetch_ms"):
+        rows = cursor.fetchall() # fallback for cursors without arrow support
+    with Stopwatch(timings, "build_ms"):
+        return pd.DataFrame(rows, columns=column_names)
+
+def execute_cursor(cursor, query: str, params: tuple = None, timeout: float = None) -> None:
+    # timeout: seconds after which the cursor cancels the query, none by default
+    if timeout is None:
+        cursor.execute(query, params)
+    else:
+        cursor.execute(query, params, timeout=timeout)
+
+def execute_query(conn, query: str, params: tuple = None, timings: dict = None, timeout: float = None) -> pd.DataFrame:
+    cursor = conn.cursor()
+    try:
+        with Stopwatch(timings, "execute_ms"):
+            execute_cursor(cursor, query, params, timeout)
+        if timings is not None:
+            timings["query_id"] = getattr(cursor, "sfqid", None)
+        return frame_from_cursor(cursor, timings)
+    finally:
+        cursor.close()
+
+def apply_schema(df: pd.DataFrame, schema: dict) -> pd.DataFrame:
+    # casts the columns a result schema names (see queries.RESULT_SCHEMAS) to compact dtypes
+    columns = {}
+    for column, kind in schema.items():
+        if column not in df.columns:
+            continue
+        if kind == CATEGORY:
+            columns[column] = df[column].astype("category")
+        elif kind == COUNT: # stays float when there are nulls
+            columns[column] = pd.to_numeric(df[column], downcast="integer")
+        elif kind == TIMESTAMP:
+            columns[column] = pd.to_datetime(df[column])
+    return df.assign(**columns) if columns else df
+
+_call_context = threading.local() # the outermost Data_fetcher method running on this thread
+
+def instrumented(method): # names the query records made while the method runs
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        if getattr(_call_context, "method", None) is not None:
+            return method(*args, **kwargs)
+        _call_context.method = method.__name__
+        try:
+            return method(*args, **kwargs)
+        finally:
+            _call_context.method = None
+    return wrapper
+
+
+# Percentile columns of the duration statistics, computed as PERCENTILE_CONT in the warehouse
+DURATION_QUANTILES = {"P50_DURATION": 0.5, "P90_DURATION": 0.9, "P99_DURATION": 0.99}
+
+
+def duration_stats_from_sessions(sessions: pd.DataFrame, by: list = None) -> pd.DataFrame:
+    # Local equivalent of the session duration statistics query, for per-session rows kept locally
+    by = list(by or [])
+    durations = sessions["SESSION_DURATION"].astype(float)
+
+    def stats(grouped) -> pd.DataFrame:
+        res = grouped.agg(
+            SESSION_COUNT="count", AVG_DURATION="mean", MIN_DURATION="min", MAX_DURATION="max"
+        )
+        for column, q in DURATION_QUANTILES.items():
+            res[column] = grouped.quantile(q)
+        return res
+
+    daily = stats(durations.groupby([sessions[col] for col in by] + [sessions["SESSION_DATE"]])).reset_index()
+    daily["IS_SUMMARY"] = 0
+
+    if by:
+        summary = stats(durations.groupby([sessions[col] for col in by])).reset_index()
+    else:
+        summary = stats(durations.groupby(lambda _: 0)).reset_index(drop=True)
+    summary["SESSION_DATE"] = pd.NaT
+    summary["IS_SUMMARY"] = 1
+
+    return pd.concat([daily, summary[daily.columns]], ignore_index=True)
+
+
+def split_duration_stats(stats: pd.DataFrame) -> tuple:
+    # (one row per SESSION_DATE, the overall summary row as a Series or None when there were no sessions).
+    # Without sessions the warehouse still returns its grand total row, with SESSION_COUNT 0 and NULL statistics
+    is_summary = stats["IS_SUMMARY"].astype(bool)
+    daily = stats[~is_summary].sort_values("SESSION_DATE", ignore_index=True)
+    summary = stats[is_summary]
+    if len(summary) == 0 or not summary["SESSION_COUNT"].iloc[0] > 0:
+        return daily, None
+    return daily, summary.iloc[0]
+
+
+def totals_frame(totals: pd.Series) -> pd.DataFrame:
+    # EVENT_NAME, EVENT_COUNT from counts indexed by event name, in the order the totals chart uses
+    res = pd.DataFrame({"EVENT_NAME": totals.index, "EVENT_COUNT": totals.to_numpy()})
+    return res.sort_values("EVENT_NAME", ascending=False, ignore_index=True)
+
+
+def index_by_device_token(frame: pd.DataFrame) -> tuple:
+    # (frame sorted by DEVICE_TOKEN without that column, DEVICE_TOKEN -> slice of its rows). Lookups are one iloc
+    frame = frame.sort_values("DEVICE_TOKEN", kind="stable", ignore_index=True)
+    tokens = frame["DEVICE_TOKEN"].to_numpy()
+    if len(tokens) == 0:
+        return frame.drop(columns="DEVICE_TOKEN"), {}
+
+    starts = np.flatnonzero(np.r_[True, tokens[1:] != tokens[:-1]])
+    stops = np.r_[starts[1:], len(tokens)]
+    slices = {tokens[start]: slice(start, stop) for start, stop in zip(starts, stops)}
+    return frame.drop(columns="DEVICE_TOKEN"), slices
+
+
+# Zoomed ranges up to this long are charted per hour, longer ones per day
+SERIES_HOURLY_SPAN = pd.Timedelta(days=14)
+
+# Defaults of the watermarked local aggregates (incremental partials and rollups): late events are re-pulled
+# for TRAILING_WINDOW, and a store refreshes at most every MIN_REFRESH_INTERVAL seconds
+TRAILING_WINDOW = pd.Timedelta(hours=2)
+MIN_REFRESH_INTERVAL = 60.0
+
+# Seconds a cached result stays valid, per query family
+QUERY_TTLS = {
+    "events": 600,
+    "sessions": 600,
+    "device": 300,
+    "device_index": 600,
+}
+
+
+# Statement each first page method reads through fetch_data, submitted ahead by load_page_async
+PAGE_STATEMENTS = {
+    "get_total_event_started": "started_event_counts",
+    "get_event_count_by_device_token": "started_event_counts",
+    "get_session_duration_stats": "session_duration_stats",
+}
+
+
+# Seconds a query may run before it is cancelled in the warehouse, per query family. Full history scans get longer
+QUERY_TIMEOUTS = {
+    "events": 300,
+    "sessions": 300,
+    "device": 120,
+    "device_index": 600,
+    "rollups": 1800,
+    "export": 3600,
+}
+
+
+class IncrementalPartials(NamedTuple):
+    """Watermarked per-day partials of one environment behind the incremental refresh"""
+    events: PartialAggregateStore # started event counts per EVENT_DATE and device
+    sessions: PartialAggregateStore # one row per session of the last month
+
+    @classmethod
+    def create(cls, trailing_window: pd.Timedelta = TRAILING_WINDOW,
+               min_refresh_interval: float = MIN_REFRESH_INTERVAL) -> "IncrementalPartials":
+        return cls(
+            PartialAggregateStore(
+                "EVENT_DATE", "LAST_EVENT_TIMESTAMP", trailing_window,
+                min_refresh_interval=min_refresh_interval
+            ),
+            PartialAggregateStore(
+                "SESSION_DATE", "LAST_EVENT_TIMESTAMP", trailing_window,
+                retention=pd.DateOffset(months=1), min_refresh_interval=min_refresh_interval
+            ),
+        )
+
 
 class Data_fetcher:
 
-    def __init__(_self, con, env) -> None:
-        _self.con = con
+    def __init__(_self, backend, env, cache: ResultCache = None, query_log: QueryLog = None, incremental: bool = False,
+                 trailing_window: pd.Timedelta = TRAILING_WINDOW, min_refresh_interval: float = MIN_REFRESH_INTERVAL,
+                 compact_dtypes: bool = True, session_gap: pd.Timedelta = None, rollups: RollupStore = None,
+                 partials: "IncrementalPartials" = None, timeouts: dict = None) -> None:
+        _self.backend = backend # backends.Backend the statements run on, e.g. SnowflakeBackend or ParquetBackend
         _self.env = env
+        _self.cache = cache if cache is not None else ResultCache(ttls=QUERY_TTLS)
+        _self.query_log = query_log # optional QueryLog, one record per fetch
+        _self.fragments = backend.fragments # SQL dialect of the backend
+        _self.compact_dtypes = compact_dtypes # cast results with their RESULT_SCHEMAS entry before caching
+        _self.timeouts = dict(QUERY_TIMEOUTS if timeouts is None else timeouts) # family -> seconds
+        _self.incremental = incremental # refresh from per-day partials newer than a watermark instead of full scans
+        _self.session_gap = session_gap # when set, sessions are split locally by this inactivity gap, see sessionize.py
+
+        # Pass the environment's shared partials so only its first fetcher scans full history
+        if partials is None:
+            partials = IncrementalPartials.create(trailing_window, min_refresh_interval)
+        _self.event_partials, _self.session_partials = partials
+
+        # for arbitrary date ranges. Pass the environment's shared store so only its first fetcher scans full history
+        _self.rollups = rollups if rollups is not None else RollupStore(trailing_window, min_refresh_interval=min_refresh_interval)
+
+        # ({"timestamps": (df, slices), "session_stats": (df, slices)}, monotonic time built), filled by prefetch_device_details.
+        # Replaced as a whole, so readers that take it once see an index and its build time together
+        _self.device_index = None
+        _self._device_index_generation = 0 # bumped by clear_cache, so a prefetch running across it does not publish
+        _self._device_index_lock = threading.Lock()
+
+    def bind(_self, statement_name: str, **params) -> BoundStatement:
+        return STATEMENTS[statement_name].bind(_self.fragments, env=_self.env, **params)
+
+    def fetch_data(_self, statement_name: str, refresh: bool = False, **params) -> pd.DataFrame:
+        # cached result of a statement, or with refresh=True always re-run and re-cached
+        statement = _self.bind(statement_name, **params)
+        key = CacheKey(_self.env, statement.family, statement.fingerprint, statement.params)
+        get = _self.cache.refresh if refresh else _self.cache.get_or_compute
+        return _self.logged(statement, lambda timings: get(key, lambda: _self.run_query(statement, timings)))
+
+    def load_async(_self, statement_name: str, group: str = None, **params) -> Future:
+        # Caches the result of a statement like fetch_data, without a thread waiting while its query runs. Resolves
+        # to the frame, or to None when it cannot be loaded this way: the backend runs queries synchronously, or
+        # another process is computing the result. fetch_data then gets it the blocking way
+        backend = _self.backend
+        if backend.scheduler is None or not backend.supports_async:
+            return completed_future(None)
+
+        statement = _self.bind(statement_name, **params)
+        key = CacheKey(_self.env, statement.family, statement.fingerprint, statement.params)
+        submit = lambda timings: backend.execute_async(
+            statement, timings, timeout=_self.timeouts.get(statement.family), group=group,
+            transform=lambda res: _self.compact(statement, res, timings),
+        )
+        return _self.cache.get_or_compute_async(
+            key, lambda: _self.logged_async(statement, submit), join=lambda future: backend.scheduler.join(future, group)
+        )
 
-    @st.cache_data
-    def fetch_data(_self, query: str) -> pd.DataFrame:
+    def load_page_async(_self, method_name: str, group: str = None) -> Future:
+        # load_async of the statement a first page method reads, see PAGE_STATEMENTS. Resolves to None at once for
+        # other methods, and where the incremental refresh or local sessions serve the method instead
+        statement_name = PAGE_STATEMENTS.get(method_name)
+        if (statement_name is None or _self.incremental
+                or (_self.session_gap is not None and statement_name == "session_duration_stats")):
+            return completed_future(None)
 
+        _call_context.method = method_name # its query record is named after the method
         try:
-            cursor = _self.con.cursor()
-            cursor.execute(query)
-            results = cursor.fetchall()
-            column_names = [desc[0] for desc in cursor.description]
-        except:
+            return _self.load_async(statement_name, group)
+        finally:
+            _call_context.method = None
+
+    def run_query(_self, statement: BoundStatement, timings: dict = None) -> pd.DataFrame: # uncached, used directly by the incremental refresh
+        res = _self.backend.execute(statement, timings, timeout=_self.timeouts.get(statement.family))
+        return _self.compact(statement, res, timings)
+
+    def compact(_self, statement: BoundStatement, res: pd.DataFrame, timings: dict = None) -> pd.DataFrame:
+        # res cast with the statement's RESULT_SCHEMAS entry, unless compact_dtypes is off
+        if not _self.compact_dtypes:
+            return res
+        with Stopwatch(timings, "build_ms"):
+            return apply_schema(res, RESULT_SCHEMAS.get(statement.name, {}))
+
+    def logged(_self, statement: BoundStatement, fetch) -> pd.DataFrame:
+        # runs fetch(timings) and adds a QueryRecord to the query log
+        if _self.query_log is None:
+            return fetch(None)
+
+        timings = {}
+        record = _self.new_record(statement)
+        start = time.perf_counter()
+        res, error = None, None
+        try:
+            res = fetch(timings)
+            return res
+        except Exception as e:
+            error = e
             raise
         finally:
-           cursor.close()
+            _self.add_record(record, start, timings, res, error)
+
+    def logged_async(_self, statement: BoundStatement, submit) -> Future:
+        # logged for a submit(timings) returning a future, the record is added once the future is resolved
+        if _self.query_log is None:
+            return submit(None)
+
+        timings = {}
+        record = _self.new_record(statement)
+        start = time.perf_counter()
+        def done(future):
+            error = future.exception()
+            _self.add_record(record, start, timings, None if error is not None else future.result(), error)
+
+        try:
+            future = submit(timings)
+        except Exception as e:
+            _self.add_record(record, start, timings, None, e)
+            raise
+        future.add_done_callback(done)
+        return future
+
+    def new_record(_self, statement: BoundStatement) -> QueryRecord:
+        return QueryRecord(
+            timestamp=time.time(),
+            method=getattr(_call_context, "method", None) or "fetch_data",
+            statement=statement.name,
+            fingerprint=statement.fingerprint,
+            env=_self.env,
+        )
 
-        return pd.DataFrame(results, columns=column_names)
+    def add_record(_self, record: QueryRecord, start: float, timings: dict, res, error) -> None:
+        # completes record with the outcome of its fetch and adds it to the query log
+        if error is not None:
+            record.error = f"{type(error).__name__}: {error}"
+        elif res is not None:
+            record.rows = len(res)
+            if "execute_ms" in timings:
+                record.result_bytes = frame_nbytes(res)
+        record.total_ms = (time.perf_counter() - start) * 1000
+        record.cache_hit = "execute_ms" not in timings and record.error is None
+        record.query_id = timings.get("query_id")
+        for phase in ("queue_ms", "execute_ms", "fetch_ms", "build_ms"):
+            setattr(record, phase, timings.get(phase, 0.0))
+        _self.query_log.add(record)
     
-    def get_total_event_started(_self) -> pd.DataFrame:
+    @instrumented
+    def get_started_event_counts(_self) -> pd.DataFrame:
+        # One scan, pivoted in the warehouse: a row per (device_name, device_token) with an integer count column per
+        # started event. Totals and the device table are both derived from it locally
+        try:
+            if _self.incremental:
+                return _self.get_started_event_counts_incremental()
+            res = _self.fetch_data("started_event_counts")
+        except:
+            raise
+
+        return res
+
+    def get_started_event_counts_incremental(_self) -> pd.DataFrame:
+
+        def fetch_since(since):
+            since = EPOCH if since is None else since.to_pydatetime()
+            statement = _self.bind("started_event_partials", since=since)
+            return _self.logged(statement, lambda timings: _self.run_query(statement, timings))
 
-        query = f'''
-                select EVENT_NAME, count(*) AS EVENT_COUNT from ACCOUNT_EVENTS
-                WHERE GAME_NAME = 'The Experience'
-                AND ENVIRONMENT_NAME = '{_self.env}'
-                AND event_name IN ('gameStarted','experienceStarted','perfectServingStarted','breweryIngredientsStarted','artOfBrewingStarted')
-                GROUP BY EVENT_NAME
-                ORDER BY EVENT_NAME DESC
-                '''
         try:
-            res = _self.fetch_data(query)
+            partials = _self.event_partials.refresh(fetch_since)
         except:
             raise
-        
+
+        res = partials.groupby(["DEVICE_NAME", "DEVICE_TOKEN"], dropna=False, as_index=False)[list(STARTED_EVENT_COLUMNS)].sum()
         return res
+
+    @instrumented
+    def get_total_event_started(_self) -> pd.DataFrame:
+
+        try:
+            counts = _self.get_started_event_counts()
+        except:
+            raise
+
+        return totals_frame(counts[list(STARTED_EVENT_COLUMNS)].sum())
+
+    @instrumented
+    def refresh_rollups(_self) -> tuple:
+        # brings the hourly rollups up to date from their watermarks, returns the (first, last) hour they cover
+
+        def fetcher_for(statement_name):
+            def fetch_since(since):
+                since = EPOCH if since is None else since.to_pydatetime()
+                statement = _self.bind(statement_name, since=since, log_gamma=SKETCH_LOG_GAMMA)
+                return _self.logged(statement, lambda timings: _self.run_query(statement, timings))
+            return fetch_since
+
+        try:
+            _self.rollups.refresh(fetcher_for("rollup_event_counts"), fetcher_for("rollup_session_sketches"))
+        except:
+            raise
+
+        return _self.rollups.span()
+
+    @instrumented
+    def get_total_event_started_between(_self, since: pd.Timestamp, until: pd.Timestamp) -> pd.DataFrame:
+        # event totals in [since, until) from the rollups, no warehouse query beyond the incremental refresh
+        try:
+            _self.refresh_rollups()
+        except:
+            raise
+
+        return totals_frame(_self.rollups.event_totals(since, until, list(STARTED_EVENT_COLUMNS)))
+
+    @instrumented
+    def get_session_duration_stats_between(_self, since: pd.Timestamp, until: pd.Timestamp, granularity: str = "day",
+                                           deviceToken: str = None) -> pd.DataFrame:
+        # session duration statistics per hour, day or week in [since, until) from the rollups, percentiles from sketches
+        try:
+            _self.refresh_rollups()
+        except:
+            raise
+
+        return _self.rollups.duration_stats(since, until, granularity, DURATION_QUANTILES, device_token=deviceToken)
     
     def get_total_event_started_MOCK(_self) -> pd.DataFrame:
         
@@ -55,43 +446,73 @@ class Data_fetcher:
 
         return pd.DataFrame(data)
     
+    @instrumented
     def get_generic_session_durations(_self) -> pd.DataFrame:
-        
-        query = f'''
-                WITH session_data AS (
-                SELECT
-                    EVENT_JSON:sessionID::STRING AS session_id,
-                    DATE_TRUNC('day', event_timestamp) AS session_date,
-                    MIN(event_timestamp) AS session_start_time,
-                    MAX(event_timestamp) AS session_end_time
-                FROM
-                    ACCOUNT_EVENTS
-                WHERE
-                    GAME_NAME = 'The Experience'
-                    AND ENVIRONMENT_NAME = 'testing'
-                    AND EVENT_JSON:sessionID::STRING IS NOT NULL
-                    AND event_timestamp >= DATEADD('month', -1, CURRENT_DATE)
-                GROUP BY
-                    EVENT_JSON:sessionID::STRING, DATE_TRUNC('day', event_timestamp)
-                )
-                SELECT
-                    session_date,
-                    DATEDIFF('minute', session_start_time, session_end_time) AS session_duration
-                FROM
-                    session_data
-                WHERE
-                    DATEDIFF('minute', session_start_time, session_end_time) > 0
-
-                '''
-
-        try:
-            res = _self.fetch_data(query)
+
+        try:
+            if _self.session_gap is not None:
+                return _self.get_local_session_durations()
+            if _self.incremental:
+                return _self.get_generic_session_durations_incremental()
+            res = _self.fetch_data("session_durations")
             # res['DURATION_MINUTES'] = pd.to_numeric(res['DURATION_MINUTES'], errors='coerce')
             return res
         except:
             raise
 
 
+    def get_generic_session_durations_incremental(_self) -> pd.DataFrame:
+
+        def fetch_since(since):
+            since = EPOCH if since is None else since.to_pydatetime()
+            statement = _self.bind("session_partials", since=since)
+            return _self.logged(statement, lambda timings: _self.run_query(statement, timings))
+
+        try:
+            partials = _self.session_partials.refresh(fetch_since)
+        except:
+            raise
+
+        # sessions are kept unfiltered so the watermark also advances on zero length sessions
+        res = partials.loc[partials["SESSION_DURATION"] > 0, ["SESSION_DATE", "SESSION_DURATION"]].reset_index(drop=True)
+        return res
+
+    def get_local_sessions(_self, refresh: bool = False) -> pd.DataFrame:
+        # Sessions starting in the last month, split from raw events by the local engine: kept together across
+        # midnight, split after the inactivity gap, and formed per device for events without a session ID.
+        # One row per session with its FUNNEL_STEP, cached like a query result
+        gap = _self.session_gap if _self.session_gap is not None else DEFAULT_INACTIVITY_GAP
+        since = pd.Timestamp.today().normalize() - pd.DateOffset(months=1)
+        statement = _self.bind("session_events", since=(since - gap).to_pydatetime()) # sessions may start before since
+        key = CacheKey(_self.env, statement.family, f"sessionized:{statement.fingerprint}", statement.params + (gap.value,))
+
+        def sessionized():
+            events = _self.logged(statement, lambda timings: _self.run_query(statement, timings))
+            res = sessionize(events["DEVICE_TOKEN"], events["SESSION_ID"], events["EVENT_TIMESTAMP"], gap)
+            sessions = res.sessions.assign(FUNNEL_STEP=funnel_steps(res, events["EVENT_NAME"]))
+            return sessions[sessions["SESSION_START"] >= since].reset_index(drop=True)
+
+        get = _self.cache.refresh if refresh else _self.cache.get_or_compute
+        try:
+            return get(key, sessionized)
+        except:
+            raise
+
+    def get_local_session_durations(_self) -> pd.DataFrame:
+        # SESSION_DATE, SESSION_DURATION like the session_durations query, from the local sessions
+        sessions = _self.get_local_sessions()
+        return sessions.loc[sessions["SESSION_DURATION"] > 0, ["SESSION_DATE", "SESSION_DURATION"]].reset_index(drop=True)
+
+    @instrumented
+    def get_session_funnel(_self) -> pd.DataFrame:
+        # sessions of the last month reaching each started event in turn, gameStarted first
+        try:
+            sessions = _self.get_local_sessions()
+        except:
+            raise
+
+        return funnel_frame(sessions["FUNNEL_STEP"])
+
     def get_generic_session_durations_MOCK(_self) -> pd.DataFrame:
 
         data = {
@@ -116,64 +537,95 @@ class Data_fetcher:
                     10, 8, 4, 5, 2, 4, 4, 13, 13, 2, 6, 2, 2, 3, 12
             ]
         }
-        df = pd.DataFrame(data)
+        df = apply_schema(pd.DataFrame(data), RESULT_SCHEMAS["session_durations"])
         return df
     
 
-    def get_event_count_by_device_token(_self):
-        
-        device_event_count_query = f'''
-            SELECT DISTINCT
-                event_name,
-                EVENT_JSON:deviceName::STRING AS device_name,
-                EVENT_JSON:deviceToken::STRING AS device_token,
-                COUNT(*) AS event_count
-            FROM
-                account_events
-            WHERE
-                game_name = 'The Experience'
-            AND
-                environment_name = '{_self.env}'
-            AND
-                event_name in ('gameStarted','experienceStarted','perfectServingStarted','breweryIngredientsStarted','artOfBrewingStarted')
-            
-            AND  (
-                EVENT_JSON:deviceToken::STRING IS NOT NULL 
-                OR (
-                    EVENT_JSON:deviceToken::STRING IS NULL 
-                    AND EVENT_JSON:deviceName::STRING IS NULL
-                )
-            )
-            GROUP BY
-                event_name,
-                EVENT_JSON:deviceName::STRING,
-                EVENT_JSON:deviceToken::STRING
-            ORDER BY
-                event_name, event_count DESC;
-            '''
+    @instrumented
+    def get_session_duration_stats(_self) -> pd.DataFrame:
 
         try:
-            res = _self.fetch_data(device_event_count_query)
+            if _self.session_gap is not None:
+                return duration_stats_from_sessions(_self.get_local_session_durations())
+            if _self.incremental: # per-session partials are kept locally anyway
+                return duration_stats_from_sessions(_self.get_generic_session_durations_incremental())
+            res = _self.fetch_data("session_duration_stats")
+        except:
+            raise
 
-            res["DEVICE_NAME"] = res["DEVICE_NAME"].fillna("None")
-            res["DEVICE_TOKEN"] = res["DEVICE_TOKEN"].fillna("None")
+        return res
 
-            device_mapping = res.groupby("DEVICE_NAME")["DEVICE_TOKEN"].first().reset_index()
+    def get_session_duration_stats_MOCK(_self) -> pd.DataFrame:
+        return duration_stats_from_sessions(_self.get_generic_session_durations_MOCK())
 
-            pivot_df = res.pivot_table(
-                index="DEVICE_NAME",
-                columns="EVENT_NAME",
-                values="EVENT_COUNT",
-                fill_value=0
-            ).reset_index()
+    @instrumented
+    def get_session_duration_series(_self, since: pd.Timestamp, until: pd.Timestamp, deviceToken: str = None) -> pd.DataFrame:
+        # Session count and average duration per SESSION_BUCKET in [since, until), finer buckets for shorter ranges
+        grain = "hour" if until - since <= SERIES_HOURLY_SPAN else "day"
+        params = {"since": since.to_pydatetime(), "until": until.to_pydatetime()}
+        try:
+            if deviceToken is None:
+                res = _self.fetch_data(f"session_duration_series_{grain}", **params)
+            else:
+                res = _self.fetch_data(f"device_session_duration_series_{grain}", device_token=deviceToken, **params)
+        except:
+            raise
 
-            pivot_df = pivot_df.merge(device_mapping, on="DEVICE_NAME", how="left")
-            return pivot_df
+        return res
 
+    @instrumented
+    def get_started_event_counts_by_env(_self, envs) -> pd.DataFrame:
+        # get_started_event_counts for several environments in one scan, with an ENVIRONMENT_NAME column.
+        # Cached as one result, so switching between or overlaying the environments needs no further query
+        try:
+            res = _self.fetch_data("env_started_event_counts", envs=tuple(sorted(envs)))
         except:
             raise
+
+        return res
+
+    @instrumented
+    def get_total_event_started_by_env(_self, envs) -> pd.DataFrame:
+        # ENVIRONMENT_NAME, EVENT_NAME, EVENT_COUNT with every started event for each environment that has events
+
+        try:
+            counts = _self.get_started_event_counts_by_env(envs)
+        except:
+            raise
+
+        totals = counts.groupby("ENVIRONMENT_NAME", observed=True)[list(STARTED_EVENT_COLUMNS)].sum()
+        frames = {environment: totals_frame(row) for environment, row in totals.iterrows()}
+        if not frames:
+            return pd.DataFrame(columns=["ENVIRONMENT_NAME", "EVENT_NAME", "EVENT_COUNT"])
+        return pd.concat(frames, names=["ENVIRONMENT_NAME"]).reset_index(level=0).reset_index(drop=True)
+
+    @instrumented
+    def get_session_duration_stats_by_env(_self, envs) -> pd.DataFrame:
+        # get_session_duration_stats for several environments in one scan, daily rows and a summary row per ENVIRONMENT_NAME
+        try:
+            res = _self.fetch_data("env_session_duration_stats", envs=tuple(sorted(envs)))
+        except:
+            raise
+
+        return res
+
+    @instrumented
+    def get_event_count_by_device_token(_self):
+
+        try:
+            counts = _self.get_started_event_counts()
+        except:
+            raise
+
+        # Rows with a device name but no token are only part of the totals
+        res = counts[counts["DEVICE_TOKEN"].notna() | counts["DEVICE_NAME"].isna()]
+        res = res.fillna({"DEVICE_NAME": "None", "DEVICE_TOKEN": "None"})
+
+        # a device name can have several tokens: counts are summed, the first token identifies the row
+        aggregations = {event: (event, "sum") for event in STARTED_EVENT_COLUMNS}
+        res = res.groupby("DEVICE_NAME", as_index=False).agg(**aggregations, DEVICE_TOKEN=("DEVICE_TOKEN", "first"))
+        return res
             
-    
     def get_event_count_by_device_token_MOCK(_self) -> pd.DataFrame:
         
         # Mock data
@@ -192,62 +644,124 @@ class Data_fetcher:
 
         return pd.DataFrame(data)
     
+    @instrumented
     def get_latest_event_timestamps_by_devicetoken(_self, deviceToken: str) -> pd.DataFrame:
 
-        device_token_dates_query = f'''
-        SELECT
-            EVENT_NAME,
-            MAX(event_timestamp) AS latest_event_timestamp
-        FROM
-            account_events
-        WHERE
-            game_name = 'The Experience'
-            AND environment_name = '{_self.env}'
-            AND EVENT_JSON:deviceToken::STRING = '{deviceToken}'
-            AND EVENT_NAME IN ('gameStarted', 'experienceStarted', 'perfectServingStarted', 'breweryIngredientsStarted', 'artOfBrewingStarted')
-        GROUP BY
-            EVENT_NAME
-        ORDER BY
-            latest_event_timestamp DESC;
-        '''
-
-        try:
-            res = _self.fetch_data(device_token_dates_query)
+        indexed = _self.get_indexed_device_details(deviceToken)
+        if indexed is not None:
+            return indexed["timestamps"]
+
+        try:
+            res = _self.fetch_data("device_latest_events", device_token=deviceToken)
             return res
         except:
             raise
 
+    @instrumented
     def get_session_durations_by_devicetoken(_self, deviceToken: str) -> pd.DataFrame:
-        query = f'''
-                WITH session_data AS (
-                SELECT
-                    EVENT_JSON:sessionID::STRING AS session_id,
-                    DATE_TRUNC('day', event_timestamp) AS session_date,
-                    MIN(event_timestamp) AS session_start_time,
-                    MAX(event_timestamp) AS session_end_time
-                FROM
-                    ACCOUNT_EVENTS
-                WHERE
-                    GAME_NAME = 'The Experience'
-                    AND ENVIRONMENT_NAME = '{_self.env}'
-                    AND EVENT_JSON:deviceToken::STRING = '{deviceToken}'
-                    AND EVENT_JSON:sessionID::STRING IS NOT NULL
-                    AND event_timestamp >= DATEADD('month', -1, CURRENT_DATE)
-                GROUP BY
-                    EVENT_JSON:sessionID::STRING, DATE_TRUNC('day', event_timestamp)
-            )
-            SELECT
-                session_date,
-                DATEDIFF('minute', session_start_time, session_end_time) AS session_duration
-            FROM
-                session_data
-            WHERE
-                DATEDIFF('minute', session_start_time, session_end_time) > 0
-            '''
-        
+
+        try:
+            res = _self.fetch_data("device_session_durations", device_token=deviceToken)
+            return res
+        except:
+            raise
+
+    @instrumented
+    def get_session_duration_stats_by_devicetoken(_self, deviceToken: str) -> pd.DataFrame:
+
+        indexed = _self.get_indexed_device_details(deviceToken)
+        if indexed is not None:
+            return indexed["session_stats"]
+
         try:
-            res = _self.fetch_data(query)
+            res = _self.fetch_data("device_session_duration_stats", device_token=deviceToken)
             return res
         except:
             raise
 
+    def export_data(_self, statement_name: str, sink, fmt: str = "parquet", **params) -> int:
+        # Streams a statement's result into sink as Parquet or CSV, one cursor batch at a time and without the
+        # result cache, so a full history export never holds the whole result. Returns the number of rows.
+        # Always runs with the "export" timeout, whatever family the statement belongs to
+        statement = _self.bind(statement_name, **params)
+        try:
+            return export_statement(_self.backend, statement, sink, fmt, timeout=_self.timeouts.get("export", QUERY_TIMEOUTS["export"]))
+        except:
+            raise
+
+    @instrumented
+    def warm(_self) -> None:
+        # Re-runs what the first dashboard page reads in this fetcher's mode, e.g. from a BackgroundRefresher:
+        # the shared cache entries, or the environment's shared partials. Sessions asking for a result while
+        # it is being re-run wait for that run instead of starting another
+        try:
+            if _self.incremental:
+                _self.get_started_event_counts_incremental()
+            else:
+                _self.fetch_data("started_event_counts", refresh=True)
+
+            if _self.session_gap is not None: # durations and the funnel both come from the local sessions
+                _self.get_local_sessions(refresh=True)
+            elif _self.incremental:
+                _self.get_generic_session_durations_incremental()
+            else:
+                _self.fetch_data("session_duration_stats", refresh=True)
+        except:
+            raise
+
+    def clear_cache(_self) -> None: # drops this environment's cached results and local incremental/index state
+        _self.cache.invalidate(env=_self.env)
+        _self.event_partials.reset()
+        _self.session_partials.reset()
+        _self.rollups.reset()
+        with _self._device_index_lock:
+            _self.device_index = None
+            _self._device_index_generation += 1
+
+    def device_index_is_fresh(_self) -> bool:
+        return _self._fresh_device_index() is not None
+
+    def _fresh_device_index(_self):
+        device_index = _self.device_index
+        if device_index is None:
+            return None
+        index, built_at = device_index
+        ttl = _self.cache.ttls.get("device_index", _self.cache.default_ttl)
+        return index if time.monotonic() - built_at < ttl else None
+
+    def get_indexed_device_details(_self, deviceToken: str):
+        index = _self._fresh_device_index()
+        if index is None:
+            return None
+
+        timestamps, timestamp_slices = index["timestamps"]
+        session_stats, session_stat_slices = index["session_stats"]
+        if deviceToken not in timestamp_slices and deviceToken not in session_stat_slices:
+            return None
+
+        return {
+            "timestamps": timestamps.iloc[timestamp_slices.get(deviceToken, slice(0, 0))].reset_index(drop=True),
+            "session_stats": session_stats.iloc[session_stat_slices.get(deviceToken, slice(0, 0))].reset_index(drop=True),
+        }
+
+    @instrumented
+    def prefetch_device_details(_self) -> None:
+        # Runs the two "Fetch more" queries once for all devices and indexes the results by DEVICE_TOKEN. The queries
+        # run outside the lock, concurrent prefetches share them through the cache
+        if _self.device_index_is_fresh():
+            return
+        generation = _self._device_index_generation
+
+        try:
+            timestamps = _self.fetch_data("device_index_latest_events")
+            session_stats = _self.fetch_data("device_index_session_duration_stats")
+        except:
+            raise
+
+        index = {
+            "timestamps": index_by_device_token(timestamps),
+            "session_stats": index_by_device_token(session_stats),
+        }
+        with _self._device_index_lock:
+            if generation == _self._device_index_generation: # not cleared while it ran
+                _self.device_index = (index, time.monotonic())
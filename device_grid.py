@@ -0,0 +1,83 @@
+from typing import NamedTuple, Optional
+
+import numpy as np
+import pandas as pd
+
+ID_COLUMNS = ("DEVICE_NAME", "DEVICE_TOKEN")
+
+
+class GridPage(NamedTuple):
+    rows: pd.DataFrame # only the rows of the requested page
+    total_rows: int # rows matching the search and filter, over all pages
+    page: int # clamped to the pages that exist
+    page_count: int
+
+
+class DeviceGrid:
+    """Server side model of the device event table.
+
+    The full table stays here and the browser only gets one page of it. Search, filter and sort run
+    against precomputed search keys and cached sort orders, so paging through a large fleet does not
+    reserialize the table. Rows are identified by DEVICE_TOKEN rather than by position.
+    """
+
+    def __init__(self, frame: pd.DataFrame) -> None:
+        self.frame = frame.reset_index(drop=True)
+        self.event_columns = [column for column in self.frame.columns if column not in ID_COLUMNS]
+
+        # lower cased "name token" per row for the quick search, as one fixed width array of UTF-8 bytes that
+        # np.char.find scans in C. A UTF-8 substring is also a byte substring, so matches are the same as on text
+        name, token = (self.frame[column].fillna("").astype(str).str.lower() for column in ID_COLUMNS)
+        self._search_keys = np.array((name + " " + token).str.encode("utf-8").tolist(), dtype=bytes)
+        self._positions = pd.Series(np.arange(len(self.frame)), index=self.frame["DEVICE_TOKEN"].astype(str))
+        self._orders = {} # (column, ascending) -> row positions in sort order
+        self._last_match = (None, None) # (search, filter_event) -> boolean mask, paging reuses it
+
+    def __len__(self) -> int:
+        return len(self.frame)
+
+    def row(self, token: str) -> Optional[pd.Series]:
+        # the device row of a token, None when the token is not in the table
+        positions = self._positions.get(token)
+        if positions is None:
+            return None
+        position = positions if np.isscalar(positions) else positions.iloc[0]
+        return self.frame.iloc[int(position)]
+
+    def page(self, page: int = 0, page_size: int = 50, search: str = "", sort_by: str = None,
+             ascending: bool = True, filter_event: str = None) -> GridPage:
+        mask = self._match(search.strip().lower(), filter_event)
+        order = self._order(sort_by, ascending)
+        if mask is not None:
+            order = order[mask[order]]
+
+        total_rows = len(order)
+        page_count = max(1, -(-total_rows // page_size))
+        page = min(max(page, 0), page_count - 1)
+        rows = self.frame.iloc[order[page * page_size:(page + 1) * page_size]].reset_index(drop=True)
+        return GridPage(rows, total_rows, page, page_count)
+
+    def _match(self, search: str, filter_event: Optional[str]) -> Optional[np.ndarray]:
+        # rows containing the search text and with at least one filter_event, None when everything matches
+        if not search and filter_event is None:
+            return None
+        key, mask = self._last_match
+        if key == (search, filter_event):
+            return mask
+
+        mask = np.ones(len(self.frame), dtype=bool)
+        if search:
+            mask &= np.char.find(self._search_keys, search.encode("utf-8")) >= 0
+        if filter_event is not None:
+            mask &= self.frame[filter_event].to_numpy() > 0
+        self._last_match = ((search, filter_event), mask)
+        return mask
+
+    def _order(self, sort_by: Optional[str], ascending: bool) -> np.ndarray:
+        if sort_by is None:
+            return np.arange(len(self.frame))
+        order = self._orders.get((sort_by, ascending))
+        if order is None:
+            order = self.frame[sort_by].sort_values(ascending=ascending, kind="stable").index.to_numpy()
+            self._orders[(sort_by, ascending)] = order
+        return order
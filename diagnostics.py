@@ -0,0 +1,83 @@
+import json
+import threading
+import time
+from collections import deque
+from dataclasses import asdict, dataclass
+from typing import Optional
+
+import pandas as pd
+
+@dataclass
+class QueryRecord:
+    timestamp: float # epoch seconds when the call started
+    method: str # Data_fetcher method that asked for the data
+    statement: str
+    fingerprint: str
+    env: str
+    query_id: Optional[str] = None # warehouse query ID, None on cache hits
+    cache_hit: bool = False
+    queue_ms: float = 0.0 # waiting for a pooled connection and a scheduler slot
+    execute_ms: float = 0.0
+    fetch_ms: float = 0.0
+    build_ms: float = 0.0 # DataFrame build from the fetched batches
+    total_ms: float = 0.0
+    rows: int = 0
+    result_bytes: Optional[int] = None # only measured on cache misses
+    error: Optional[str] = None
+
+
+class QueryLog:
+    """Rolling in-process store of the last max_records query records"""
+
+    def __init__(self, max_records: int = 2000) -> None:
+        self._records = deque(maxlen=max_records)
+        self._lock = threading.Lock()
+
+    def add(self, record: QueryRecord) -> None:
+        with self._lock:
+            self._records.append(record)
+
+    def records(self, last: Optional[int] = None) -> list:
+        with self._lock:
+            records = list(self._records)
+        return records if last is None else records[-last:]
+
+    def to_jsonl(self, last: Optional[int] = None) -> str:
+        return "".join(json.dumps(asdict(record)) + "\n" for record in self.records(last))
+
+    def to_frame(self, last: Optional[int] = None) -> pd.DataFrame:
+        return pd.DataFrame([asdict(record) for record in self.records(last)], columns=list(QueryRecord.__dataclass_fields__))
+
+    def latency_summary(self, last: Optional[int] = None) -> pd.DataFrame:
+        # p50/p95 latencies per method over the last runs
+        df = self.to_frame(last)
+        if len(df) == 0:
+            return pd.DataFrame(columns=["method", "calls", "cache_hit_rate", "errors", "p50_ms", "p95_ms", "p50_execute_ms", "p95_execute_ms", "avg_rows"])
+
+        grouped = df.groupby("method")
+        summary = pd.DataFrame({
+            "calls": grouped.size(),
+            "cache_hit_rate": grouped["cache_hit"].mean(),
+            "errors": grouped["error"].count(),
+            "p50_ms": grouped["total_ms"].quantile(0.5),
+            "p95_ms": grouped["total_ms"].quantile(0.95),
+            "p50_execute_ms": grouped["execute_ms"].quantile(0.5),
+            "p95_execute_ms": grouped["execute_ms"].quantile(0.95),
+            "avg_rows": grouped["rows"].mean(),
+        })
+        return summary.sort_values("p95_ms", ascending=False).reset_index()
+
+
+class Stopwatch: # accumulates phase durations in milliseconds into a dict
+    def __init__(self, timings: Optional[dict], phase: str) -> None:
+        self.timings = timings
+        self.phase = phase
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        if self.timings is not None:
+            self.timings[self.phase] = self.timings.get(self.phase, 0.0) + (time.perf_counter() - self.start) * 1000
+        return False
@@ -0,0 +1,90 @@
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+import pyarrow.parquet as pq
+
+from queries import BoundStatement
+
+# format -> (mime type, file suffix)
+EXPORT_FORMATS = {
+    "parquet": ("application/vnd.apache.parquet", ".parquet"),
+    "csv": ("text/csv", ".csv"),
+}
+
+FALLBACK_BATCH_ROWS = 100_000 # rows per batch for cursors without arrow batches
+
+
+def _export_schema(schema: pa.Schema) -> pa.Schema:
+    # Batches of one result can differ in integer and float widths (Snowflake sizes them per batch),
+    # so every batch is written with the widest type of its kind
+    fields = []
+    for field in schema:
+        if pa.types.is_integer(field.type):
+            field = field.with_type(pa.int64())
+        elif pa.types.is_floating(field.type):
+            field = field.with_type(pa.float64())
+        fields.append(field.with_nullable(True))
+    return pa.schema(fields)
+
+
+def _cursor_batches(cursor):
+    # arrow tables of an executed cursor, falling back to fetchmany for cursors without arrow support
+    names = [desc[0] for desc in cursor.description]
+    fetch_batches = getattr(cursor, "fetch_arrow_batches", None)
+    if fetch_batches is not None:
+        try:
+            for table in fetch_batches():
+                yield table.rename_columns(names)
+            return
+        except NotImplementedError:
+            pass
+        except Exception as e: # e.g. snowflake NotSupportedError when the result is not in arrow format
+            if type(e).__name__ != "NotSupportedError":
+                raise
+
+    while True:
+        rows = cursor.fetchmany(FALLBACK_BATCH_ROWS)
+        if not rows:
+            return
+        yield pa.Table.from_pylist([dict(zip(names, row)) for row in rows])
+
+
+class _BatchWriter:
+    """Parquet or CSV writer opened with the schema of the first batch"""
+
+    def __init__(self, sink, fmt: str) -> None:
+        if fmt not in EXPORT_FORMATS:
+            raise ValueError(f"Unknown export format '{fmt}'")
+        self.sink = sink
+        self.fmt = fmt
+        self.schema = None
+        self._writer = None
+
+    def write(self, table: pa.Table) -> None:
+        if self._writer is None:
+            self.schema = _export_schema(table.schema)
+            if self.fmt == "parquet":
+                self._writer = pq.ParquetWriter(self.sink, self.schema, compression="zstd")
+            else:
+                self._writer = pa_csv.CSVWriter(self.sink, self.schema)
+        self._writer.write_table(table.cast(self.schema))
+
+    def close(self, names: list) -> None:
+        if self._writer is None: # no batches, still a valid file with the result's columns
+            self.write(pa.table({name: pa.array([], pa.string()) for name in names}))
+        self._writer.close()
+
+
+def export_statement(backend, statement: BoundStatement, sink, fmt: str = "parquet", timeout: float = None) -> int:
+    # Runs statement through the backend, under its query scheduler when it has one, and writes the result to
+    # sink (a path or a binary file object) batch by batch, so only one batch is in memory at a time. Returns
+    # the number of rows written
+    def export(cursor):
+        rows = 0
+        writer = _BatchWriter(sink, fmt)
+        for table in _cursor_batches(cursor):
+            writer.write(table)
+            rows += table.num_rows
+        writer.close([desc[0] for desc in cursor.description])
+        return rows
+
+    return backend.stream(statement, export, timeout=timeout)
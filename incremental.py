@@ -0,0 +1,58 @@
+import threading
+import time
+from typing import Callable, Optional
+
+import pandas as pd
+
+class PartialAggregateStore:
+    """Per-day partial aggregates of one query family plus the max event_timestamp seen so far"""
+
+    def __init__(self, day_column: str, timestamp_column: str, trailing_window: pd.Timedelta,
+                 retention: Optional[pd.DateOffset] = None, min_refresh_interval: float = 0.0) -> None:
+        self.day_column = day_column
+        self.timestamp_column = timestamp_column
+        self.trailing_window = trailing_window # re-pulled on every refresh to pick up late-arriving events
+        self.retention = retention # days older than now - retention are dropped locally
+        self.min_refresh_interval = min_refresh_interval # seconds
+
+        self.partials = None
+        self.watermark = None
+        self._last_refresh = None
+        self._lock = threading.Lock()
+
+    def refresh(self, fetch: Callable[[Optional[pd.Timestamp]], pd.DataFrame]) -> pd.DataFrame:
+        # fetch(since) must return every row with event_timestamp >= since, or full history when since is None
+        with self._lock:
+            if self._last_refresh is not None and time.monotonic() - self._last_refresh < self.min_refresh_interval:
+                return self.partials
+
+            since = None
+            if self.watermark is not None:
+                since = (self.watermark - self.trailing_window).floor("D") # whole days, so re-pulled days replace stored ones
+
+            new = fetch(since)
+
+            if since is None or self.partials is None:
+                partials = new
+            else:
+                kept = self.partials[self.partials[self.day_column] < since]
+                partials = pd.concat([kept, new], ignore_index=True) if len(kept) > 0 else new
+
+            if self.retention is not None and len(partials) > 0:
+                days = partials[self.day_column]
+                cutoff = pd.Timestamp.now(tz=getattr(days.dt, "tz", None)).normalize() - self.retention
+                partials = partials[days >= cutoff].reset_index(drop=True)
+
+            if len(new) > 0:
+                new_max = new[self.timestamp_column].max()
+                self.watermark = new_max if self.watermark is None else max(self.watermark, new_max)
+
+            self.partials = partials
+            self._last_refresh = time.monotonic()
+            return partials
+
+    def reset(self) -> None:
+        with self._lock:
+            self.partials = None
+            self.watermark = None
+            self._last_refresh = None
@@ -0,0 +1,76 @@
+import threading
+
+import duckdb
+import pyarrow as pa
+
+# Flattened ACCOUNT_EVENTS as the local engine sees it. JSON fields the dashboard reads are plain columns
+ACCOUNT_EVENTS_COLUMNS = [
+    "GAME_NAME", "ENVIRONMENT_NAME", "EVENT_NAME", "EVENT_TIMESTAMP", "DEVICE_NAME", "DEVICE_TOKEN", "SESSION_ID",
+]
+
+
+def _identifier(name: str) -> str:
+    return name.upper() if name == name.lower() else name
+
+
+class LocalCursor:
+    """DB-API style cursor over a duckdb connection that hands results out as arrow batches.
+
+    Column names are upper cased, like Snowflake does for unquoted identifiers. Mixed case names can only
+    come from quoted identifiers in our statements and are kept as they are.
+    """
+
+    def __init__(self, con: duckdb.DuckDBPyConnection, batch_size: int = 1_000_000) -> None:
+        self._con = con
+        self.batch_size = batch_size
+        self.description = None
+        self.sfqid = None
+
+    def execute(self, query: str, params=None, timeout: float = None):
+        # timeout: seconds after which the query is interrupted, like the Snowflake connector's
+        timer = threading.Timer(timeout, self._con.interrupt) if timeout is not None else None
+        if timer is not None:
+            timer.start()
+        try:
+            self._con.execute(query, list(params or []))
+        finally:
+            if timer is not None:
+                timer.cancel()
+        self.description = [(_identifier(desc[0]),) + tuple(desc[1:]) for desc in self._con.description]
+        return self
+
+    def fetch_arrow_batches(self):
+        names = [desc[0] for desc in self.description]
+        reader = self._con.fetch_record_batch(self.batch_size)
+        for batch in reader:
+            yield pa.Table.from_batches([batch]).rename_columns(names)
+
+    def fetchall(self) -> list:
+        return self._con.fetchall()
+
+    def close(self) -> None:
+        pass
+
+
+class LocalConnection:
+    """One duckdb connection per pooled connection, all sharing the same database"""
+
+    def __init__(self, con: duckdb.DuckDBPyConnection) -> None:
+        self._con = con
+
+    def cursor(self) -> LocalCursor:
+        return LocalCursor(self._con)
+
+    def is_closed(self) -> bool:
+        return False
+
+    def cancel(self) -> None: # interrupts the query running on this connection, from another thread
+        self._con.interrupt()
+
+    def close(self) -> None:
+        self._con.close()
+
+
+def connect(database: duckdb.DuckDBPyConnection):
+    # connect function for a ConnectionPool, duckdb cursors are independent connections to one database
+    return lambda: LocalConnection(database.cursor())
@@ -0,0 +1,501 @@
+import hashlib
+import re
+from datetime import datetime
+from typing import NamedTuple
+
+GAME_NAME = "The Experience"
+STARTED_EVENTS = ("gameStarted", "experienceStarted", "perfectServingStarted", "breweryIngredientsStarted", "artOfBrewingStarted")
+STARTED_EVENT_COLUMNS = tuple(sorted(STARTED_EVENTS)) # one count column per started event in the pivoted statements
+SERIES_GRAINS = ("hour", "day") # bucket sizes of the session duration series statements
+EPOCH = datetime(1970, 1, 1) # "since" of a first incremental load
+
+# Parameters every statement may use without the caller passing them
+DEFAULT_PARAMS = {
+    "game_name": GAME_NAME,
+    "started_events": STARTED_EVENTS,
+}
+
+# Shared SQL fragments, written as {name} in statement templates
+SNOWFLAKE_FRAGMENTS = {
+    "device_name": "EVENT_JSON:deviceName::STRING",
+    "device_token": "EVENT_JSON:deviceToken::STRING",
+    "session_id": "EVENT_JSON:sessionID::STRING",
+    "last_month": "DATEADD('month', -1, CURRENT_DATE)",
+    "game_env_filter": "game_name = :game_name AND environment_name = :env",
+    "game_envs_filter": "game_name = :game_name AND environment_name IN (:envs)", # comparison mode, several environments
+    "started_filter": "event_name IN (:started_events)",
+    # conditional aggregation, one integer count column per started event. Quoted so the column keeps the event's name
+    "started_event_counts": ",\n                ".join(
+        f"COUNT(CASE WHEN event_name = '{event}' THEN 1 END) AS \"{event}\"" for event in STARTED_EVENT_COLUMNS
+    ),
+}
+
+# Local embedded engine (duckdb) over a flattened ACCOUNT_EVENTS with DEVICE_NAME, DEVICE_TOKEN and SESSION_ID columns
+DUCKDB_FRAGMENTS = {
+    **SNOWFLAKE_FRAGMENTS,
+    "device_name": "DEVICE_NAME",
+    "device_token": "DEVICE_TOKEN",
+    "session_id": "SESSION_ID",
+    "last_month": "(CURRENT_DATE - INTERVAL 1 MONTH)",
+}
+
+DIALECTS = {
+    "snowflake": SNOWFLAKE_FRAGMENTS,
+    "duckdb": DUCKDB_FRAGMENTS,
+}
+
+# :name bind variables. Not preceded by a word character or colon, so JSON paths (EVENT_JSON:deviceToken) and casts (::STRING) are left alone
+_PARAM_PATTERN = re.compile(r"(?<![\w:]):([A-Za-z_]\w*)")
+
+
+class BoundStatement(NamedTuple):
+    name: str
+    family: str
+    sql: str # qmark style, one ? per bound value
+    params: tuple
+    fingerprint: str # identifies the statement text, the same for every parameter value
+
+
+class Statement(NamedTuple):
+    name: str
+    family: str # query family, used for cache TTLs and invalidation
+    template: str
+
+    def bind(self, fragments: dict = SNOWFLAKE_FRAGMENTS, **params) -> BoundStatement:
+        values = {**DEFAULT_PARAMS, **params}
+        sql = self.template.format(**fragments)
+
+        bound = []
+        def placeholder(match):
+            name = match.group(1)
+            if name not in values:
+                raise KeyError(f"Statement '{self.name}' is missing parameter '{name}'")
+            value = values[name]
+            if isinstance(value, (list, tuple)): # IN lists expand to one bind variable per element
+                bound.extend(value)
+                return ", ".join("?" * len(value))
+            bound.append(value)
+            return "?"
+
+        sql = _PARAM_PATTERN.sub(placeholder, sql)
+        fingerprint = hashlib.sha1(" ".join(sql.split()).encode()).hexdigest()[:16]
+        return BoundStatement(self.name, self.family, sql, tuple(bound), fingerprint)
+
+
+# Columns the session duration statistics can be broken down by
+_STATS_GROUP_COLUMNS = {"device_token": "{device_token}", "environment_name": "environment_name"}
+
+
+def _session_duration_stats(device_filter: str, by: str = None, env_filter: str = "{game_env_filter}") -> str:
+    # Daily count, mean, min, max and percentiles of session durations over the last month, plus summary rows.
+    # With by, per device_token or environment_name, one summary row each
+    by_column = f"{_STATS_GROUP_COLUMNS[by]} AS {by}," if by else ""
+    by_group = f"{_STATS_GROUP_COLUMNS[by]}," if by else ""
+    by_select = f"{by}," if by else ""
+    grouping_sets = f"(({by}, session_date), ({by}))" if by else "((session_date), ())"
+    return f'''
+            WITH session_data AS (
+            SELECT
+                {by_column}
+                {{session_id}} AS session_id,
+                DATE_TRUNC('day', event_timestamp) AS session_date,
+                MIN(event_timestamp) AS session_start_time,
+                MAX(event_timestamp) AS session_end_time
+            FROM
+                ACCOUNT_EVENTS
+            WHERE
+                {env_filter}
+                {device_filter}
+                AND {{session_id}} IS NOT NULL
+                AND event_timestamp >= {{last_month}}
+            GROUP BY
+                {by_group} {{session_id}}, DATE_TRUNC('day', event_timestamp)
+            ),
+            durations AS (
+            SELECT
+                {by_select}
+                session_date,
+                DATEDIFF('minute', session_start_time, session_end_time) AS session_duration
+            FROM
+                session_data
+            WHERE
+                DATEDIFF('minute', session_start_time, session_end_time) > 0
+            )
+            SELECT
+                {by_select}
+                session_date,
+                COUNT(*) AS session_count,
+                AVG(session_duration) AS avg_duration,
+                MIN(session_duration) AS min_duration,
+                MAX(session_duration) AS max_duration,
+                PERCENTILE_CONT(0.5) WITHIN GROUP (ORDER BY session_duration) AS p50_duration,
+                PERCENTILE_CONT(0.9) WITHIN GROUP (ORDER BY session_duration) AS p90_duration,
+                PERCENTILE_CONT(0.99) WITHIN GROUP (ORDER BY session_duration) AS p99_duration,
+                GROUPING(session_date) AS is_summary
+            FROM
+                durations
+            GROUP BY GROUPING SETS {grouping_sets}
+            ORDER BY
+                {by_select} is_summary, session_date
+            '''
+
+
+def _session_duration_series(grain: str, device_filter: str) -> str:
+    # Session count and average duration per hour or day of session start, between :since and :until
+    return f'''
+            WITH session_data AS (
+            SELECT
+                {{session_id}} AS session_id,
+                MIN(event_timestamp) AS session_start_time,
+                MAX(event_timestamp) AS session_end_time
+            FROM
+                ACCOUNT_EVENTS
+            WHERE
+                {{game_env_filter}}
+                {device_filter}
+                AND {{session_id}} IS NOT NULL
+                AND event_timestamp >= :since
+                AND event_timestamp < :until
+            GROUP BY
+                {{session_id}}, DATE_TRUNC('day', event_timestamp)
+            )
+            SELECT
+                DATE_TRUNC('{grain}', session_start_time) AS session_bucket,
+                COUNT(*) AS session_count,
+                AVG(DATEDIFF('minute', session_start_time, session_end_time)) AS avg_duration
+            FROM
+                session_data
+            WHERE
+                DATEDIFF('minute', session_start_time, session_end_time) > 0
+            GROUP BY
+                DATE_TRUNC('{grain}', session_start_time)
+            ORDER BY
+                session_bucket
+            '''
+
+
+_SESSION_DURATIONS = '''
+            WITH session_data AS (
+            SELECT
+                {session_id} AS session_id,
+                DATE_TRUNC('day', event_timestamp) AS session_date,
+                MIN(event_timestamp) AS session_start_time,
+                MAX(event_timestamp) AS session_end_time
+            FROM
+                ACCOUNT_EVENTS
+            WHERE
+                {game_env_filter}
+                %s
+                AND {session_id} IS NOT NULL
+                AND event_timestamp >= {last_month}
+            GROUP BY
+                {session_id}, DATE_TRUNC('day', event_timestamp)
+            )
+            SELECT
+                session_date,
+                DATEDIFF('minute', session_start_time, session_end_time) AS session_duration
+            FROM
+                session_data
+            WHERE
+                DATEDIFF('minute', session_start_time, session_end_time) > 0
+            '''
+
+
+STATEMENTS = {statement.name: statement for statement in [
+
+    Statement("started_event_counts", "events", '''
+            SELECT
+                {device_name} AS device_name,
+                {device_token} AS device_token,
+                {started_event_counts}
+            FROM
+                account_events
+            WHERE
+                {game_env_filter}
+            AND
+                {started_filter}
+            GROUP BY
+                {device_name},
+                {device_token}
+            '''),
+
+    Statement("started_event_partials", "events", '''
+            SELECT
+                DATE_TRUNC('day', event_timestamp) AS event_date,
+                {device_name} AS device_name,
+                {device_token} AS device_token,
+                {started_event_counts},
+                MAX(event_timestamp) AS last_event_timestamp
+            FROM
+                account_events
+            WHERE
+                {game_env_filter}
+            AND
+                {started_filter}
+            AND
+                event_timestamp >= :since
+            GROUP BY
+                DATE_TRUNC('day', event_timestamp),
+                {device_name},
+                {device_token}
+            '''),
+
+    # Comparison mode: started event counts of several environments in one scan, with their ENVIRONMENT_NAME
+    Statement("env_started_event_counts", "events", '''
+            SELECT
+                environment_name AS environment_name,
+                {device_name} AS device_name,
+                {device_token} AS device_token,
+                {started_event_counts}
+            FROM
+                account_events
+            WHERE
+                {game_envs_filter}
+            AND
+                {started_filter}
+            GROUP BY
+                environment_name,
+                {device_name},
+                {device_token}
+            '''),
+
+    Statement("session_durations", "sessions", _SESSION_DURATIONS % ""),
+
+    Statement("session_partials", "sessions", '''
+            WITH session_data AS (
+            SELECT
+                {session_id} AS session_id,
+                DATE_TRUNC('day', event_timestamp) AS session_date,
+                MIN(event_timestamp) AS session_start_time,
+                MAX(event_timestamp) AS session_end_time
+            FROM
+                ACCOUNT_EVENTS
+            WHERE
+                {game_env_filter}
+                AND {session_id} IS NOT NULL
+                AND event_timestamp >= {last_month}
+                AND event_timestamp >= :since
+            GROUP BY
+                {session_id}, DATE_TRUNC('day', event_timestamp)
+            )
+            SELECT
+                session_date,
+                DATEDIFF('minute', session_start_time, session_end_time) AS session_duration,
+                session_end_time AS last_event_timestamp
+            FROM
+                session_data
+            '''),
+
+    # Raw events for the local sessionization engine (sessionize.py), no grouping by session ID and day
+    Statement("session_events", "sessions", '''
+            SELECT
+                {device_token} AS device_token,
+                {session_id} AS session_id,
+                event_name AS event_name,
+                event_timestamp AS event_timestamp
+            FROM
+                ACCOUNT_EVENTS
+            WHERE
+                {game_env_filter}
+                AND event_timestamp >= :since
+            '''),
+
+    Statement("session_duration_stats", "sessions", _session_duration_stats("")),
+
+    Statement("env_session_duration_stats", "sessions",
+              _session_duration_stats("", by="environment_name", env_filter="{game_envs_filter}")),
+
+    *[Statement(f"session_duration_series_{grain}", "sessions", _session_duration_series(grain, ""))
+      for grain in SERIES_GRAINS],
+
+    Statement("device_latest_events", "device", '''
+            SELECT
+                EVENT_NAME,
+                MAX(event_timestamp) AS latest_event_timestamp
+            FROM
+                account_events
+            WHERE
+                {game_env_filter}
+                AND {device_token} = :device_token
+                AND {started_filter}
+            GROUP BY
+                EVENT_NAME
+            ORDER BY
+                latest_event_timestamp DESC
+            '''),
+
+    Statement("device_session_durations", "device", _SESSION_DURATIONS % "AND {device_token} = :device_token"),
+
+    Statement("device_session_duration_stats", "device",
+              _session_duration_stats("AND {device_token} = :device_token")),
+
+    *[Statement(f"device_session_duration_series_{grain}", "device",
+                _session_duration_series(grain, "AND {device_token} = :device_token"))
+      for grain in SERIES_GRAINS],
+
+    Statement("device_index_latest_events", "device_index", '''
+            SELECT
+                {device_token} AS device_token,
+                EVENT_NAME,
+                MAX(event_timestamp) AS latest_event_timestamp
+            FROM
+                account_events
+            WHERE
+                {game_env_filter}
+                AND {device_token} IS NOT NULL
+                AND {started_filter}
+            GROUP BY
+                {device_token}, EVENT_NAME
+            ORDER BY
+                device_token, latest_event_timestamp DESC
+            '''),
+
+    Statement("device_index_session_duration_stats", "device_index",
+              _session_duration_stats("AND {device_token} IS NOT NULL", by="device_token")),
+
+    Statement("rollup_event_counts", "rollups", '''
+            SELECT
+                DATE_TRUNC('hour', event_timestamp) AS period_start,
+                {device_name} AS device_name,
+                {device_token} AS device_token,
+                {started_event_counts},
+                MAX(event_timestamp) AS last_event_timestamp
+            FROM
+                account_events
+            WHERE
+                {game_env_filter}
+            AND
+                {started_filter}
+            AND
+                event_timestamp >= :since
+            GROUP BY
+                DATE_TRUNC('hour', event_timestamp),
+                {device_name},
+                {device_token}
+            '''),
+
+    # Hourly log-bucket sketches of session durations, see rollups.py. Bin of a duration d is CEIL(LN(d) / :log_gamma)
+    Statement("rollup_session_sketches", "rollups", '''
+            WITH session_data AS (
+            SELECT
+                MAX({device_token}) AS device_token,
+                MIN(event_timestamp) AS session_start_time,
+                MAX(event_timestamp) AS session_end_time
+            FROM
+                ACCOUNT_EVENTS
+            WHERE
+                {game_env_filter}
+                AND {session_id} IS NOT NULL
+                AND event_timestamp >= :since
+            GROUP BY
+                {session_id}, DATE_TRUNC('day', event_timestamp)
+            ),
+            durations AS (
+            SELECT
+                device_token,
+                DATE_TRUNC('hour', session_start_time) AS period_start,
+                DATEDIFF('minute', session_start_time, session_end_time) AS session_duration,
+                CEIL(LN(DATEDIFF('minute', session_start_time, session_end_time)) / :log_gamma) AS duration_bin,
+                session_end_time
+            FROM
+                session_data
+            WHERE
+                DATEDIFF('minute', session_start_time, session_end_time) > 0
+            )
+            SELECT
+                period_start,
+                device_token,
+                duration_bin,
+                COUNT(*) AS session_count,
+                SUM(session_duration) AS duration_sum,
+                MIN(session_duration) AS min_duration,
+                MAX(session_duration) AS max_duration,
+                MAX(session_end_time) AS last_event_timestamp
+            FROM
+                durations
+            GROUP BY
+                period_start, device_token, duration_bin
+            '''),
+
+    # Exports, streamed to a file rather than cached. Full history, not only the last month
+    Statement("export_session_durations", "export", '''
+            SELECT
+                MAX({device_name}) AS device_name,
+                MAX({device_token}) AS device_token,
+                {session_id} AS session_id,
+                DATE_TRUNC('day', event_timestamp) AS session_date,
+                MIN(event_timestamp) AS session_start_time,
+                MAX(event_timestamp) AS session_end_time,
+                DATEDIFF('minute', MIN(event_timestamp), MAX(event_timestamp)) AS session_duration
+            FROM
+                ACCOUNT_EVENTS
+            WHERE
+                {game_env_filter}
+                AND {session_id} IS NOT NULL
+            GROUP BY
+                {session_id}, DATE_TRUNC('day', event_timestamp)
+            ORDER BY
+                session_date, session_start_time
+            '''),
+
+    Statement("account_events_extract", "extract", '''
+            SELECT
+                game_name AS game_name,
+                environment_name AS environment_name,
+                event_name AS event_name,
+                event_timestamp AS event_timestamp,
+                {device_name} AS device_name,
+                {device_token} AS device_token,
+                {session_id} AS session_id
+            FROM
+                account_events
+            WHERE
+                game_name = :game_name
+            '''),
+]}
+
+
+# Result column types, applied by Data_fetcher when it builds a frame. Columns not listed keep the engine's type
+CATEGORY = "category" # low cardinality names
+COUNT = "count" # integers, stored in the smallest integer type that fits
+TIMESTAMP = "timestamp" # datetime64
+
+_STARTED_COUNTS = {event: COUNT for event in STARTED_EVENT_COLUMNS}
+_SESSION_DURATIONS_SCHEMA = {"SESSION_DATE": TIMESTAMP, "SESSION_DURATION": COUNT}
+_DURATION_STATS_SCHEMA = {
+    "SESSION_DATE": TIMESTAMP,
+    "SESSION_COUNT": COUNT,
+    "MIN_DURATION": COUNT,
+    "MAX_DURATION": COUNT,
+    "IS_SUMMARY": COUNT,
+}
+_SERIES_SCHEMA = {"SESSION_BUCKET": TIMESTAMP, "SESSION_COUNT": COUNT}
+_LATEST_EVENTS_SCHEMA = {"EVENT_NAME": CATEGORY, "LATEST_EVENT_TIMESTAMP": TIMESTAMP}
+
+RESULT_SCHEMAS = {
+    "started_event_counts": _STARTED_COUNTS,
+    "started_event_partials": {**_STARTED_COUNTS, "EVENT_DATE": TIMESTAMP, "LAST_EVENT_TIMESTAMP": TIMESTAMP},
+    "session_durations": _SESSION_DURATIONS_SCHEMA,
+    "session_partials": {**_SESSION_DURATIONS_SCHEMA, "LAST_EVENT_TIMESTAMP": TIMESTAMP},
+    "session_duration_stats": _DURATION_STATS_SCHEMA,
+    "session_events": {"DEVICE_TOKEN": CATEGORY, "SESSION_ID": CATEGORY, "EVENT_NAME": CATEGORY, "EVENT_TIMESTAMP": TIMESTAMP},
+    "env_started_event_counts": {**_STARTED_COUNTS, "ENVIRONMENT_NAME": CATEGORY},
+    "env_session_duration_stats": {**_DURATION_STATS_SCHEMA, "ENVIRONMENT_NAME": CATEGORY},
+    **{f"session_duration_series_{grain}": _SERIES_SCHEMA for grain in SERIES_GRAINS},
+    **{f"device_session_duration_series_{grain}": _SERIES_SCHEMA for grain in SERIES_GRAINS},
+    "device_latest_events": _LATEST_EVENTS_SCHEMA,
+    "rollup_event_counts": {**_STARTED_COUNTS, "PERIOD_START": TIMESTAMP, "LAST_EVENT_TIMESTAMP": TIMESTAMP},
+    "rollup_session_sketches": {
+        "PERIOD_START": TIMESTAMP,
+        "DURATION_BIN": COUNT,
+        "SESSION_COUNT": COUNT,
+        "DURATION_SUM": COUNT,
+        "MIN_DURATION": COUNT,
+        "MAX_DURATION": COUNT,
+        "LAST_EVENT_TIMESTAMP": TIMESTAMP,
+    },
+    "device_session_durations": _SESSION_DURATIONS_SCHEMA,
+    "device_session_duration_stats": _DURATION_STATS_SCHEMA,
+    "device_index_latest_events": {"DEVICE_TOKEN": CATEGORY, **_LATEST_EVENTS_SCHEMA},
+    "device_index_session_duration_stats": {"DEVICE_TOKEN": CATEGORY, **_DURATION_STATS_SCHEMA},
+}
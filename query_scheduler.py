@@ -0,0 +1,421 @@
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Callable, Optional
+
+import pandas as pd
+from data_fetcher import execute_query, frame_from_cursor
+from diagnostics import Stopwatch
+
+class QueryCancelled(Exception):
+    """The query was cancelled because its group was cancelled or went away"""
+
+class QueryTimeout(Exception):
+    """The query ran longer than its timeout and was cancelled"""
+
+
+class _PendingQuery:
+    """A query submitted with submit_query, from its submission until its future is resolved"""
+
+    def __init__(self, conn, query: str, params: tuple, timeout: float, timings: Optional[dict],
+                 group: Optional[str], transform: Optional[Callable]) -> None:
+        self.conn = conn
+        self.query = query
+        self.params = params
+        self.timeout = timeout
+        self.timings = timings
+        self.transform = transform # applied to the frame on the fetch worker, before the future resolves
+        self.groups = set() if group is None else {group} # groups that still want the result, see join
+        self.pinned = group is None # wanted by a caller without a group, never cancelled with one
+        self.future = Future()
+        self.state = "queued" # queued -> starting -> running -> fetching -> done
+        self.cancelled = None # cancel that arrived while starting, sent once the query has an ID
+        self.cursor = None
+        self.query_id = None
+        self.submitted = time.perf_counter()
+        self.started = None
+        self.deadline = None
+
+
+class _RunningQuery:
+
+    def __init__(self, conn, group: Optional[str]) -> None:
+        self.conn = conn
+        self.group = group
+        self.cancelled = None # the error to raise instead of the connector's, once cancelled
+        self.finished = False
+        self.lock = threading.Lock() # a cancel is sent before the connection can go back to the pool
+
+
+def _abort(conn) -> None:
+    # cancels what runs on conn, from another thread. Local engines interrupt their connection, Snowflake cancels
+    # the queries of the connection's session, which only runs this one
+    cancel = getattr(conn, "cancel", None)
+    if cancel is not None:
+        cancel()
+        return
+    cursor = conn.cursor()
+    try:
+        cursor.execute("SELECT SYSTEM$CANCEL_ALL_QUERIES(?)", (conn.session_id,))
+    finally:
+        cursor.close()
+
+
+def _runs_async(conn) -> bool: # Snowflake connections, local engines only run queries synchronously
+    return hasattr(conn, "get_query_status_throw_if_error")
+
+
+class QueryScheduler:
+    """Process wide scheduler for dashboard queries.
+
+    Warehouse queries are submitted asynchronously (server side query IDs) and one poller thread checks
+    all of them for completion, so no thread waits while a query runs. Finished results are fetched on a
+    small pool of fetch workers. A global cap limits how many queries every session together has
+    running, submissions past it queue without holding a thread. Dashboard calls run on one small shared
+    worker pool instead of a new executor per call.
+
+    Cancelling a group, the browser session of a group going away, or a query running past its timeout
+    cancels it in the warehouse. Local engines cannot run queries asynchronously, they run on the
+    calling worker and are cancelled by interrupting their connection.
+    """
+
+    def __init__(self, max_concurrent_queries: int = 8, workers: int = 8, fetch_workers: int = 4,
+                 poll_interval: float = 0.25, default_timeout: float = 600.0,
+                 is_group_alive: Optional[Callable[[str], bool]] = None) -> None:
+        self.poll_interval = poll_interval # seconds between status checks of the running queries
+        self.default_timeout = default_timeout
+        self.is_group_alive = is_group_alive # queries of a group that is no longer alive are cancelled
+
+        self._free_slots = max_concurrent_queries
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="query-worker")
+        # fetch workers never wait for another future, so callers blocked on a query cannot starve its fetch
+        self._fetchers = ThreadPoolExecutor(max_workers=fetch_workers, thread_name_prefix="query-fetcher")
+        self._local = threading.local()
+        self._queued = deque() # _PendingQuery waiting for a slot
+        self._queries = {} # future -> _PendingQuery, until the future is resolved
+        self._running = set() # _RunningQuery, synchronous queries of local engines
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._slot_freed = threading.Condition(self._lock)
+        self._poller = None
+
+    def submit(self, fn: Callable, *args, group: Optional[str] = None) -> Future:
+        def run():
+            self._local.group = group
+            try:
+                return fn(*args)
+            finally:
+                self._local.group = None
+
+        return self._executor.submit(run)
+
+    def submit_after(self, futures: list, fn: Callable, *args, group: Optional[str] = None) -> Future:
+        # submits fn once every future is resolved, e.g. queries from submit_query, so no worker waits for them.
+        # Fails with the exception of a failed future instead of running fn
+        result = Future()
+        remaining = [len(futures)]
+        lock = threading.Lock()
+
+        def run():
+            try:
+                result.set_result(fn(*args))
+            except BaseException as e:
+                result.set_exception(e)
+
+        def ready(_):
+            with lock:
+                remaining[0] -= 1
+                if remaining[0] > 0:
+                    return
+            error = next((future.exception() for future in futures if future.exception() is not None), None)
+            if error is not None:
+                result.set_exception(error)
+            else:
+                self.submit(run, group=group)
+
+        if not futures:
+            self.submit(run, group=group)
+        for future in futures:
+            future.add_done_callback(ready)
+        return result
+
+    def run_all(self, *functions, arg=None, group: Optional[str] = None) -> list:
+        # runs several dashboard calls at once, with an optional argument. Failed calls return their exception
+        args = () if arg is None else (arg,)
+        futures = [self.submit(func, *args, group=group) for func in functions]
+
+        results = []
+        for future in futures:
+            try:
+                results.append(future.result())
+            except Exception as e:
+                results.append(e)
+        return results
+
+    def submit_query(self, conn, query: str, params: tuple = None, timeout: Optional[float] = None,
+                     timings: dict = None, group: Optional[str] = None, transform: Optional[Callable] = None) -> Future:
+        # Submits a query asynchronously on a Snowflake connection and returns a future of its frame, resolved by
+        # the poller. group: the calling worker's group when None. timeout: the default when None
+        group = getattr(self._local, "group", None) if group is None else group
+        timeout = self.default_timeout if timeout is None else timeout
+        pending = _PendingQuery(conn, query, params, timeout, timings, group, transform)
+
+        with self._lock:
+            self._queries[pending.future] = pending
+            if self._free_slots == 0: # global concurrency cap across every session, started once a slot frees
+                self._queued.append(pending)
+                return pending.future
+            self._free_slots -= 1
+            pending.state = "starting"
+
+        if not self._start(pending):
+            self._release_slot()
+        return pending.future
+
+    def join(self, future: Future, group: Optional[str]) -> bool:
+        # adds group to the groups waiting for a query from submit_query, so cancelling another of its groups
+        # no longer cancels it. False when the future is already resolved
+        with self._lock:
+            pending = self._queries.get(future)
+            if pending is None:
+                return False
+            if group is None:
+                pending.pinned = True
+            else:
+                pending.groups.add(group)
+            return True
+
+    def execute(self, conn, query: str, params: tuple = None, timeout: Optional[float] = None,
+                timings: dict = None) -> pd.DataFrame:
+        if _runs_async(conn): # the caller waits for the future, the query itself holds no thread
+            return self.submit_query(conn, query, params, timeout, timings).result()
+        with self.running(conn, timeout, timings) as timeout:
+            return execute_query(conn, query, params, timings, timeout=timeout)
+
+    @contextmanager
+    def running(self, conn, timeout: Optional[float] = None, timings: dict = None):
+        # Holds one of the global query slots while a query runs synchronously on conn, e.g. one streamed batch by
+        # batch, and cancels it with its group. Yields the timeout to pass to cursor.execute, the default when None
+        group = getattr(self._local, "group", None)
+        timeout = self.default_timeout if timeout is None else timeout
+
+        with Stopwatch(timings, "queue_ms"):
+            with self._slot_freed:
+                while self._free_slots == 0:
+                    self._slot_freed.wait()
+                self._free_slots -= 1
+
+        try: # global concurrency cap across every session
+            if not self._is_alive(group): # waited for a slot past the end of its session
+                raise QueryCancelled("Query cancelled, session ended")
+
+            running = _RunningQuery(conn, group)
+            self._track(running)
+            start = time.monotonic()
+            try:
+                yield timeout
+            except Exception as e:
+                if running.cancelled is not None:
+                    raise running.cancelled from e
+                if time.monotonic() - start >= timeout:
+                    raise QueryTimeout(f"Query timed out after {timeout:.0f}s") from e
+                raise
+            finally:
+                self._untrack(running)
+        finally:
+            self._release_slot()
+
+    def cancel_group(self, group: str) -> int:
+        # cancels the queries of group that no other group joined, returns how many
+        with self._lock:
+            running = [query for query in self._running if query.group == group]
+            pending = [query for query in self._queries.values() if group in query.groups]
+            for query in pending:
+                query.groups.discard(group)
+            pending = [query for query in pending if not query.pinned and not query.groups]
+
+        for query in running:
+            self._cancel_running(query, QueryCancelled("Query cancelled"))
+        for query in pending:
+            self._cancel(query, QueryCancelled("Query cancelled"))
+        return len(running) + len(pending)
+
+    def running_count(self) -> int: # queries running in the warehouse or on a local engine
+        with self._lock:
+            return len(self._running) + sum(query.state == "running" for query in self._queries.values())
+
+    def queued_count(self) -> int:
+        with self._lock:
+            return len(self._queued)
+
+    def _is_alive(self, group: Optional[str]) -> bool:
+        return group is None or self.is_group_alive is None or self.is_group_alive(group)
+
+    def _is_wanted(self, pending: _PendingQuery) -> bool:
+        return pending.pinned or any(self._is_alive(group) for group in pending.groups)
+
+    def _start(self, pending: _PendingQuery) -> bool:
+        # submits a query that got a slot, False when it was not started and the slot is free again
+        if not self._is_wanted(pending): # cancelled or its sessions ended while it waited for a slot
+            self._resolve(pending, error=QueryCancelled("Query cancelled, session ended"))
+            return False
+
+        if pending.timings is not None:
+            pending.timings["queue_ms"] = pending.timings.get("queue_ms", 0.0) + (time.perf_counter() - pending.submitted) * 1000
+        cursor = pending.conn.cursor()
+        try:
+            cursor.execute_async(pending.query, pending.params)
+        except Exception as e:
+            cursor.close()
+            self._resolve(pending, error=e)
+            return False
+
+        pending.cursor = cursor
+        pending.query_id = cursor.sfqid
+        pending.started = time.perf_counter()
+        pending.deadline = time.monotonic() + pending.timeout
+        if pending.timings is not None:
+            pending.timings["query_id"] = pending.query_id
+
+        with self._wakeup:
+            pending.state = "running"
+            cancelled = pending.cancelled
+            self._ensure_poller()
+        if cancelled is not None:
+            self._cancel(pending, cancelled)
+        return True
+
+    def _release_slot(self) -> None:
+        # hands the slot to the next queued query, or frees it
+        while True:
+            with self._lock:
+                if not self._queued:
+                    self._free_slots += 1
+                    self._slot_freed.notify()
+                    return
+                pending = self._queued.popleft()
+                pending.state = "starting"
+            if self._start(pending):
+                return
+
+    def _finish(self, pending: _PendingQuery, error: Optional[Exception] = None) -> None:
+        # the query is no longer running in the warehouse, its results are fetched on a fetch worker
+        with self._lock:
+            if pending.state != "running":
+                return
+            pending.state = "fetching"
+        self._release_slot()
+
+        if pending.timings is not None:
+            pending.timings["execute_ms"] = pending.timings.get("execute_ms", 0.0) + (time.perf_counter() - pending.started) * 1000
+        if error is not None:
+            pending.cursor.close()
+            self._resolve(pending, error=error)
+            return
+        self._fetchers.submit(self._fetch, pending)
+
+    def _fetch(self, pending: _PendingQuery) -> None:
+        try:
+            with Stopwatch(pending.timings, "fetch_ms"):
+                pending.cursor.get_results_from_sfqid(pending.query_id)
+            frame = frame_from_cursor(pending.cursor, pending.timings)
+            if pending.transform is not None:
+                frame = pending.transform(frame)
+        except Exception as e:
+            self._resolve(pending, error=e)
+        else:
+            self._resolve(pending, frame)
+        finally:
+            pending.cursor.close()
+
+    def _resolve(self, pending: _PendingQuery, frame: Optional[pd.DataFrame] = None,
+                 error: Optional[Exception] = None) -> None:
+        with self._lock:
+            pending.state = "done"
+            self._queries.pop(pending.future, None)
+        if error is not None:
+            pending.future.set_exception(error)
+        else:
+            pending.future.set_result(frame)
+
+    def _cancel(self, pending: _PendingQuery, error: Exception) -> None:
+        with self._lock:
+            state = pending.state
+            if state == "queued":
+                self._queued.remove(pending)
+            elif state == "starting": # _start cancels it once it has a query ID
+                pending.cancelled = error
+                return
+            elif state == "running":
+                pending.state = "fetching"
+            else: # done in the warehouse already
+                return
+
+        if state == "running":
+            try:
+                pending.conn.cursor().abort_query(pending.query_id)
+            except Exception as e:
+                print(f"Cancel error for query {pending.query_id}: {e}")
+            pending.cursor.close()
+            self._release_slot()
+        self._resolve(pending, error=error)
+
+    def _track(self, running: _RunningQuery) -> None:
+        with self._wakeup:
+            self._running.add(running)
+            if self.is_group_alive is not None:
+                self._ensure_poller()
+
+    def _untrack(self, running: _RunningQuery) -> None:
+        with running.lock:
+            running.finished = True
+        with self._lock:
+            self._running.discard(running)
+
+    def _ensure_poller(self) -> None: # called holding the lock
+        if self._poller is None or not self._poller.is_alive():
+            self._poller = threading.Thread(target=self._poll, name="query-poller", daemon=True)
+            self._poller.start()
+        self._wakeup.notify()
+
+    def _poll(self) -> None:
+        while True:
+            with self._wakeup:
+                while not self._queries and not self._running:
+                    self._wakeup.wait()
+                queries = list(self._queries.values())
+                running = list(self._running)
+
+            now = time.monotonic()
+            for pending in queries:
+                if not self._is_wanted(pending):
+                    self._cancel(pending, QueryCancelled("Query cancelled, session ended"))
+                elif pending.state != "running":
+                    continue
+                elif now >= pending.deadline:
+                    self._cancel(pending, QueryTimeout(f"Query {pending.query_id} timed out after {pending.timeout:.0f}s"))
+                else:
+                    try:
+                        status = pending.conn.get_query_status_throw_if_error(pending.query_id)
+                        if not pending.conn.is_still_running(status):
+                            self._finish(pending)
+                    except Exception as e:
+                        self._finish(pending, e)
+
+            for query in running:
+                if not self._is_alive(query.group):
+                    self._cancel_running(query, QueryCancelled("Query cancelled, session ended"))
+
+            time.sleep(self.poll_interval)
+
+    def _cancel_running(self, running: _RunningQuery, error: Exception) -> None:
+        with running.lock:
+            if running.finished or running.cancelled is not None:
+                return
+            running.cancelled = error
+            try:
+                _abort(running.conn)
+            except Exception as e:
+                print(f"Cancel error: {e}")
@@ -0,0 +1,119 @@
+import threading
+import time
+from typing import Callable, Optional
+
+
+class _Job:
+
+    def __init__(self, fn: Callable[[], None], next_run: float, alive: Optional[Callable[[], bool]] = None) -> None:
+        self.fn = fn
+        self.next_run = next_run
+        self.alive = alive # the job is dropped instead of run once this returns False
+        self.runs = 0
+        self.last_run = None # wall clock time the last run finished
+        self.last_ms = None
+        self.last_error = None
+
+
+class BackgroundRefresher:
+    """Process wide thread that keeps the standard dashboard results warm.
+
+    Jobs are registered by name, e.g. one per environment, and re-run every interval seconds so
+    sessions find fresh results in the shared ResultCache instead of waiting on the warehouse.
+    Registering a name again replaces its job but keeps its schedule. A failed run is retried after
+    retry_interval seconds. A job registered with alive, e.g. a check that the session whose credentials
+    it runs on is still open, is dropped once alive returns False.
+    """
+
+    def __init__(self, interval: float = 300.0, retry_interval: float = 60.0) -> None:
+        self.interval = interval
+        self.retry_interval = retry_interval
+
+        self._jobs = {} # name -> _Job
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._stopped = False
+        self._thread = None
+
+    def register(self, name: str, fn: Callable[[], None], alive: Optional[Callable[[], bool]] = None) -> None:
+        with self._wakeup:
+            job = self._jobs.get(name)
+            if job is None:
+                self._jobs[name] = _Job(fn, time.monotonic(), alive) # first run right away
+            else:
+                job.fn = fn
+                job.alive = alive
+            if self._thread is None or not self._thread.is_alive():
+                self._stopped = False
+                self._thread = threading.Thread(target=self._run, name="dashboard-refresher", daemon=True)
+                self._thread.start()
+            self._wakeup.notify()
+
+    def unregister(self, name: str) -> None:
+        with self._lock:
+            self._jobs.pop(name, None)
+
+    def run_now(self, name: Optional[str] = None) -> None:
+        # moves the next run of one job, or of every job, to now
+        with self._wakeup:
+            for job_name, job in self._jobs.items():
+                if name is None or job_name == name:
+                    job.next_run = time.monotonic()
+            self._wakeup.notify()
+
+    def stop(self) -> None:
+        with self._wakeup:
+            self._stopped = True
+            self._wakeup.notify()
+
+    def status(self) -> list:
+        # one dict per job, for the diagnostics tab
+        with self._lock:
+            now = time.monotonic()
+            return [
+                {
+                    "job": name,
+                    "runs": job.runs,
+                    "last_run": job.last_run,
+                    "last_ms": job.last_ms,
+                    "last_error": job.last_error,
+                    "next_run_in_s": max(job.next_run - now, 0.0),
+                }
+                for name, job in self._jobs.items()
+            ]
+
+    def _run(self) -> None:
+        while True:
+            with self._wakeup:
+                while not self._stopped:
+                    now = time.monotonic()
+                    due = [(name, job) for name, job in self._jobs.items() if job.next_run <= now]
+                    if due:
+                        break
+                    next_run = min((job.next_run for job in self._jobs.values()), default=None)
+                    self._wakeup.wait(None if next_run is None else next_run - now)
+                if self._stopped:
+                    return
+
+            for name, job in due: # sequentially, so the refresher adds at most one query stream to the warehouse
+                with self._lock: # alive is read under the lock, a register meanwhile may have replaced it
+                    ended = job.alive is not None and not job.alive()
+                    if ended and self._jobs.get(name) is job:
+                        del self._jobs[name]
+                if ended:
+                    continue
+
+                start = time.perf_counter()
+                try:
+                    job.fn()
+                    error = None
+                except Exception as e:
+                    print(f"Background refresh of {name} failed: {e}")
+                    error = f"{type(e).__name__}: {e}"
+
+                with self._lock:
+                    job.runs += 1
+                    job.last_run = time.time()
+                    job.last_ms = (time.perf_counter() - start) * 1000
+                    job.last_error = error
+                    job.next_run = time.monotonic() + (self.interval if error is None else self.retry_interval)
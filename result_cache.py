@@ -0,0 +1,335 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Callable, NamedTuple, Optional
+
+import pandas as pd
+import pyarrow as pa
+
+class CacheKey(NamedTuple):
+    env: str
+    family: str # query family, e.g. "events", "sessions", "device"
+    query: str
+    params: tuple = ()
+
+
+def frame_nbytes(df: pd.DataFrame) -> int:
+    return int(df.memory_usage(index=True, deep=True).sum())
+
+
+def frame_fingerprint(df: pd.DataFrame) -> str:
+    # content hash of a frame (values, index, column names and dtypes), e.g. to memoize what is built from it
+    digest = hashlib.sha1(pd.util.hash_pandas_object(df, index=True).to_numpy().tobytes())
+    digest.update(repr([(str(column), str(dtype)) for column, dtype in df.dtypes.items()]).encode())
+    return digest.hexdigest()[:16]
+
+
+def completed_future(value=None) -> Future:
+    future = Future()
+    future.set_result(value)
+    return future
+
+
+class SingleFlight:
+    """Collapses concurrent calls with the same key into one execution.
+
+    The first caller of a key runs the function. Callers arriving while it runs wait for it and get
+    the same result, or the same exception, instead of running it again.
+    """
+
+    def __init__(self) -> None:
+        self._calls = {} # key -> [done event, result, exception]
+        self._lock = threading.Lock()
+        self.executions = 0
+        self.shared = 0 # calls answered by another caller's execution
+
+    def do(self, key, fn: Callable):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = [threading.Event(), None, None]
+                self.executions += 1
+            else:
+                self.shared += 1
+
+        done = call[0]
+        if not leader:
+            done.wait()
+            if call[2] is not None:
+                raise call[2]
+            return call[1]
+
+        try:
+            call[1] = fn()
+            return call[1]
+        except BaseException as e:
+            call[2] = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            done.set()
+
+    def in_flight(self) -> int:
+        with self._lock:
+            return len(self._calls)
+
+
+class _AsyncFlight:
+    """A miss of get_or_compute_async, from the first caller until its compute's future is resolved"""
+
+    def __init__(self) -> None:
+        self.future = Future() # resolved once the result is cached
+        self.compute = None # the future compute returned, once submitted
+        self.joins = [] # join functions of callers that arrived before it was submitted
+
+
+class ResultCache:
+    """LRU cache of query results bounded by entry count and bytes, with a TTL per query family.
+
+    Cached frames are shared between callers and must be treated as read-only. With a SharedResultStore,
+    misses are looked up in it before computing, and computed results are written to it for the other
+    processes on the host. A result read from it is kept here as a frame, so only its numeric and
+    timestamp columns stay shared with the other processes, see SharedResultStore.
+    """
+
+    def __init__(self, max_entries: int = 256, max_bytes: int = 512 * 1024 * 1024,
+                 ttls: Optional[dict] = None, default_ttl: float = 600.0, shared=None) -> None:
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttls = dict(ttls or {}) # family -> seconds
+        self.default_ttl = default_ttl
+        self.shared = shared # optional shared_cache.SharedResultStore
+
+        self._entries = OrderedDict() # key -> (frame, nbytes, expires_at, computed_at), oldest first
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._flights = SingleFlight() # concurrent misses and refreshes of a key run the query once
+        self._async_flights = {} # key -> _AsyncFlight
+
+        self.hits = 0
+        self.misses = 0
+        self.expirations = 0
+        self.evictions = 0
+        self.shared_hits = 0
+
+    def ttl(self, key: CacheKey) -> float:
+        return self.ttls.get(key.family, self.default_ttl)
+
+    def get(self, key: CacheKey) -> Optional[pd.DataFrame]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            frame, nbytes, expires_at, _ = entry
+            if time.monotonic() >= expires_at:
+                self._remove(key)
+                self.expirations += 1
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return frame
+
+    def put(self, key: CacheKey, frame: pd.DataFrame, computed_at: Optional[float] = None) -> None:
+        # computed_at: wall clock time the result was computed, now by default. Earlier for shared tier results
+        nbytes = frame_nbytes(frame)
+        if nbytes > self.max_bytes: # would evict everything else and still not fit
+            return
+
+        now = time.time()
+        computed_at = now if computed_at is None else computed_at
+        expires_at = time.monotonic() + self.ttl(key) - max(now - computed_at, 0.0)
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (frame, nbytes, expires_at, computed_at)
+            self._bytes += nbytes
+
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self.evictions += 1
+
+    def get_or_compute(self, key: CacheKey, compute: Callable[[], pd.DataFrame]) -> pd.DataFrame:
+        frame = self.get(key)
+        if frame is not None:
+            return frame
+
+        def fill():
+            with self._lock: # a flight of this key may have filled it since the miss above
+                entry = self._entries.get(key)
+            if entry is not None and time.monotonic() < entry[2]:
+                return entry[0]
+            frame = self._wait_async(key)
+            if frame is not None:
+                return frame
+            if self.shared is None:
+                return self._compute(key, compute)
+
+            frame = self._read_shared(key)
+            if frame is not None:
+                return frame
+            with self.shared.lock(key): # one process computes, the others wait and read its file
+                frame = self._read_shared(key)
+                if frame is not None:
+                    return frame
+                return self._compute(key, compute)
+
+        return self._flights.do(key, fill)
+
+    def get_or_compute_async(self, key: CacheKey, compute: Callable[[], Future],
+                             join: Optional[Callable[[Future], None]] = None) -> Future:
+        # get_or_compute for a compute that returns a future, e.g. a query from QueryScheduler.submit_query, so no
+        # thread waits while it runs. Returns a future of the cached frame. Concurrent misses share one compute,
+        # each caller after the first calls join with its future. With the shared tier, a result another process
+        # is computing resolves to None instead, get_or_compute then waits for that process's file
+        frame = self.get(key)
+        if frame is not None:
+            return completed_future(frame)
+
+        with self._lock:
+            flight = self._async_flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._async_flights[key] = _AsyncFlight()
+            elif flight.compute is None:
+                if join is not None:
+                    flight.joins.append(join)
+                join = None
+        if not leader:
+            if join is not None:
+                join(flight.compute)
+            return flight.future
+
+        release = None
+        try:
+            if self.shared is not None:
+                frame = self._read_shared(key)
+                if frame is None:
+                    release = self.shared.try_lock(key)
+                if frame is not None or release is None:
+                    self._end_async(key, flight, frame)
+                    return flight.future
+            future = compute()
+        except Exception as e:
+            if release is not None:
+                release()
+            self._end_async(key, flight, error=e)
+            return flight.future
+
+        def done(future):
+            frame, error = None, None
+            try:
+                frame = self._store(key, future.result())
+            except Exception as e:
+                error = e
+            if release is not None:
+                release()
+            self._end_async(key, flight, frame, error)
+
+        with self._lock:
+            flight.compute = future
+            joins, flight.joins = flight.joins, []
+        for join_flight in joins:
+            join_flight(future)
+        future.add_done_callback(done)
+        return flight.future
+
+    def refresh(self, key: CacheKey, compute: Callable[[], pd.DataFrame]) -> pd.DataFrame:
+        # recomputes key even when its entry is still valid. Readers keep getting the old entry until the new
+        # one is put, and misses of key while the refresh runs wait for it instead of querying again
+        def fill():
+            if self.shared is None:
+                return self._compute(key, compute)
+            with self.shared.lock(key):
+                with self._lock:
+                    entry = self._entries.get(key)
+                # another process refreshed it since this one got its entry, e.g. the refresher of another replica
+                frame = self._read_shared(key, newer_than=entry[3] if entry is not None else None)
+                if frame is not None:
+                    return frame
+                return self._compute(key, compute)
+
+        return self._flights.do(key, fill)
+
+    def _compute(self, key: CacheKey, compute: Callable[[], pd.DataFrame]) -> pd.DataFrame:
+        return self._store(key, compute())
+
+    def _store(self, key: CacheKey, frame: pd.DataFrame) -> pd.DataFrame:
+        computed_at = None
+        if self.shared is not None:
+            try:
+                computed_at = self.shared.write(key, frame) # the file's time, so a later refresh can tell it apart
+            except (pa.ArrowException, OSError) as e: # e.g. object columns arrow cannot type, the memory tier still has it
+                print(f"Shared cache write failed for {key.family}/{key.query}: {e}")
+        self.put(key, frame, computed_at)
+        return frame
+
+    def _wait_async(self, key: CacheKey) -> Optional[pd.DataFrame]:
+        # the result of an async flight of key, None when there is none or it failed
+        with self._lock:
+            flight = self._async_flights.get(key)
+        if flight is None:
+            return None
+        try:
+            return flight.future.result()
+        except Exception:
+            return None
+
+    def _end_async(self, key: CacheKey, flight: _AsyncFlight, frame: Optional[pd.DataFrame] = None,
+                   error: Optional[Exception] = None) -> None:
+        with self._lock:
+            del self._async_flights[key]
+        if error is not None:
+            flight.future.set_exception(error)
+        else:
+            flight.future.set_result(frame)
+
+    def _read_shared(self, key: CacheKey, newer_than: Optional[float] = None) -> Optional[pd.DataFrame]:
+        res = self.shared.read(key, self.ttl(key))
+        if res is None or (newer_than is not None and res[1] <= newer_than):
+            return None
+        frame, written_at = res
+        self.put(key, frame, written_at)
+        with self._lock:
+            self.shared_hits += 1
+        return frame
+
+    def invalidate(self, env: Optional[str] = None, family: Optional[str] = None) -> int:
+        # None matches everything, so invalidate() empties the cache
+        with self._lock:
+            keys = [
+                key for key in self._entries
+                if (env is None or key.env == env) and (family is None or key.family == family)
+            ]
+            for key in keys:
+                self._remove(key)
+        if self.shared is not None: # gone for every process, other processes keep their memory entries until they expire
+            self.shared.invalidate(env, family)
+        return len(keys)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "expirations": self.expirations,
+                "evictions": self.evictions,
+                "in_flight": self._flights.in_flight() + len(self._async_flights),
+                "coalesced": self._flights.shared,
+                "shared_hits": self.shared_hits,
+                **(self.shared.stats() if self.shared is not None else {}),
+            }
+
+    def _remove(self, key: CacheKey) -> None:
+        _, nbytes, _, _ = self._entries.pop(key)
+        self._bytes -= nbytes
@@ -0,0 +1,175 @@
+import math
+import threading
+from typing import Callable, Optional
+
+import numpy as np
+import pandas as pd
+
+from incremental import PartialAggregateStore
+
+# Relative accuracy of the duration sketches: an estimated quantile is within 1% of a session duration near it
+SKETCH_ACCURACY = 0.01
+SKETCH_GAMMA = (1 + SKETCH_ACCURACY) / (1 - SKETCH_ACCURACY)
+SKETCH_LOG_GAMMA = math.log(SKETCH_GAMMA) # bin of a duration d is CEIL(LN(d) / SKETCH_LOG_GAMMA), computed in the warehouse
+
+GRANULARITIES = ("hour", "day", "week")
+
+
+def period_start(timestamps: pd.Series, granularity: str) -> pd.Series:
+    if granularity == "hour":
+        return timestamps.dt.floor("h")
+    if granularity == "day":
+        return timestamps.dt.floor("D")
+    if granularity == "week": # weeks start on Monday
+        days = timestamps.dt.floor("D")
+        return days - pd.to_timedelta(days.dt.dayofweek, unit="D")
+    raise ValueError(f"Unknown granularity '{granularity}'")
+
+
+def sketch_bin_value(bins: np.ndarray) -> np.ndarray:
+    # the duration a bin stands for, within SKETCH_ACCURACY of every duration in the bin
+    return 2 * SKETCH_GAMMA ** bins / (SKETCH_GAMMA + 1)
+
+
+def sketch_quantiles(sketches: pd.DataFrame, by: list, quantiles: dict) -> pd.DataFrame:
+    # Quantiles per group of merged sketch rows (DURATION_BIN, SESSION_COUNT, MIN_DURATION, MAX_DURATION).
+    # Ranks follow PERCENTILE_CONT: quantile q interpolates between the values at the ranks around q * (n - 1)
+    keys = by or ["_ALL"]
+    sketches = sketches if by else sketches.assign(_ALL=0)
+    merged = (
+        sketches.groupby(keys + ["DURATION_BIN"], as_index=False, observed=True)
+        .agg(SESSION_COUNT=("SESSION_COUNT", "sum"), MIN_DURATION=("MIN_DURATION", "min"), MAX_DURATION=("MAX_DURATION", "max"))
+        .sort_values(keys + ["DURATION_BIN"], ignore_index=True)
+    )
+    grouped = merged.groupby(keys, observed=True)["SESSION_COUNT"]
+    seen = grouped.cumsum().to_numpy()
+    total = grouped.transform("sum").to_numpy()
+
+    # a bin's representative value, kept inside the exact min and max of the durations in it
+    values = np.clip(sketch_bin_value(merged["DURATION_BIN"].to_numpy(dtype=float)),
+                     merged["MIN_DURATION"].to_numpy(dtype=float), merged["MAX_DURATION"].to_numpy(dtype=float))
+
+    def value_at(rank: np.ndarray) -> pd.DataFrame: # per group, the value of the first bin holding rank
+        reached = seen > rank
+        return merged.loc[reached, keys].assign(_VALUE=values[reached]).drop_duplicates(subset=keys)
+
+    res = merged[keys].drop_duplicates(ignore_index=True)
+    for column, q in quantiles.items():
+        rank = q * (total - 1)
+        lower, upper = value_at(np.floor(rank)), value_at(np.minimum(np.floor(rank) + 1, total - 1))
+        fraction = res[keys].merge(merged[keys].assign(_FRACTION=rank - np.floor(rank)).drop_duplicates(subset=keys), on=keys)
+        both = fraction.merge(lower, on=keys).merge(upper, on=keys, suffixes=("_LOWER", "_UPPER"))
+        both[column] = both["_VALUE_LOWER"] + both["_FRACTION"] * (both["_VALUE_UPPER"] - both["_VALUE_LOWER"])
+        res = res.merge(both[keys + [column]], on=keys, how="left")
+    return res.drop(columns=["_ALL"]) if not by else res
+
+
+class RollupStore:
+    """Hourly event counts and session duration sketches of one environment, per device, rolled up to days and weeks.
+
+    Both are refreshed incrementally from a watermark. Any date range and granularity is answered by
+    merging stored buckets: counts and session sums add up, and the log-bucket duration sketches merge by
+    adding bin counts, so percentiles over any range need no raw events.
+    """
+
+    def __init__(self, trailing_window: pd.Timedelta, retention: Optional[pd.DateOffset] = None,
+                 min_refresh_interval: float = 0.0) -> None:
+        self.event_counts = PartialAggregateStore(
+            "PERIOD_START", "LAST_EVENT_TIMESTAMP", trailing_window,
+            retention=retention, min_refresh_interval=min_refresh_interval
+        )
+        self.session_sketches = PartialAggregateStore(
+            "PERIOD_START", "LAST_EVENT_TIMESTAMP", trailing_window,
+            retention=retention, min_refresh_interval=min_refresh_interval
+        )
+        self.levels = {} # (kind, granularity) -> buckets at that granularity, rebuilt when a refresh brings new rows
+        self._sources = (None, None)
+        self._lock = threading.Lock()
+
+    def refresh(self, fetch_events: Callable, fetch_sessions: Callable) -> None:
+        # fetch_*(since) as for PartialAggregateStore.refresh, returning hourly buckets
+        events = self.event_counts.refresh(fetch_events)
+        sessions = self.session_sketches.refresh(fetch_sessions)
+        with self._lock:
+            if self._sources[0] is events and self._sources[1] is sessions:
+                return
+            levels = {}
+            for granularity in GRANULARITIES:
+                levels[("events", granularity)] = self._roll_up(events, granularity, ["DEVICE_NAME", "DEVICE_TOKEN"])
+                levels[("sessions", granularity)] = self._roll_up(sessions, granularity, ["DEVICE_TOKEN", "DURATION_BIN"])
+            self.levels = levels
+            self._sources = (events, sessions)
+
+    def reset(self) -> None:
+        self.event_counts.reset()
+        self.session_sketches.reset()
+        with self._lock:
+            self.levels = {}
+            self._sources = (None, None)
+
+    def span(self) -> tuple:
+        # (first, last) hour with any events, or (None, None) before the first refresh
+        hours = self.levels.get(("events", "hour"))
+        if hours is None or len(hours) == 0:
+            return None, None
+        return hours["PERIOD_START"].min(), hours["PERIOD_START"].max()
+
+    @staticmethod
+    def _roll_up(hourly: pd.DataFrame, granularity: str, keys: list) -> pd.DataFrame:
+        if granularity == "hour":
+            return hourly
+        rolled = hourly.assign(PERIOD_START=period_start(hourly["PERIOD_START"], granularity))
+        sums = [column for column in rolled.columns if column not in keys + ["PERIOD_START", "MIN_DURATION", "MAX_DURATION", "LAST_EVENT_TIMESTAMP"]]
+        aggregations = {column: (column, "sum") for column in sums}
+        for column, how in (("MIN_DURATION", "min"), ("MAX_DURATION", "max"), ("LAST_EVENT_TIMESTAMP", "max")):
+            if column in rolled.columns:
+                aggregations[column] = (column, how)
+        return rolled.groupby(["PERIOD_START"] + keys, dropna=False, as_index=False, observed=True).agg(**aggregations)
+
+    def _buckets(self, kind: str, since: pd.Timestamp, until: pd.Timestamp, granularity: str,
+                 device_token: Optional[str]) -> pd.DataFrame:
+        # stored buckets covering [since, until) at granularity. A coarser level is only used when the range is
+        # aligned to it, otherwise the next finer level is rolled up within the range
+        for level in GRANULARITIES[GRANULARITIES.index(granularity)::-1]:
+            if level == "hour" or (period_start(pd.Series([since, until]), level) == pd.Series([since, until])).all():
+                break
+        buckets = self.levels[(kind, level)]
+        buckets = buckets[(buckets["PERIOD_START"] >= since) & (buckets["PERIOD_START"] < until)]
+        if device_token is not None:
+            buckets = buckets[buckets["DEVICE_TOKEN"] == device_token]
+        if level != granularity:
+            buckets = buckets.assign(PERIOD_START=period_start(buckets["PERIOD_START"], granularity))
+        return buckets
+
+    def event_totals(self, since: pd.Timestamp, until: pd.Timestamp, event_columns: list,
+                     device_token: Optional[str] = None) -> pd.Series:
+        # started event counts in [since, until), indexed by event name
+        return self._buckets("events", since, until, "day", device_token)[event_columns].sum()
+
+    def duration_stats(self, since: pd.Timestamp, until: pd.Timestamp, granularity: str, quantiles: dict,
+                       device_token: Optional[str] = None) -> pd.DataFrame:
+        # session duration statistics per period in [since, until) plus a summary row, in the shape of the
+        # session_duration_stats query. Percentiles come from the merged sketches
+        sketches = self._buckets("sessions", since, until, granularity, device_token)
+
+        def stats(by: list) -> pd.DataFrame:
+            keys = by or ["_ALL"]
+            frame = sketches if by else sketches.assign(_ALL=0)
+            res = frame.groupby(keys, as_index=False, observed=True).agg(
+                SESSION_COUNT=("SESSION_COUNT", "sum"), DURATION_SUM=("DURATION_SUM", "sum"),
+                MIN_DURATION=("MIN_DURATION", "min"), MAX_DURATION=("MAX_DURATION", "max"),
+            )
+            res["AVG_DURATION"] = res["DURATION_SUM"] / res["SESSION_COUNT"]
+            res = res.merge(sketch_quantiles(frame, keys, quantiles), on=keys)
+            return res.drop(columns=["DURATION_SUM"] + (["_ALL"] if not by else []))
+
+        columns = ["SESSION_DATE", "SESSION_COUNT", "AVG_DURATION", "MIN_DURATION", "MAX_DURATION", *quantiles, "IS_SUMMARY"]
+        if len(sketches) == 0:
+            return pd.DataFrame(columns=columns)
+
+        periods = stats(["PERIOD_START"]).rename(columns={"PERIOD_START": "SESSION_DATE"})
+        periods["IS_SUMMARY"] = 0
+        summary = stats([])
+        summary["SESSION_DATE"] = pd.NaT
+        summary["IS_SUMMARY"] = 1
+        return pd.concat([periods[columns], summary[columns]], ignore_index=True)
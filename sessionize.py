@@ -0,0 +1,163 @@
+from typing import NamedTuple
+
+import numpy as np
+import pandas as pd
+
+from queries import STARTED_EVENTS
+
+DEFAULT_INACTIVITY_GAP = pd.Timedelta(minutes=30)
+DEFAULT_FUNNEL = STARTED_EVENTS # gameStarted -> experienceStarted -> ... in the order the game starts them
+
+
+def _array_like(values):
+    # lists become object arrays, arrays, Series and extension arrays are used as they are
+    return np.asarray(values, dtype=object) if isinstance(values, (list, tuple)) else values
+
+
+def _factorize(values) -> tuple:
+    # (int64 code per value, -1 when missing, distinct values). Categoricals already have their codes
+    values = _array_like(values)
+    if isinstance(getattr(values, "dtype", None), pd.CategoricalDtype):
+        categorical = pd.Categorical(values)
+        return categorical.codes.astype(np.int64), categorical.categories
+    codes, uniques = pd.factorize(values)
+    return codes.astype(np.int64), uniques
+
+
+def _sort_order(keys: np.ndarray, timestamps: np.ndarray) -> np.ndarray:
+    # argsort by key, then time. Packed into one int64 when key and time range fit, which sorts several
+    # times faster than np.lexsort
+    if len(keys) == 0:
+        return np.arange(0)
+    ticks = timestamps.view(np.int64)
+    offsets = ticks - ticks.min()
+    span = int(offsets.max()) + 1
+    if (int(keys.max()) + 1) * span < 2**63:
+        return np.argsort(keys * span + offsets)
+    return np.lexsort((ticks, keys))
+
+
+def _firsts(sorted_values: np.ndarray) -> np.ndarray:
+    # positions where a run of equal values starts in a sorted array
+    starts = np.ones(len(sorted_values), dtype=bool)
+    starts[1:] = sorted_values[1:] != sorted_values[:-1]
+    return np.flatnonzero(starts)
+
+
+class Sessionized(NamedTuple):
+    sessions: pd.DataFrame # one row per session, see sessionize
+    order: np.ndarray # positions of the kept input events, sorted by session and then time
+    session_of_sorted: np.ndarray # session row of each event in order
+
+
+def _no_sessions(timestamp_dtype) -> Sessionized:
+    # typed like the sessions of sessionize, so callers filter and aggregate it the same way
+    times = np.array([], dtype=timestamp_dtype)
+    sessions = pd.DataFrame({
+        "DEVICE_TOKEN": np.array([], dtype=object),
+        "SESSION_ID": np.array([], dtype=object),
+        "SESSION_START": times,
+        "SESSION_END": times,
+        "SESSION_DATE": times,
+        "SESSION_DURATION": np.array([], dtype=np.int64),
+        "EVENT_COUNT": np.array([], dtype=np.int64),
+    })
+    return Sessionized(sessions, np.array([], dtype=np.int64), np.array([], dtype=np.int64))
+
+
+def sessionize(device_tokens, session_ids, event_timestamps,
+               inactivity_gap: pd.Timedelta = DEFAULT_INACTIVITY_GAP) -> Sessionized:
+    """Splits raw events into sessions with one sort and no per-event Python code.
+
+    Events are keyed by their session ID, or by their device token when the session ID is missing. Within
+    a key, events more than inactivity_gap apart start a new session, so a session crossing midnight stays
+    one session and events without a session ID still form sessions per device. Events with neither are
+    dropped, as are events without a timestamp.
+
+    sessions has DEVICE_TOKEN (first token seen in the session), SESSION_ID (None for sessions keyed by
+    device), SESSION_START, SESSION_END, SESSION_DATE (day of SESSION_START), SESSION_DURATION (whole
+    minutes, counted like DATEDIFF('minute', start, end)) and EVENT_COUNT.
+    """
+    timestamps = pd.to_datetime(pd.Series(event_timestamps)).to_numpy()
+    token_codes, tokens = _factorize(device_tokens)
+    session_codes, session_values = _factorize(session_ids)
+
+    # session IDs first, device tokens after them in the same code space
+    keys = np.where(session_codes >= 0, session_codes, np.where(token_codes >= 0, token_codes + len(session_values), -1))
+    kept = np.flatnonzero((keys >= 0) & ~np.isnat(timestamps))
+    order = kept[_sort_order(keys[kept], timestamps[kept])]
+    if len(order) == 0: # no events left, e.g. an environment or month without any
+        return _no_sessions(timestamps.dtype)
+
+    sorted_keys = keys[order]
+    sorted_times = timestamps[order]
+    starts = np.ones(len(order), dtype=bool)
+    starts[1:] = (sorted_keys[1:] != sorted_keys[:-1]) | (np.diff(sorted_times) > inactivity_gap.to_timedelta64())
+    first = np.flatnonzero(starts)
+    last = np.r_[first[1:], len(order)] - 1
+    session_of_sorted = np.cumsum(starts) - 1
+
+    session_start = sorted_times[first]
+    session_end = sorted_times[last]
+    minutes = session_end.astype("datetime64[m]") - session_start.astype("datetime64[m]")
+
+    # first event with a device token in each session, events are in time order within a session
+    sorted_tokens = token_codes[order]
+    with_token = np.flatnonzero(sorted_tokens >= 0)
+    with_token = with_token[_firsts(session_of_sorted[with_token])]
+    session_tokens = np.full(len(first), None, dtype=object)
+    session_tokens[session_of_sorted[with_token]] = np.asarray(tokens, dtype=object)[sorted_tokens[with_token]]
+
+    first_keys = sorted_keys[first]
+    session_id_keyed = first_keys < len(session_values)
+    session_ids = np.full(len(first), None, dtype=object)
+    session_ids[session_id_keyed] = np.asarray(session_values, dtype=object)[first_keys[session_id_keyed]]
+
+    sessions = pd.DataFrame({
+        "DEVICE_TOKEN": session_tokens,
+        "SESSION_ID": session_ids,
+        "SESSION_START": session_start,
+        "SESSION_END": session_end,
+        "SESSION_DATE": session_start.astype("datetime64[D]").astype(session_start.dtype),
+        "SESSION_DURATION": minutes.astype(np.int64),
+        "EVENT_COUNT": last - first + 1,
+    })
+    return Sessionized(sessions, order, session_of_sorted)
+
+
+def funnel_steps(sessionized: Sessionized, event_names, steps: tuple = DEFAULT_FUNNEL) -> np.ndarray:
+    """Number of funnel steps each session reached, in session row order.
+
+    A session reaches a step when it reached the previous step and has the step's event after the event
+    that reached the previous step.
+    """
+    sessions = len(sessionized.sessions)
+    step_codes = pd.Categorical(_array_like(event_names), categories=list(steps)).codes[sessionized.order]
+
+    # positions in sessionized.order stand in for time, they increase with time within a session
+    reached = np.zeros(sessions, dtype=np.int64)
+    previous = np.full(sessions, -1)
+    for step in range(len(steps)):
+        positions = np.flatnonzero(step_codes == step)
+        owners = sessionized.session_of_sorted[positions]
+        after = (positions > previous[owners]) & (reached[owners] == step) # only sessions still in the funnel
+        positions, owners = positions[after], owners[after]
+        firsts = _firsts(owners)
+        reached[owners[firsts]] = step + 1
+        previous[owners[firsts]] = positions[firsts]
+    return reached
+
+
+def funnel_frame(steps_reached, steps: tuple = DEFAULT_FUNNEL) -> pd.DataFrame:
+    # STEP, EVENT_NAME, SESSIONS reaching it, and FROM_PREVIOUS and FROM_FIRST as shares between 0 and 1.
+    # Without sessions every step has 0 sessions and 0 shares
+    reached = np.bincount(np.asarray(steps_reached, dtype=np.int64), minlength=len(steps) + 1)
+    counts = reached[::-1].cumsum()[::-1][1:] # sessions reaching at least each step
+    previous_counts = np.r_[counts[:1], counts[:-1]]
+    return pd.DataFrame({
+        "STEP": np.arange(1, len(steps) + 1),
+        "EVENT_NAME": list(steps),
+        "SESSIONS": counts,
+        "FROM_PREVIOUS": counts / np.maximum(previous_counts, 1),
+        "FROM_FIRST": counts / max(counts[0], 1) if len(counts) else counts.astype(float),
+    })
@@ -0,0 +1,162 @@
+import contextlib
+import functools
+import hashlib
+import os
+import pathlib
+import re
+import threading
+import time
+from typing import Callable, Optional
+
+import pandas as pd
+import pyarrow as pa
+
+try:
+    import fcntl
+except ImportError: # Windows has no fcntl, SharedResultStore needs a POSIX host
+    fcntl = None
+
+
+def _name_part(value: str) -> str:
+    return re.sub(r"[^A-Za-z0-9_-]", "_", str(value))
+
+
+def _is_current(fd: int, path: pathlib.Path) -> bool:
+    # whether the locked descriptor is still the file at path, and not one removed by _remove_lock
+    try:
+        return os.fstat(fd).st_ino == os.stat(path).st_ino
+    except FileNotFoundError:
+        return False
+
+
+def _remove_lock(path: pathlib.Path) -> None:
+    # removes a lock file nobody holds. Left in place while held, a later sweep removes it
+    try:
+        fd = os.open(path, os.O_RDWR)
+    except FileNotFoundError:
+        return
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        if _is_current(fd, path):
+            path.unlink() # still locked, waiters see the file is gone and lock a new one
+    except BlockingIOError:
+        pass
+    finally:
+        os.close(fd)
+
+
+class SharedResultStore:
+    """Second result cache tier shared by every server process on a host, one Arrow IPC file per result.
+
+    Files are written under a temporary name and renamed into place, so readers never see a partial
+    file. A lock file per key lets one process compute a result while the others wait for its file
+    instead of running the same query, and is removed with the result. Reads memory map the file, so a
+    freshly started process finds the results warm and numeric and timestamp columns stay views of the
+    page cache every process shares. String and categorical columns are converted into each reading
+    process's own memory, so for those every process still holds its own copy.
+    """
+
+    def __init__(self, directory, max_age: float = 24 * 3600.0) -> None:
+        if fcntl is None:
+            raise RuntimeError("SharedResultStore needs fcntl file locks")
+        self.directory = pathlib.Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.max_age = max_age # files older than this are removed by sweep, whatever their TTL
+        self.sweep()
+
+    def path(self, key) -> pathlib.Path:
+        # <env>.<family>.<hash of the whole key>.arrow, so invalidation can match files by env and family
+        digest = hashlib.sha1(repr(tuple(key)).encode()).hexdigest()[:24]
+        return self.directory / f"{_name_part(key.env)}.{_name_part(key.family)}.{digest}.arrow"
+
+    def read(self, key, ttl: float) -> Optional[tuple]:
+        # (frame, wall clock time it was written) when a file younger than ttl seconds exists, else None
+        path = self.path(key)
+        try:
+            written_at = path.stat().st_mtime
+            if time.time() - written_at >= ttl:
+                return None
+            source = pa.memory_map(str(path)) # buffers of the table keep the mapping alive
+            table = pa.ipc.open_file(source).read_all()
+        except (FileNotFoundError, pa.ArrowInvalid):
+            return None
+        return table.to_pandas(split_blocks=True), written_at
+
+    def write(self, key, frame: pd.DataFrame) -> float:
+        # returns the wall clock time the file was written, as read reports it
+        path = self.path(key)
+        staging = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        try:
+            table = pa.Table.from_pandas(frame)
+            with pa.OSFile(str(staging), "wb") as sink:
+                with pa.ipc.new_file(sink, table.schema) as writer:
+                    writer.write_table(table)
+            os.replace(staging, path)
+            return path.stat().st_mtime
+        finally:
+            with contextlib.suppress(FileNotFoundError):
+                staging.unlink()
+
+    @contextlib.contextmanager
+    def lock(self, key):
+        # exclusive across processes and threads, each holder opens its own lock file descriptor
+        path = self.path(key).with_suffix(".lock")
+        while True:
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            if _is_current(fd, path):
+                break
+            os.close(fd) # removed by _remove_lock while this process waited for it, lock the new file instead
+        try:
+            yield
+        finally:
+            os.close(fd) # closing releases the lock
+
+    def try_lock(self, key) -> Optional[Callable[[], None]]:
+        # lock without waiting, for a holder that releases it from another thread. Returns the function releasing
+        # it, None when another holder has it
+        path = self.path(key).with_suffix(".lock")
+        while True:
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                os.close(fd)
+                return None
+            if _is_current(fd, path):
+                return functools.partial(os.close, fd)
+            os.close(fd)
+
+    def invalidate(self, env: Optional[str] = None, family: Optional[str] = None) -> int:
+        # None matches everything
+        pattern = f"{'*' if env is None else _name_part(env)}.{'*' if family is None else _name_part(family)}.*.arrow"
+        removed = 0
+        for path in self.directory.glob(pattern):
+            with contextlib.suppress(FileNotFoundError):
+                path.unlink()
+                removed += 1
+            _remove_lock(path.with_suffix(".lock"))
+        return removed
+
+    def sweep(self) -> int:
+        # removes result files older than max_age, temporary files left by crashed writers, and the lock
+        # files of results that no longer exist
+        removed = 0
+        now = time.time()
+        for path in list(self.directory.glob("*.arrow")) + list(self.directory.glob("*.tmp")):
+            with contextlib.suppress(FileNotFoundError):
+                if now - path.stat().st_mtime >= (self.max_age if path.suffix == ".arrow" else 3600.0):
+                    path.unlink()
+                    removed += 1
+        for path in self.directory.glob("*.lock"):
+            if not path.with_suffix(".arrow").exists():
+                _remove_lock(path)
+        return removed
+
+    def stats(self) -> dict:
+        files, nbytes = 0, 0
+        for path in self.directory.glob("*.arrow"):
+            with contextlib.suppress(FileNotFoundError):
+                nbytes += path.stat().st_size
+                files += 1
+        return {"shared_files": files, "shared_bytes": nbytes}
@@ -0,0 +1,48 @@
+"""Writes the Parquet snapshot of ACCOUNT_EVENTS that the dashboard serves with data_source = "parquet".
+
+Meant for a nightly job. The new snapshot is swapped in by rename, so a running dashboard keeps
+reading the previous one until it restarts. Credentials come from the environment, so they stay out of
+the process list and the crontab.
+
+Usage: SNOWFLAKE_ACCOUNT=... SNOWFLAKE_USER=... SNOWFLAKE_PASSWORD=... python write_snapshot.py --path snapshot/account_events
+Cron:  0 3 * * * cd /srv/dashboard && python write_snapshot.py --path snapshot/account_events >> snapshot.log 2>&1
+"""
+import argparse
+import os
+import sys
+import time
+
+import snowflake.connector as con
+
+from backends import SnowflakeBackend, write_parquet_snapshot
+from connection_pool import ConnectionPool
+from queries import GAME_NAME
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--path", default="snapshot/account_events", help="snapshot directory, the app's snapshot_path")
+    parser.add_argument("--game-name", default=GAME_NAME)
+    args = parser.parse_args()
+
+    missing = [name for name in ("SNOWFLAKE_ACCOUNT", "SNOWFLAKE_USER", "SNOWFLAKE_PASSWORD") if not os.environ.get(name)]
+    if missing:
+        print(f"Missing environment variables: {', '.join(missing)}", file=sys.stderr)
+        return 2
+
+    backend = SnowflakeBackend(ConnectionPool(lambda: con.connect(
+        account=os.environ["SNOWFLAKE_ACCOUNT"],
+        user=os.environ["SNOWFLAKE_USER"],
+        password=os.environ["SNOWFLAKE_PASSWORD"],
+    ), max_size=1))
+    start = time.perf_counter()
+    try:
+        rows = write_parquet_snapshot(backend, args.path, game_name=args.game_name)
+    finally:
+        backend.close()
+    print(f"{rows} rows of {args.game_name} written to {args.path} in {time.perf_counter() - start:.1f}s")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())